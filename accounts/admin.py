@@ -1,7 +1,56 @@
+import json
+
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django import forms
-from .models import User
+from .models import User, ServiceZone, AccountPurge, TripLocations, ProfileCapture
+from .contacts import canonical_email, canonical_phone, phone_prefix, is_email
+from smart_rider.db_router import use_replica
+
+# upper bound for range scans, sorts after any character a prefix can continue with
+PREFIX_END = '\U0010ffff'
+ACTION_BATCH_SIZE = 1000
+
+
+class EstimatedCountPaginator(Paginator):
+    # Counts stop at count_limit rows. Past that the page count comes from the
+    # PostgreSQL planner when available, otherwise the list is capped at the limit
+    # and a search or filter is needed to reach older rows.
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        exact = queryset[:self.count_limit + 1].count()
+        if exact <= self.count_limit:
+            return exact
+        return max(self.estimate(queryset), self.count_limit)
+
+    def estimate(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return 0
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+def prefix_range(field, prefix):
+    # a range instead of LIKE so the btree index on the column is used
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix + PREFIX_END})
 
 
 class UserCreationForm(forms.ModelForm):
@@ -16,13 +65,15 @@ class UserCreationForm(forms.ModelForm):
         if '@' in value:
             try:
                 forms.EmailField().clean(value)
-                if User.objects.filter(email=value).exists():
-                    raise forms.ValidationError("Email already exists.")
-                return value
-            except:
+            except forms.ValidationError:
                 raise forms.ValidationError("Invalid email.")
+            if User.objects.get_by_contact(value):
+                raise forms.ValidationError("Email already exists.")
+            return value
         else:
-            if User.objects.filter(phone=value).exists():
+            if not canonical_phone(value):
+                raise forms.ValidationError("Invalid phone.")
+            if User.objects.get_by_contact(value):
                 raise forms.ValidationError("Phone already exists.")
             return value
 
@@ -55,8 +106,13 @@ class UserAdmin(UserAdmin):
 
     list_display = ('username', 'get_contact', 'full_name', 'account_type', 'is_verified', 'is_staff')
     list_filter = ('account_type', 'is_verified', 'is_staff')
-    search_fields = ('username', 'email', 'phone', 'full_name')
+    # get_search_results below does the matching, these only enable the search box
+    search_fields = ('username', 'email_canonical', 'phone_canonical')
+    search_help_text = ("Prefix of an email, phone or username. "
+                        "Start with = for an exact contact, ~ to match anywhere in the name (slow).")
     ordering = ('-date_joined',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = ('username', 'date_joined', 'updated_at')
 
     fieldsets = (
@@ -74,6 +130,38 @@ class UserAdmin(UserAdmin):
         ('Permissions', {'fields': ('is_verified', 'is_staff')}),
     )
 
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with use_replica():
+            response = super().changelist_view(request, extra_context)
+            # the result list is a lazy queryset, render while still routed to the replica
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.startswith('='):
+            term = term[1:].strip()
+            field, value = ('email_canonical', canonical_email(term)) if is_email(term) \
+                else ('phone_canonical', canonical_phone(term))
+            condition = Q(username=term)
+            if value:
+                condition |= Q(**{field: value})
+            return queryset.filter(condition), False
+        if term.startswith('~'):
+            return queryset.filter(full_name__icontains=term[1:].strip()), False
+
+        condition = prefix_range('username', term)
+        if is_email(term) or not phone_prefix(term):
+            condition |= prefix_range('email_canonical', canonical_email(term))
+        else:
+            condition |= prefix_range('phone_canonical', phone_prefix(term))
+        return queryset.filter(condition), False
+
     def get_form(self, request, obj=None, **kwargs):
         if obj is None:
             kwargs['form'] = self.add_form
@@ -85,12 +173,81 @@ class UserAdmin(UserAdmin):
 
     actions = ['verify_selected', 'unverify_selected']
 
+    def update_in_batches(self, queryset, **values):
+        # walks the (possibly "select all") queryset by primary key, each batch is
+        # its own short UPDATE so the whole filtered set is never loaded or locked
+        queryset = queryset.exclude(**values).order_by('pk')
+        values['updated_at'] = timezone.now()
+        updated = 0
+        last = None
+        while True:
+            batch = queryset if last is None else queryset.filter(pk__gt=last)
+            pks = list(batch.values_list('pk', flat=True)[:ACTION_BATCH_SIZE])
+            if not pks:
+                return updated
+            updated += User.objects.filter(pk__in=pks).update(**values)
+            last = pks[-1]
+
     def verify_selected(self, request, queryset):
-        updated = queryset.update(is_verified=True)
+        updated = self.update_in_batches(queryset, is_verified=True)
         self.message_user(request, f"{updated} users verified.")
     verify_selected.short_description = "Verify"
 
     def unverify_selected(self, request, queryset):
-        updated = queryset.update(is_verified=False)
+        updated = self.update_in_batches(queryset, is_verified=False)
         self.message_user(request, f"{updated} users unverified.")
-    unverify_selected.short_description = "Unverify"
\ No newline at end of file
+    unverify_selected.short_description = "Unverify"
+
+
+@admin.register(ServiceZone)
+class ServiceZoneAdmin(admin.ModelAdmin):
+    list_display = ('name', 'kind', 'is_active', 'updated_at')
+    list_filter = ('kind', 'is_active')
+    search_fields = ('name',)
+
+
+@admin.register(AccountPurge)
+class AccountPurgeAdmin(admin.ModelAdmin):
+    list_display = ('user_id', 'contact', 'state', 'created_at', 'updated_at', 'finished_at')
+    list_filter = ('state',)
+    search_fields = ('contact',)
+    readonly_fields = ('user_id', 'contact', 'progress', 'error', 'created_at', 'updated_at', 'finished_at')
+
+
+@admin.register(TripLocations)
+class TripLocationsAdmin(admin.ModelAdmin):
+    list_display = ('name', 'address', 'lat', 'lng')
+    search_fields = ('name',)
+
+
+@admin.register(ProfileCapture)
+class ProfileCaptureAdmin(admin.ModelAdmin):
+    list_display = ('target', 'kind', 'duration_ms', 'samples', 'requested_by', 'created_at', 'download_link')
+    list_filter = ('kind',)
+    search_fields = ('target',)
+    exclude = ('folded',)
+    readonly_fields = ('kind', 'target', 'requested_by', 'duration_ms', 'samples', 'created_at', 'download_link')
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_queryset(self, request):
+        # the stacks can be large, only the download reads them
+        return super().get_queryset(request).defer('folded').select_related('requested_by')
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/', self.admin_site.admin_view(self.download), name='accounts_profilecapture_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk):
+        if not self.has_view_permission(request):
+            return HttpResponse(status=403)
+        capture = get_object_or_404(ProfileCapture, pk=pk)
+        response = HttpResponse(capture.folded, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{capture.pk}.folded"'
+        return response
+
+    def download_link(self, obj):
+        return format_html('<a href="{}">folded stacks</a>', reverse('admin:accounts_profilecapture_download', args=[obj.pk]))
+    download_link.short_description = "Download"
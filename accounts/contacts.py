@@ -0,0 +1,55 @@
+import re
+
+from django.conf import settings
+
+# Contacts are matched on a canonical form: lowercased email and E.164 phone
+# numbers, so "+8801711...", "8801711..." and "01711..." are the same account.
+
+PHONE_NOISE = re.compile(r'[\s\-().]')
+
+
+def canonical_email(value):
+    if not value:
+        return None
+    return value.strip().lower()
+
+
+def _international(value):
+    number = PHONE_NOISE.sub('', value)
+    country_code = getattr(settings, 'PHONE_COUNTRY_CODE', '880')
+    if number.startswith('+'):
+        number = number[1:]
+    elif number.startswith('00'):
+        number = number[2:]
+    elif number.startswith('0'):
+        # national format, drop the trunk prefix
+        number = country_code + number[1:]
+    elif not number.startswith(country_code):
+        number = country_code + number
+    return number
+
+
+def canonical_phone(value):
+    if not value:
+        return None
+    number = _international(value)
+    if not number.isdigit() or not 7 <= len(number) <= 15:
+        return None
+    return '+' + number
+
+
+def phone_prefix(value):
+    # canonical form of a partial number typed into a search box
+    number = _international(value)
+    return '+' + number if number.isdigit() else None
+
+
+def is_email(value):
+    return '@' in value
+
+
+def canonical_contact(value):
+    # (field, canonical value) for lookups against the canonical columns
+    if is_email(value):
+        return 'email_canonical', canonical_email(value)
+    return 'phone_canonical', canonical_phone(value)
@@ -0,0 +1,199 @@
+import logging
+import math
+import os
+from array import array
+from functools import lru_cache
+
+from django.conf import settings
+
+from .geocells import haversine
+from .surge import get_heatmap
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVICE_AREA = {'south': 23.65, 'west': 90.30, 'north': 23.92, 'east': 90.52}
+DEFAULT_FARE_RATES = {
+    'BIKE': {'base': 20, 'per_km': 12, 'per_min': 1, 'minimum': 40},
+    'RIK': {'base': 25, 'per_km': 14, 'per_min': 1, 'minimum': 50},
+    'SEDAN': {'base': 50, 'per_km': 25, 'per_min': 3, 'minimum': 120},
+    'SUV': {'base': 70, 'per_km': 32, 'per_min': 4, 'minimum': 160},
+    'BUS': {'base': 100, 'per_km': 40, 'per_min': 5, 'minimum': 250},
+}
+
+# road distance is longer than the straight line between two cell centers
+DETOUR_FACTOR = 1.35
+AVERAGE_SPEED_MPS = 5.5
+# weight given to an observed trip when it is folded into the tables
+TRIP_WEIGHT = 0.2
+
+
+class EstimationGrid:
+    def __init__(self, south, west, north, east, cell_size, cache_size=4096):
+        self.south = south
+        self.west = west
+        self.cell_size = cell_size
+        self.rows = max(1, math.ceil((north - south) / cell_size))
+        self.cols = max(1, math.ceil((east - west) / cell_size))
+        self.size = self.rows * self.cols
+        self.durations = array('f', bytes(4 * self.size * self.size))
+        self.distances = array('f', bytes(4 * self.size * self.size))
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def contains(self, lat, lng):
+        return (self.south <= lat <= self.south + self.rows * self.cell_size
+                and self.west <= lng <= self.west + self.cols * self.cell_size)
+
+    def center(self, index):
+        row, col = divmod(index, self.cols)
+        return (self.south + (row + 0.5) * self.cell_size,
+                self.west + (col + 0.5) * self.cell_size)
+
+    def cell_index(self, lat, lng):
+        row = min(max(int((lat - self.south) // self.cell_size), 0), self.rows - 1)
+        col = min(max(int((lng - self.west) // self.cell_size), 0), self.cols - 1)
+        return row * self.cols + col
+
+    def precompute(self):
+        centers = [self.center(i) for i in range(self.size)]
+        for i, (lat1, lng1) in enumerate(centers):
+            offset = i * self.size
+            for j, (lat2, lng2) in enumerate(centers):
+                distance = haversine(lat1, lng1, lat2, lng2) * DETOUR_FACTOR
+                self.distances[offset + j] = distance
+                self.durations[offset + j] = distance / AVERAGE_SPEED_MPS
+        self.lookup.cache_clear()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            self.durations.tofile(f)
+            self.distances.tofile(f)
+
+    def load(self, path):
+        # the file has no header, its size has to match this grid's dimensions
+        count = self.size * self.size
+        durations, distances = array('f'), array('f')
+        expected = 2 * count * durations.itemsize
+        actual = os.path.getsize(path)
+        if actual != expected:
+            raise ValueError(f'{path} holds {actual} bytes, a {self.rows}x{self.cols} grid needs {expected}')
+        with open(path, 'rb') as f:
+            durations.fromfile(f, count)
+            distances.fromfile(f, count)
+        self.durations, self.distances = durations, distances
+        self.lookup.cache_clear()
+
+    def _weights(self, lat, lng):
+        # bilinear weights over the (up to) four cell centers around a point
+        fy = min(max((lat - self.south) / self.cell_size - 0.5, 0), self.rows - 1)
+        fx = min(max((lng - self.west) / self.cell_size - 0.5, 0), self.cols - 1)
+        r0, c0 = int(fy), int(fx)
+        r1, c1 = min(r0 + 1, self.rows - 1), min(c0 + 1, self.cols - 1)
+        wy, wx = fy - r0, fx - c0
+        return [
+            (r0 * self.cols + c0, (1 - wy) * (1 - wx)),
+            (r0 * self.cols + c1, (1 - wy) * wx),
+            (r1 * self.cols + c0, wy * (1 - wx)),
+            (r1 * self.cols + c1, wy * wx),
+        ]
+
+    def _lookup(self, o_lat, o_lng, d_lat, d_lng):
+        duration = distance = straight = 0.0
+        for o, ow in self._weights(o_lat, o_lng):
+            if not ow:
+                continue
+            offset = o * self.size
+            o_center = self.center(o)
+            for d, dw in self._weights(d_lat, d_lng):
+                if not dw:
+                    continue
+                w = ow * dw
+                duration += w * self.durations[offset + d]
+                distance += w * self.distances[offset + d]
+                straight += w * haversine(*o_center, *self.center(d))
+        direct = haversine(o_lat, o_lng, d_lat, d_lng)
+        if straight < 1:
+            distance = direct * DETOUR_FACTOR
+            return round(distance / AVERAGE_SPEED_MPS), round(distance)
+        # the tables describe trips between cell centers, scale them to the actual points
+        scale = direct / straight
+        return round(duration * scale), round(distance * scale)
+
+    def estimate(self, o_lat, o_lng, d_lat, d_lng):
+        if not (self.contains(o_lat, o_lng) and self.contains(d_lat, d_lng)):
+            return None
+        # ~10m precision is plenty and keeps hot pairs in the cache
+        return self.lookup(round(o_lat, 4), round(o_lng, 4), round(d_lat, 4), round(d_lng, 4))
+
+    def refresh(self, trips):
+        # trips: iterable of (o_lat, o_lng, d_lat, d_lng, duration_s, distance_m)
+        updated = 0
+        for o_lat, o_lng, d_lat, d_lng, duration, distance in trips:
+            if not (self.contains(o_lat, o_lng) and self.contains(d_lat, d_lng)):
+                continue
+            key = self.cell_index(o_lat, o_lng) * self.size + self.cell_index(d_lat, d_lng)
+            self.durations[key] += TRIP_WEIGHT * (duration - self.durations[key])
+            self.distances[key] += TRIP_WEIGHT * (distance - self.distances[key])
+            updated += 1
+        if updated:
+            self.lookup.cache_clear()
+        return updated
+
+
+def fare_for(vehicle_type, duration, distance):
+    rates = getattr(settings, 'FARE_RATES', DEFAULT_FARE_RATES)[vehicle_type]
+    fare = rates['base'] + rates['per_km'] * distance / 1000 + rates['per_min'] * duration / 60
+    return round(max(fare, rates['minimum']))
+
+
+_grid = None
+_grid_mtime = None
+
+
+def build_grid():
+    area = getattr(settings, 'SERVICE_AREA', DEFAULT_SERVICE_AREA)
+    return EstimationGrid(
+        area['south'], area['west'], area['north'], area['east'],
+        getattr(settings, 'ESTIMATE_CELL_DEG', 0.02),
+        getattr(settings, 'ESTIMATE_CACHE_SIZE', 4096),
+    )
+
+
+def grid_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except FileNotFoundError:
+        return None
+
+
+def get_grid():
+    # reloaded when build_estimate_grid rewrites the file, no restart needed; a
+    # file that does not fit the configured area falls back to the live tables
+    global _grid, _grid_mtime
+    path = getattr(settings, 'ESTIMATE_GRID_PATH', None)
+    mtime = grid_mtime(path)
+    if _grid is None or mtime != _grid_mtime:
+        grid = build_grid()
+        if mtime is None:
+            grid.precompute()
+        else:
+            try:
+                grid.load(path)
+            except (OSError, EOFError, ValueError):
+                logger.warning('Could not load the estimate grid, computing it instead', exc_info=True)
+                grid.precompute()
+        _grid, _grid_mtime = grid, mtime
+    return _grid
+
+
+def estimate_trip(o_lat, o_lng, d_lat, d_lng, vehicle_type):
+    result = get_grid().estimate(o_lat, o_lng, d_lat, d_lng)
+    if result is None:
+        return None
+    duration, distance = result
+    surge = get_heatmap().surge_at(o_lat, o_lng)
+    return {
+        'eta_seconds': duration,
+        'distance_m': distance,
+        'surge': surge,
+        'fare': round(fare_for(vehicle_type, duration, distance) * surge)
+    }
@@ -0,0 +1,106 @@
+import math
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from smart_rider import metrics
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE = 111320
+
+# Cell edge sizes in degrees, finest first. Drivers sit in one cell per level,
+# so an offer can pick the finest level whose cells are at least as wide as the
+# search radius and reach every candidate through a small block of groups.
+DEFAULT_LEVELS = (0.01, 0.04, 0.16)
+
+
+def get_levels():
+    return tuple(getattr(settings, 'GEOCELL_LEVELS', DEFAULT_LEVELS))
+
+
+def cell_for(lat, lng, level=0):
+    size = get_levels()[level]
+    row = int((lat + 90) // size)
+    col = int((lng + 180) // size)
+    return f'{level}_{row}_{col}'
+
+
+def cells_for(lat, lng):
+    return [cell_for(lat, lng, level) for level in range(len(get_levels()))]
+
+
+def parse_cell(cell):
+    level, row, col = cell.split('_')
+    return int(level), int(row), int(col)
+
+
+def cell_bounds(cell):
+    level, row, col = parse_cell(cell)
+    size = get_levels()[level]
+    south = row * size - 90
+    west = col * size - 180
+    return south, west, south + size, west + size
+
+
+def cell_center(cell):
+    south, west, north, east = cell_bounds(cell)
+    return (south + north) / 2, (west + east) / 2
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def level_for_radius(radius_m):
+    levels = get_levels()
+    for level, size in enumerate(levels):
+        if size * METERS_PER_DEGREE >= radius_m:
+            return level
+    return len(levels) - 1
+
+
+def cells_covering(lat, lng, radius_m):
+    level = level_for_radius(radius_m)
+    size = get_levels()[level]
+    dlat = radius_m / METERS_PER_DEGREE
+    dlng = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    row_min = int((lat - dlat + 90) // size)
+    row_max = int((lat + dlat + 90) // size)
+    col_min = int((lng - dlng + 180) // size)
+    col_max = int((lng + dlng + 180) // size)
+
+    cells = []
+    for row in range(row_min, row_max + 1):
+        for col in range(col_min, col_max + 1):
+            cell = f'{level}_{row}_{col}'
+            south, west, north, east = cell_bounds(cell)
+            # distance from the search point to the closest point of the cell
+            near_lat = min(max(lat, south), north)
+            near_lng = min(max(lng, west), east)
+            if haversine(lat, lng, near_lat, near_lng) <= radius_m:
+                cells.append(cell)
+    return cells
+
+
+def group_name(vehicle_type, cell):
+    return f'drivers.{vehicle_type}.{cell}'
+
+
+async def publish_ride_offer(lat, lng, vehicle_type, offer, radius_m=None):
+    if radius_m is None:
+        radius_m = getattr(settings, 'DRIVER_SEARCH_RADIUS_M', 5000)
+    channel_layer = get_channel_layer()
+    cells = cells_covering(lat, lng, radius_m)
+    for cell in cells:
+        await metrics.group_send(channel_layer, group_name(vehicle_type, cell), {
+            'type': 'ride_offer',
+            'offer': offer,
+            'lat': lat,
+            'lng': lng,
+            'radius': radius_m,
+        })
+    return cells
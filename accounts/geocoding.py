@@ -0,0 +1,172 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .geocells import haversine
+from .models import GeocodeResult
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('country', 'city', 'district', 'region', 'village', 'state',
+          'display_address', 'postcode', 'place_id', 'accuracy')
+
+
+def empty_result():
+    return dict.fromkeys(FIELDS)
+
+
+class NominatimProvider:
+    # OpenStreetMap reverse lookups, mind the public server's usage policy
+    # (GEOCODING_WORKERS=1) or point url at a self-hosted instance
+    url = 'https://nominatim.openstreetmap.org/reverse'
+
+    def __init__(self, url=None, timeout=5, user_agent='smart-rider'):
+        self.url = url or self.url
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+
+    def reverse(self, lat, lng):
+        response = self.session.get(self.url, params={
+            'lat': lat, 'lon': lng, 'format': 'jsonv2', 'addressdetails': 1
+        }, timeout=self.timeout)
+        response.raise_for_status()
+        payload = response.json()
+        address = payload.get('address', {})
+        return {
+            'country': address.get('country'),
+            'city': address.get('city') or address.get('town'),
+            'district': address.get('state_district') or address.get('county'),
+            'region': address.get('region'),
+            'village': address.get('village') or address.get('suburb'),
+            'state': address.get('state'),
+            'display_address': payload.get('display_name'),
+            'postcode': address.get('postcode'),
+            'place_id': payload.get('place_id'),
+            'accuracy': payload.get('importance'),
+        }
+
+
+class FixtureProvider:
+    # Answers from a JSON list of places ({"lat", "lng", <FIELDS>...}) with the
+    # nearest one within max_distance_m, for development and tests without network
+    def __init__(self, path=None, max_distance_m=3000):
+        with open(path or settings.GEOCODING_FIXTURES, encoding='utf-8') as f:
+            self.places = json.load(f)
+        self.max_distance_m = max_distance_m
+
+    def reverse(self, lat, lng):
+        result = empty_result()
+        if not self.places:
+            return result
+        distance, place = min((haversine(lat, lng, p['lat'], p['lng']), p) for p in self.places)
+        if distance <= self.max_distance_m:
+            result.update((k, v) for k, v in place.items() if k in FIELDS)
+        return result
+
+
+class ReverseGeocoder:
+    # Results are cached in GeocodeResult under coordinates rounded to `precision`
+    # decimals (4 is ~11 m). A batch costs one SELECT for the hits; the misses go
+    # to the provider concurrently and are written back with one upsert.
+    def __init__(self, provider, precision=4, ttl=30 * 86400, max_entries=100000,
+                 workers=4, touch_interval=86400, evict_every=1000):
+        self.provider = provider
+        self.precision = precision
+        self.ttl = timedelta(seconds=ttl)
+        self.max_entries = max_entries
+        self.touch_interval = timedelta(seconds=touch_interval)
+        self.evict_every = evict_every
+        self.written = 0
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='geocode')
+
+    def key_for(self, lat, lng):
+        return f'{lat:.{self.precision}f},{lng:.{self.precision}f}'
+
+    def resolve(self, lat, lng):
+        return self.resolve_many([(lat, lng)])[0]
+
+    def resolve_many(self, points):
+        keys = [self.key_for(lat, lng) for lat, lng in points]
+        unique = list(dict.fromkeys(keys))
+        if not unique:
+            return []
+        now = timezone.now()
+        found = {}
+        touch = []
+        rows = GeocodeResult.objects.filter(key__in=unique, created_at__gte=now - self.ttl)
+        for key, data, last_used_at in rows.values_list('key', 'data', 'last_used_at'):
+            found[key] = data
+            # LRU bookkeeping is coarse so that reads rarely write
+            if last_used_at < now - self.touch_interval:
+                touch.append(key)
+        if touch:
+            GeocodeResult.objects.filter(key__in=touch).update(last_used_at=now)
+
+        misses = [key for key in unique if key not in found]
+        if misses:
+            fetched = self.fetch(misses)
+            found.update(fetched)
+            self.store(fetched, now)
+        return [found.get(key) or empty_result() for key in keys]
+
+    def fetch(self, keys):
+        # the rounded point is looked up so the cached answer fits every point in the cell
+        points = [tuple(float(v) for v in key.split(',')) for key in keys]
+        return {key: data for key, data in zip(keys, self.pool.map(self._reverse, points)) if data is not None}
+
+    def _reverse(self, point):
+        try:
+            return self.provider.reverse(*point)
+        except Exception:
+            # not cached, the next request retries
+            logger.warning('Reverse geocoding %s,%s failed', *point, exc_info=True)
+            return None
+
+    def store(self, results, now):
+        if not results:
+            return
+        GeocodeResult.objects.bulk_create(
+            [GeocodeResult(key=key, data=data, created_at=now, last_used_at=now) for key, data in results.items()],
+            update_conflicts=True, unique_fields=['key'], update_fields=['data', 'created_at', 'last_used_at']
+        )
+        self.written += len(results)
+        if self.written >= self.evict_every:
+            self.written = 0
+            self.evict(now)
+
+    def evict(self, now=None):
+        now = now or timezone.now()
+        GeocodeResult.objects.filter(created_at__lt=now - self.ttl).delete()
+        # everything from the first row past max_entries in (last_used_at, pk) order
+        cutoff = (GeocodeResult.objects.order_by('-last_used_at', '-pk')
+                  .values_list('last_used_at', 'pk')[self.max_entries:self.max_entries + 1])
+        if cutoff:
+            last_used_at, pk = cutoff[0]
+            GeocodeResult.objects.filter(
+                Q(last_used_at__lt=last_used_at) | Q(last_used_at=last_used_at, pk__lte=pk)
+            ).delete()
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    global _geocoder
+    if _geocoder is None:
+        provider = import_string(settings.GEOCODING_PROVIDER)(**getattr(settings, 'GEOCODING_PROVIDER_OPTIONS', {}))
+        _geocoder = ReverseGeocoder(
+            provider,
+            precision=getattr(settings, 'GEOCODING_PRECISION', 4),
+            ttl=getattr(settings, 'GEOCODING_TTL_S', 30 * 86400),
+            max_entries=getattr(settings, 'GEOCODING_MAX_ENTRIES', 100000),
+            workers=getattr(settings, 'GEOCODING_WORKERS', 4),
+        )
+    return _geocoder
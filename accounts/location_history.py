@@ -0,0 +1,182 @@
+import mmap
+import struct
+import sys
+import time
+from array import array
+from pathlib import Path
+
+from django.conf import settings
+
+# A segment file holds one driver's fixes for one time window as a sequence of
+# blocks. Each block starts with an absolute fix and is followed by int16 deltas
+# (seconds, 1e-6 degrees) for the fixes after it, so a fix costs 6 bytes on disk.
+# A delta that does not fit in int16 simply starts a new block.
+BLOCK_HEADER = struct.Struct('<HIii')
+DELTA_SIZE = 6
+DELTA_MAX = 32767
+SCALE = 1000000
+
+
+def _encode(fixes):
+    blocks = []
+    header = None
+    deltas = array('h')
+    prev = None
+    for t, lat, lng in fixes:
+        point = (int(t), round(lat * SCALE), round(lng * SCALE))
+        if prev is not None:
+            step = (point[0] - prev[0], point[1] - prev[1], point[2] - prev[2])
+            if header[0] < 65535 and all(-DELTA_MAX <= d <= DELTA_MAX for d in step):
+                deltas.extend(step)
+                header[0] += 1
+                prev = point
+                continue
+            blocks.append((header, deltas))
+            deltas = array('h')
+        header = [1, *point]
+        prev = point
+    if header is not None:
+        blocks.append((header, deltas))
+
+    out = bytearray()
+    for header, deltas in blocks:
+        if sys.byteorder != 'little':
+            deltas.byteswap()
+        out += BLOCK_HEADER.pack(*header)
+        out += deltas.tobytes()
+    return bytes(out)
+
+
+def _block_size(buf, offset):
+    # None for a partial block, which a crash mid-append leaves at the end of a segment
+    if offset + BLOCK_HEADER.size > len(buf):
+        return None
+    count = BLOCK_HEADER.unpack_from(buf, offset)[0]
+    size = BLOCK_HEADER.size + (count - 1) * DELTA_SIZE
+    if count < 1 or offset + size > len(buf):
+        return None
+    return size
+
+
+def _complete_length(buf):
+    offset = 0
+    size = _block_size(buf, offset)
+    while size is not None:
+        offset += size
+        size = _block_size(buf, offset)
+    return offset
+
+
+def _decode(buf):
+    offset = 0
+    while _block_size(buf, offset) is not None:
+        count, t, lat, lng = BLOCK_HEADER.unpack_from(buf, offset)
+        offset += BLOCK_HEADER.size
+        size = (count - 1) * DELTA_SIZE
+        deltas = array('h')
+        deltas.frombytes(buf[offset:offset + size])
+        if sys.byteorder != 'little':
+            deltas.byteswap()
+        offset += size
+        yield t, lat / SCALE, lng / SCALE
+        for i in range(0, len(deltas), 3):
+            t += deltas[i]
+            lat += deltas[i + 1]
+            lng += deltas[i + 2]
+            yield t, lat / SCALE, lng / SCALE
+
+
+def downsample(points, interval):
+    # keep the first fix of every `interval` seconds, enough for map playback
+    last = None
+    for point in points:
+        if last is None or point[0] - last >= interval:
+            last = point[0]
+            yield point
+
+
+class LocationHistoryStore:
+    def __init__(self, root, window=3600, batch_size=64):
+        self.root = Path(root)
+        self.window = window
+        self.batch_size = batch_size
+        self.pending = {}
+        # driver id -> segment last checked for a partial block
+        self.checked = {}
+
+    def segment_path(self, driver_id, window_start):
+        return self.root / str(driver_id) / f'{window_start}.seg'
+
+    def record(self, driver_id, lat, lng, t=None):
+        fixes = self.pending.setdefault(driver_id, [])
+        fixes.append((int(time.time() if t is None else t), lat, lng))
+        if len(fixes) >= self.batch_size:
+            self.flush(driver_id)
+
+    def flush(self, driver_id=None):
+        driver_ids = list(self.pending) if driver_id is None else [driver_id]
+        for driver_id in driver_ids:
+            fixes = self.pending.pop(driver_id, None)
+            if fixes:
+                self.append(driver_id, fixes)
+
+    def append(self, driver_id, fixes):
+        fixes = sorted(fixes)
+        start = 0
+        while start < len(fixes):
+            window_start = fixes[start][0] - fixes[start][0] % self.window
+            stop = start
+            while stop < len(fixes) and fixes[stop][0] < window_start + self.window:
+                stop += 1
+            path = self.segment_path(driver_id, window_start)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if self.checked.get(driver_id) != path:
+                self.checked[driver_id] = path
+                self._drop_partial_block(path)
+            with open(path, 'ab') as f:
+                f.write(_encode(fixes[start:stop]))
+            start = stop
+
+    def _drop_partial_block(self, path):
+        # blocks appended after a partial one could not be decoded
+        if not path.exists() or not path.stat().st_size:
+            return
+        with open(path, 'r+b') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                length = _complete_length(buf)
+                truncated = length < len(buf)
+            if truncated:
+                f.truncate(length)
+
+    def query(self, driver_id, start, end, interval=None):
+        points = self._read(driver_id, int(start), int(end))
+        if interval:
+            points = downsample(points, interval)
+        return list(points)
+
+    def _read(self, driver_id, start, end):
+        window_start = start - start % self.window
+        while window_start <= end:
+            path = self.segment_path(driver_id, window_start)
+            window_start += self.window
+            if not path.exists() or not path.stat().st_size:
+                continue
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                # batches can arrive out of order, so sort within the window
+                for point in sorted(_decode(buf)):
+                    if start <= point[0] <= end:
+                        yield point
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = LocationHistoryStore(
+            settings.LOCATION_HISTORY_ROOT,
+            getattr(settings, 'LOCATION_HISTORY_WINDOW', 3600),
+            getattr(settings, 'LOCATION_HISTORY_BATCH', 64),
+        )
+    return _store
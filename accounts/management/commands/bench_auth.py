@@ -0,0 +1,122 @@
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+
+from accounts.models import User
+from smart_rider import benchmarking
+from smart_rider.instrumentation import collect_queries
+
+PASSWORD = 'Bench-pass-2024!'
+NEW_PASSWORD = 'Bench-pass-2025!'
+STEPS = ('register', 'verify-otp', 'login', 'profile', 'change-password')
+
+
+class FakeTwilioClient:
+    # stands in for twilio.rest.Client, records nothing and never touches the network
+    def __init__(self, *args, **kwargs):
+        self.messages = self
+
+    def create(self, **kwargs):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Benchmark register, verify-otp, login, profile and change-password on a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Accounts driven through the whole flow')
+        parser.add_argument('--warmup', type=int, default=3, help='Flows run before measuring')
+        parser.add_argument('--client', choices=['wsgi', 'asgi'], default='wsgi')
+        parser.add_argument('--fast-hasher', action='store_true',
+                            help='MD5 instead of PBKDF2, to see the cost of everything but hashing')
+        parser.add_argument('--output', help='Write the results as JSON')
+        parser.add_argument('--baseline', help='Earlier --output to compare against')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative latency increase over the baseline')
+
+    def handle(self, *args, **options):
+        with benchmarking.bench_environment(fast_hasher=options['fast_hasher']), \
+                mock.patch('twilio.rest.Client', FakeTwilioClient):
+            self.client = self.make_client(options['client'])
+            for i in range(options['warmup']):
+                self.run_flow(f'warmup{i}', {})
+            samples = {step: {'timer': benchmarking.Timer(), 'queries': [], 'errors': 0} for step in STEPS}
+            started = time.perf_counter()
+            for i in range(options['users']):
+                self.run_flow(i, samples)
+            elapsed = time.perf_counter() - started
+
+        results = {
+            'benchmark': 'auth',
+            'environment': benchmarking.environment(),
+            'config': {k: options[k] for k in ('users', 'client', 'fast_hasher')},
+            'flows_per_s': round(options['users'] / elapsed, 2),
+            'scenarios': {
+                step: benchmarking.summarize(s['timer'].latencies, s['queries'], errors=s['errors'])
+                for step, s in samples.items()
+            },
+        }
+        self.report(results)
+        benchmarking.check_errors(results)
+        if options['output']:
+            benchmarking.save(options['output'], results)
+        if options['baseline']:
+            benchmarking.check_baseline(self, results, options['baseline'], options['threshold'])
+
+    def make_client(self, kind):
+        if kind == 'wsgi':
+            return Client()
+        client = AsyncClient()
+
+        class SyncFacade:
+            # same call shape as Client, driving the ASGI handler
+            def get(self, *args, **kwargs):
+                return async_to_sync(client.get)(*args, **kwargs)
+
+            def post(self, *args, **kwargs):
+                return async_to_sync(client.post)(*args, **kwargs)
+        return SyncFacade()
+
+    def call(self, samples, step, method, path, expected, **kwargs):
+        sample = samples.get(step)
+        if sample is None:
+            return getattr(self.client, method)(path, **kwargs)
+        with collect_queries() as collector, sample['timer'].measure():
+            response = getattr(self.client, method)(path, **kwargs)
+        sample['queries'].append(collector.count)
+        if response.status_code != expected:
+            sample['errors'] += 1
+        return response
+
+    def run_flow(self, i, samples):
+        # half the accounts sign up by phone so both OTP transports are exercised
+        contact = f'+88017{abs(hash(i)) % 10 ** 8:08d}' if isinstance(i, int) and i % 2 else f'bench{i}@example.com'
+        response = self.call(samples, 'register', 'post', '/api/accounts/register/', 201,
+                             data={'email_or_phone': contact, 'password': PASSWORD, 'full_name': f'Bench {i}'})
+        user = User.objects.get_by_contact(contact)
+        if user is None:
+            # no account to go on with, a 201 without one is a failed sign-up as well
+            if 'register' in samples and response.status_code == 201:
+                samples['register']['errors'] += 1
+            return
+        self.call(samples, 'verify-otp', 'post', '/api/accounts/verify-otp/', 200,
+                  data={'contact': contact, 'otp': user.otp_code})
+        response = self.call(samples, 'login', 'post', '/api/accounts/login/', 200,
+                             data={'email_or_phone': contact, 'password': PASSWORD})
+        # headers= rather than an HTTP_ key, AsyncClient only reads the former
+        headers = {'Authorization': f'Bearer {response.json().get("access", "")}'}
+        self.call(samples, 'profile', 'get', '/api/accounts/profile/', 200, headers=headers)
+        self.call(samples, 'change-password', 'post', '/api/accounts/change-password/', 200,
+                  data={'old_password': PASSWORD, 'new_password': NEW_PASSWORD,
+                        'new_password_confirm': NEW_PASSWORD}, headers=headers)
+
+    def report(self, results):
+        self.stdout.write(f'{"endpoint":<18}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+                          f'{"queries":>9}{"errors":>8}')
+        for step, s in results['scenarios'].items():
+            self.stdout.write(f'{step:<18}{s["throughput_per_s"]:>10}{s["p50_ms"]:>10}{s["p95_ms"]:>10}'
+                              f'{s["p99_ms"]:>10}{s["queries_per_request"]:>9}{s["errors"]:>8}')
+        self.stdout.write(f'{results["flows_per_s"]} complete flows/s')
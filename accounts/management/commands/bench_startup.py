@@ -0,0 +1,158 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from smart_rider import benchmarking
+
+ENTRY_POINTS = {'wsgi': 'smart_rider.wsgi', 'asgi': 'smart_rider.asgi'}
+PHASES = ('interpreter', 'setup', 'application', 'first_request', 'second_request', 'ready')
+
+# Runs in a fresh interpreter, so nothing the parent imported is warm. Times are
+# wall clock so the parent can add the process launch to them.
+CHILD = r'''
+import json, sys, time
+started = time.time()
+entry, path = sys.argv[1], sys.argv[2]
+timings = {}
+
+def timed(name, call):
+    start = time.perf_counter()
+    result = call()
+    timings[name] = time.perf_counter() - start
+    return result
+
+import django
+timed('setup', django.setup)
+import importlib
+application = timed('application', lambda: importlib.import_module(entry).application)
+
+if entry.endswith('wsgi'):
+    from io import BytesIO
+
+    def request():
+        status = []
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+        }
+        body = b''.join(application(environ, lambda code, headers, exc_info=None: status.append(code)))
+        return int(status[0].split()[0]), len(body)
+else:
+    import asyncio
+
+    async def call():
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        }
+        sent, events = [], [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if events:
+                return events.pop()
+            await asyncio.Future()
+
+        async def send(message):
+            sent.append(message)
+        await application(scope, receive, send)
+        body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+        return sent[0]['status'], len(body)
+
+    def request():
+        return asyncio.run(call())
+
+status, size = timed('first_request', request)
+timings['ready_at'] = time.time()
+timed('second_request', request)
+print(json.dumps({'started_at': started, 'status': status, 'bytes': size, **timings}))
+'''
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+class Command(BaseCommand):
+    help = ('Measure cold start of fresh worker processes: interpreter launch, django.setup(), importing the '
+            'WSGI or ASGI application, and the first and second request through it. The request goes to '
+            'the configured database, the default path needs none.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh processes per entry point')
+        parser.add_argument('--entry', choices=sorted(ENTRY_POINTS), action='append',
+                            help='Entry point to measure, repeatable, both by default')
+        parser.add_argument('--path', default='/api/accounts/login/',
+                            help='Requested with GET, the default answers 405 without a query')
+        # a worker on one core measured 0.55-0.75s at p50, most of it importing Django,
+        # DRF and simplejwt; pass a larger --budget on a loaded host
+        parser.add_argument('--budget', type=float, default=1.0,
+                            help='Seconds from launch to the first response a worker may take at p50')
+        parser.add_argument('--imports', type=int, default=10, help='Slowest imports to list, 0 to skip')
+        parser.add_argument('--output', help='Write the results as JSON')
+        parser.add_argument('--baseline', help='Earlier --output to compare against')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative latency increase over the baseline')
+
+    def handle(self, *args, **options):
+        entries = options['entry'] or sorted(ENTRY_POINTS)
+        scenarios = {}
+        for entry in entries:
+            runs = [self.launch(ENTRY_POINTS[entry], options['path']) for _ in range(options['runs'])]
+            errors = sum(1 for run in runs if run['status'] >= 500)
+            for phase in PHASES:
+                scenarios[f'{entry}:{phase}'] = benchmarking.summarize([run[phase] for run in runs], errors=errors)
+
+        results = {
+            'benchmark': 'startup',
+            'environment': benchmarking.environment(),
+            'config': {'runs': options['runs'], 'entry': entries, 'path': options['path']},
+            'scenarios': scenarios,
+        }
+        if options['imports']:
+            results['slowest_imports'] = self.slowest_imports(ENTRY_POINTS[entries[0]], options['path'],
+                                                              options['imports'])
+        self.report(results)
+        if options['output']:
+            benchmarking.save(options['output'], results)
+        if options['baseline']:
+            benchmarking.check_baseline(self, results, options['baseline'], options['threshold'])
+        slow = [entry for entry in entries if scenarios[f'{entry}:ready']['p50_ms'] > options['budget'] * 1000]
+        if slow:
+            raise CommandError(f'{", ".join(slow)} took longer than {options["budget"]}s to serve a first request')
+
+    def launch(self, module, path, *flags):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE}
+        launched = time.time()
+        process = subprocess.run([sys.executable, *flags, '-c', CHILD, module, path], cwd=settings.BASE_DIR,
+                                 env=env, capture_output=True, text=True)
+        if process.returncode:
+            raise CommandError(f'{module} failed to start:\n{process.stderr[-2000:]}')
+        run = json.loads(process.stdout.strip().splitlines()[-1])
+        run['interpreter'] = run['started_at'] - launched
+        run['ready'] = run['ready_at'] - launched
+        run['stderr'] = process.stderr
+        return run
+
+    def slowest_imports(self, module, path, count):
+        # top level imports only, by cumulative time; nested ones are inside them
+        imports = []
+        for line in self.launch(module, path, '-X', 'importtime')['stderr'].splitlines():
+            match = IMPORT_LINE.match(line)
+            if match and not match.group(3):
+                imports.append((match.group(4), round(int(match.group(2)) / 1000, 1)))
+        return sorted(imports, key=lambda item: -item[1])[:count]
+
+    def report(self, results):
+        self.stdout.write(f'{"phase":<22}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}')
+        for name, s in results['scenarios'].items():
+            self.stdout.write(f'{name:<22}{s["p50_ms"]:>10}{s["p95_ms"]:>10}{s["max_ms"]:>10}')
+        if results.get('slowest_imports'):
+            self.stdout.write('slowest imports (cumulative ms):')
+            for name, ms in results['slowest_imports']:
+                self.stdout.write(f'  {ms:>8}  {name}')
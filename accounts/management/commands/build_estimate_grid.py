@@ -0,0 +1,40 @@
+import csv
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.estimates import build_grid
+
+TRIP_FIELDS = ('o_lat', 'o_lng', 'd_lat', 'd_lng', 'duration_s', 'distance_m')
+
+
+class Command(BaseCommand):
+    help = 'Precompute the ETA/fare estimation tables and fold in completed trips'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trips', help='CSV of completed trips with a header row: ' + ','.join(TRIP_FIELDS))
+        parser.add_argument('--rebuild', action='store_true', help='Ignore the saved tables and start over')
+
+    def handle(self, *args, **options):
+        path = getattr(settings, 'ESTIMATE_GRID_PATH', None)
+        if not path:
+            raise CommandError('ESTIMATE_GRID_PATH is not configured')
+
+        grid = build_grid()
+        if not options['rebuild'] and Path(path).exists():
+            try:
+                grid.load(path)
+            except (OSError, EOFError, ValueError) as e:
+                raise CommandError(f'{e}, run again with --rebuild')
+        else:
+            grid.precompute()
+
+        if options['trips']:
+            with open(options['trips'], newline='') as f:
+                rows = (tuple(float(row[field]) for field in TRIP_FIELDS) for row in csv.DictReader(f))
+                updated = grid.refresh(rows)
+            self.stdout.write(f'{updated} trips applied')
+
+        grid.save(path)
+        self.stdout.write(self.style.SUCCESS(f'{grid.size} cells saved to {path}'))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from accounts.media import PHOTO_FIELDS, build_variants
+from accounts.models import User
+
+
+class Command(BaseCommand):
+    help = 'Build the resized variants of stored photos that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        has_photo = Q()
+        for field in PHOTO_FIELDS:
+            has_photo |= Q(**{f'{field}__gt': ''})
+        rows = (User.objects.filter(has_photo).order_by('pk').values_list('pk', *PHOTO_FIELDS)
+                .iterator(chunk_size=options['chunk_size']))
+
+        done = {}
+        built = failed = 0
+        changed = []
+        for pk, *names in rows:
+            names = [name for name in names if name]
+            for name in names:
+                # the same original can belong to several users and fields
+                if name not in done:
+                    try:
+                        done[name] = build_variants(name)
+                    except Exception as e:
+                        done[name] = False
+                        failed += 1
+                        self.stderr.write(f'{name}: {e}')
+                    built += done[name]
+            if any(done[name] for name in names):
+                changed.append(pk)
+            if len(changed) >= options['chunk_size']:
+                self.touch(changed)
+        self.touch(changed)
+        self.stdout.write(self.style.SUCCESS(f'{built} photos resized, {failed} failed, '
+                                             f'{len(done) - built - failed} already done'))
+
+    def touch(self, pks):
+        # new updated_at so conditional GETs of the profiles pick up the URLs
+        User.objects.filter(pk__in=pks).update(updated_at=timezone.now())
+        pks.clear()
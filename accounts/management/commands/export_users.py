@@ -0,0 +1,54 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import User
+
+DEFAULT_FIELDS = ['id', 'email', 'phone', 'full_name', 'account_type', 'is_verified',
+                  'date_joined', 'id_number', 'car_name', 'plate_number']
+
+
+class Command(BaseCommand):
+    help = 'Stream users to CSV or JSONL in primary key order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Output file, '-' for stdout")
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--account-type', choices=User.AccountType.values)
+        parser.add_argument('--with-password-hash', action='store_true',
+                            help='Include password hashes so import_users can restore them')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        fields = list(DEFAULT_FIELDS)
+        if options['with_password_hash']:
+            fields.append('password')
+
+        users = User.objects.order_by('pk')
+        if options['account_type']:
+            users = users.filter(account_type=options['account_type'])
+        # values_list + iterator: rows are streamed in chunks, no model instances are built
+        rows = users.values_list(*fields).iterator(chunk_size=options['chunk_size'])
+        header = ['password_hash' if f == 'password' else f for f in fields]
+
+        out = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        count = 0
+        try:
+            if fmt == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(header)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    out.write(json.dumps(dict(zip(header, row)), default=str) + '\n')
+                    count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(f'{count} users exported')
@@ -0,0 +1,255 @@
+import math
+import random
+import string
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import get_hasher
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from accounts.location_history import get_store
+from accounts.models import User, Vehicle
+from contract_app.models import Message
+
+# (name, lat, lng, share of drivers and riders)
+CITIES = [
+    ('Dhaka', 23.8103, 90.4125, 0.6),
+    ('Chattogram', 22.3569, 91.7832, 0.2),
+    ('Sylhet', 24.8949, 91.8687, 0.08),
+    ('Khulna', 22.8456, 89.5403, 0.07),
+    ('Rajshahi', 24.3745, 88.6042, 0.05),
+]
+FIRST_NAMES = ['Abdul', 'Ayesha', 'Farhan', 'Fatema', 'Hasan', 'Imran', 'Jannat', 'Karim', 'Mahmud', 'Mim',
+               'Nabila', 'Nusrat', 'Rahim', 'Rafiq', 'Sadia', 'Sakib', 'Sumaiya', 'Tanvir', 'Tasnim', 'Zahid']
+LAST_NAMES = ['Ahmed', 'Akter', 'Chowdhury', 'Haque', 'Hossain', 'Islam', 'Khan', 'Miah', 'Rahman', 'Sarkar']
+# (type, share of drivers, seats, car names)
+VEHICLES = [
+    (Vehicle.Type.BIKE, 0.35, 1, ['Bajaj Pulsar', 'Honda CB Hornet', 'Yamaha FZS', 'Suzuki Gixxer']),
+    (Vehicle.Type.CAR_SEDAN, 0.3, 4, ['Toyota Axio', 'Toyota Allion', 'Toyota Premio', 'Honda Grace']),
+    (Vehicle.Type.RIKSHAW, 0.2, 3, ['Bajaj RE', 'TVS King']),
+    (Vehicle.Type.CAR_SUV, 0.1, 6, ['Toyota Noah', 'Mitsubishi Pajero', 'Toyota Harrier']),
+    (Vehicle.Type.BUS, 0.05, 30, ['Hino AK1J', 'Ashok Leyland Viking']),
+]
+METROS = ['DHA', 'CTG', 'SYL', 'KHU', 'RAJ']
+SERIES = ['KA', 'KHA', 'GA', 'GHA', 'CHA', 'HA', 'LA', 'MA', 'BA', 'THA']
+PHRASES = ['I am at the gate', 'Where are you?', 'Coming in 2 minutes', 'Please wait a little',
+           'Traffic is heavy here', 'I have arrived', 'Which side of the road?', 'Ok', 'Thank you',
+           'Can you call me?', 'Near the mosque', 'Blue shirt', 'On my way']
+
+
+class Table:
+    # bulk_create spends most of its time preparing every value of every row; at
+    # millions of rows that dominates. Rows here are plain tuples in database
+    # form: columns left out take the model default, adapted once, and only
+    # datetimes are converted per row. Primary keys are given explicitly.
+    def __init__(self, model, **constants):
+        self.fields = model._meta.concrete_fields
+        template = model(**constants)
+        self.defaults = {f.attname: f.get_db_prep_save(getattr(template, f.attname), connection)
+                         for f in self.fields}
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(f.column) for f in self.fields)
+        self.sql = (f'INSERT INTO {quote(model._meta.db_table)} ({columns}) '
+                    f'VALUES ({", ".join(["%s"] * len(self.fields))})')
+        self.names = [f.attname for f in self.fields]
+
+    def row(self, **values):
+        defaults = self.defaults
+        return tuple(values[name] if name in values else defaults[name] for name in self.names)
+
+    def insert(self, rows):
+        with connection.cursor() as cursor:
+            cursor.executemany(self.sql, rows)
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = ('Generate riders, drivers with vehicles, skewed conversations and clustered driver positions. '
+            'The same --seed on an empty database gives the same data, with dates relative to the run. Ids '
+            'are assigned up front, so do not run it against a database taking sign-ups.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Accounts, drivers included')
+        parser.add_argument('--driver-ratio', type=float, default=0.15)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--fixes', type=int, default=10, help='Recent positions written per driver')
+        parser.add_argument('--days', type=int, default=90, help='Spread of sign-ups and conversations')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=20000)
+        parser.add_argument('--password', default='Smart-rider-1',
+                            help='Shared by every generated account')
+
+    def handle(self, *args, **options):
+        if not 0 < options['driver_ratio'] < 1:
+            raise CommandError('--driver-ratio must be between 0 and 1')
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now().replace(microsecond=0)
+        self.days = options['days']
+        # bound once, the connection proxy lookup costs more than the conversion
+        self.when = connection.ops.adapt_datetimefield_value
+
+        started = time.perf_counter()
+        riders, drivers = self.create_users(options['users'], options['driver_ratio'], options['password'])
+        if drivers:
+            self.write_positions(drivers, options['fixes'])
+        if riders and drivers and options['messages']:
+            self.create_messages(riders, drivers, options['messages'])
+        # explicit ids leave sequences behind on PostgreSQL and Oracle
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Vehicle, Message]):
+                cursor.execute(sql)
+        self.stdout.write(self.style.SUCCESS(f'Done in {time.perf_counter() - started:.1f}s'))
+
+    def progress(self, label, done, total, started):
+        if done % 100000 >= self.batch_size and done != total:
+            return
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{label}: {done}/{total} ({done / elapsed if elapsed else 0:,.0f}/s)')
+
+    def next_id(self, model):
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+    def cheap_password(self, password):
+        # One PBKDF2 iteration with the configured hasher: hashing is skipped here
+        # but logins still verify, and upgrade the hash on first use
+        hasher = get_hasher()
+        salt = ''.join(self.rng.choices(string.ascii_letters + string.digits, k=22))
+        if hasattr(hasher, 'iterations'):
+            return hasher.encode(password, salt, iterations=1)
+        return hasher.encode(password, salt)
+
+    def create_users(self, count, driver_ratio, password):
+        # returns (rider ids, [(driver id, home city)]); a user's id also numbers
+        # its contact, national id and plate, which keeps them unique
+        users = Table(User, password=self.cheap_password(password), updated_at=self.now)
+        vehicles = Table(Vehicle)
+        first_id, vehicle_id = self.next_id(User), self.next_id(Vehicle)
+        riders, drivers = [], []
+        started = time.perf_counter()
+        for batch in batched(range(first_id, first_id + count), self.batch_size):
+            user_rows, vehicle_rows = [], []
+            for n in batch:
+                if self.rng.random() < driver_ratio:
+                    city = self.city()
+                    vehicle = self.build_vehicle(n, city)
+                    user_rows.append(users.row(**self.build_user(n), account_type=User.AccountType.DRIVER,
+                                               id_number=str(1000000000000 + n), car_name=vehicle['car_name'],
+                                               plate_number=vehicle['vehicle_number']))
+                    del vehicle['car_name']
+                    vehicle_rows.append(vehicles.row(id=vehicle_id, driver_id=n, **vehicle))
+                    vehicle_id += 1
+                    drivers.append((n, city))
+                else:
+                    user_rows.append(users.row(**self.build_user(n)))
+                    riders.append(n)
+            with transaction.atomic():
+                users.insert(user_rows)
+                vehicles.insert(vehicle_rows)
+            self.progress('users', batch[-1] - first_id + 1, count, started)
+        return riders, drivers
+
+    def city(self):
+        return self.rng.choices(CITIES, weights=[city[3] for city in CITIES])[0]
+
+    def build_user(self, n):
+        rng = self.rng
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        values = {
+            'id': n,
+            'full_name': f'{first} {last}',
+            'is_verified': rng.random() < 0.9,
+            'date_joined': self.when(self.now - timedelta(seconds=rng.randrange(self.days * 86400))),
+            'payment_method': rng.choice(User.PaymentMethod.values) if rng.random() < 0.7 else None,
+        }
+        # what User.save() would derive, in the canonical form already
+        if rng.random() < 0.5:
+            values['email'] = values['email_canonical'] = values['username'] = (
+                f'{first}.{last}.{n}@example.com'.lower())
+        else:
+            values['phone'] = values['phone_canonical'] = values['username'] = f'+8801{3 + n % 7}{n // 7:08d}'
+        return values
+
+    def build_vehicle(self, n, city):
+        rng = self.rng
+        kind, _, seats, names = rng.choices(VEHICLES, weights=[v[1] for v in VEHICLES])[0]
+        # unique for the first ten million ids and within User.plate_number, like "DHA-GA 12-3456"
+        series = SERIES[n // 1000000 % 10]
+        return {
+            'vehicle_number': f'{METROS[CITIES.index(city)]}-{series} {n // 10000 % 100:02d}-{n % 10000:04d}',
+            'vehicle_type': kind.value,
+            'seat_capacity': seats,
+            'mileage': round(rng.uniform(5000, 250000), 1),
+            'car_name': rng.choice(names),
+        }
+
+    def write_positions(self, drivers, fixes):
+        # a short recent trace per driver, starting near its city center
+        if not fixes:
+            return
+        store = get_store()
+        rng = self.rng
+        now = int(time.time())
+        started = time.perf_counter()
+        for i, (driver_id, city) in enumerate(drivers, start=1):
+            # most drivers work the center, fewer the further out
+            radius = abs(rng.gauss(0, 0.03))
+            angle = rng.uniform(0, 2 * math.pi)
+            lat, lng = city[1] + radius * math.sin(angle), city[2] + radius * math.cos(angle)
+            t = now - fixes * 15
+            trace = []
+            for _ in range(fixes):
+                t += rng.randint(5, 25)
+                lat += rng.gauss(0, 0.0005)
+                lng += rng.gauss(0, 0.0005)
+                trace.append((t, round(lat, 6), round(lng, 6)))
+            store.append(driver_id, trace)
+            if i % 100000 == 0 or i == len(drivers):
+                self.progress('driver positions', i, len(drivers), started)
+
+    def conversations(self, riders, drivers, total, table):
+        # Pareto sized conversations: most are a couple of messages, a few run
+        # into the hundreds; popular drivers (low indexes) chat far more often
+        rng, when = self.rng, self.when
+        day_ago = self.now - timedelta(days=1)
+        message_id = self.next_id(Message)
+        made = 0
+        while made < total:
+            count = min(total - made, int(rng.paretovariate(1.16)) + 1, 2000)
+            rider = riders[int(rng.random() * len(riders))]
+            driver = drivers[int(len(drivers) * rng.random() ** 3)][0]
+            at = self.now - timedelta(seconds=rng.randrange(self.days * 86400))
+            sender, receiver = (rider, driver) if rng.random() < 0.6 else (driver, rider)
+            for _ in range(count):
+                if rng.random() < 0.5:
+                    sender, receiver = receiver, sender
+                at += timedelta(seconds=int(rng.expovariate(1 / 45)) + 1)
+                # everything older than a day has been seen
+                yield table.row(id=message_id, sender_id=sender, receiver_id=receiver,
+                                message=rng.choice(PHRASES), timestamp=when(at), is_read=at < day_ago)
+                message_id += 1
+            made += count
+
+    def create_messages(self, riders, drivers, total):
+        table = Table(Message)
+        started = time.perf_counter()
+        done = 0
+        for batch in batched(self.conversations(riders, drivers, total, table), self.batch_size):
+            with transaction.atomic():
+                table.insert(batch)
+            done += len(batch)
+            self.progress('messages', done, total, started)
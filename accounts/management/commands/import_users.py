@@ -0,0 +1,202 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from accounts.contacts import canonical_email, canonical_phone, is_email
+from accounts.models import User
+
+ERROR_FIELDS = ['line', 'contact', 'error']
+
+
+def _init_worker():
+    # spawned workers need their own Django setup before hashing
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_rider.settings')
+    django.setup()
+
+
+def read_rows(path, fmt):
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            # DictReader consumes the header, the first record is line 2
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                yield line, row
+        else:
+            for line, text in enumerate(f, start=1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError:
+                        yield line, None
+
+
+class Command(BaseCommand):
+    help = ('Stream users from CSV or JSONL into the database in batches. The id and date_joined columns '
+            'written by export_users are kept when present.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes used to hash passwords')
+        parser.add_argument('--checkpoint', help='Defaults to <path>.checkpoint')
+        parser.add_argument('--errors', help='Per-row error report, defaults to <path>.errors.csv')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist')
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        errors_path = options['errors'] or f'{path}.errors.csv'
+
+        done = 0 if options['restart'] else self.read_checkpoint()
+        if done:
+            self.stdout.write(f'Resuming after line {done}')
+
+        self.created = self.failed = 0
+        self.kept_ids = False
+        rows = ((line, row) for line, row in read_rows(path, fmt) if line > done)
+        with open(errors_path, 'a' if done else 'w', newline='', encoding='utf-8') as errors_file, \
+                ProcessPoolExecutor(options['workers'], initializer=_init_worker) as pool:
+            self.errors = csv.writer(errors_file)
+            if not done:
+                self.errors.writerow(ERROR_FIELDS)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.import_batch(batch, pool)
+                errors_file.flush()
+                self.write_checkpoint(batch[-1][0])
+                self.stdout.write(f'line {batch[-1][0]}: {self.created} created, {self.failed} failed')
+
+        if self.kept_ids:
+            # rows inserted with their own id leave the sequence behind on some databases
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [User]):
+                    cursor.execute(sql)
+        os.remove(self.checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(
+            f'{self.created} users created, {self.failed} rows failed (see {errors_path})'
+        ))
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_checkpoint(self, line):
+        tmp = f'{self.checkpoint_path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(line))
+        os.replace(tmp, self.checkpoint_path)
+
+    def reject(self, line, contact, error):
+        self.errors.writerow([line, contact, error])
+        self.failed += 1
+
+    def build_user(self, row):
+        # JSONL values are not always strings, a phone can come through as a number
+        contact = str(row.get('contact') or row.get('email') or row.get('phone') or '').strip()
+        if not contact:
+            raise ValueError('contact is required')
+        account_type = row.get('account_type') or User.AccountType.USER
+        if account_type not in User.AccountType.values:
+            raise ValueError(f'unknown account_type {account_type}')
+
+        user = User(
+            full_name=str(row.get('full_name') or ''),
+            account_type=account_type,
+            is_verified=str(row.get('is_verified', '')).lower() in ('1', 'true', 'yes'),
+            id_number=row.get('id_number') or None,
+            car_name=row.get('car_name') or None,
+            plate_number=row.get('plate_number') or None,
+        )
+        # bulk_create skips save(), so fill in what it would have derived
+        if is_email(contact):
+            user.email = User.objects.normalize_email(contact)
+            user.email_canonical = canonical_email(contact)
+            if not user.email_canonical:
+                raise ValueError('invalid email')
+        else:
+            user.phone = contact
+            user.phone_canonical = canonical_phone(contact)
+            if not user.phone_canonical:
+                raise ValueError('invalid phone')
+        user.username = user.email or user.phone
+        if row.get('id'):
+            user.pk = int(row['id'])
+        if row.get('date_joined'):
+            user.date_joined = parse_datetime(str(row['date_joined']))
+            if not user.date_joined:
+                raise ValueError('invalid date_joined')
+        return user
+
+    def import_batch(self, batch, pool):
+        users, lines, passwords, hashed = [], [], [], []
+        seen = set()
+        for line, row in batch:
+            if not isinstance(row, dict):
+                self.reject(line, '', 'unreadable row')
+                continue
+            try:
+                user = self.build_user(row)
+            except (TypeError, ValueError) as e:
+                self.reject(line, row.get('contact') or row.get('email') or row.get('phone') or '', str(e))
+                continue
+            key = user.email_canonical or user.phone_canonical
+            if key in seen:
+                self.reject(line, user.username, 'duplicate contact in file')
+                continue
+            seen.add(key)
+            users.append(user)
+            lines.append(line)
+            passwords.append(row.get('password') or None)
+            hashed.append(row.get('password_hash') or None)
+
+        # one query per column instead of full_clean() per row
+        taken = set(User.objects.filter(email_canonical__in=[u.email_canonical for u in users if u.email_canonical])
+                    .values_list('email_canonical', flat=True))
+        taken |= set(User.objects.filter(phone_canonical__in=[u.phone_canonical for u in users if u.phone_canonical])
+                     .values_list('phone_canonical', flat=True))
+        keep = [i for i, u in enumerate(users) if (u.email_canonical or u.phone_canonical) not in taken]
+        for i in set(range(len(users))) - set(keep):
+            self.reject(lines[i], users[i].username, 'already registered')
+        users = [users[i] for i in keep]
+        lines = [lines[i] for i in keep]
+        to_hash = [passwords[i] for i in keep if not hashed[i]]
+
+        digests = iter(pool.map(make_password, to_hash, chunksize=max(1, len(to_hash) // 32)))
+        for i, user in zip(keep, users):
+            user.password = hashed[i] or next(digests)
+
+        ids = [user.pk for user in users]
+        self.kept_ids = self.kept_ids or any(ids)
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+            self.created += len(users)
+        except (DataError, IntegrityError):
+            # a concurrent sign-up, a clashing id or id_number or a value the column
+            # rejects, isolate the offending rows
+            for line, user, pk in zip(lines, users, ids):
+                user.pk = pk
+                try:
+                    with transaction.atomic():
+                        user.save(force_insert=True, validate=False)
+                    self.created += 1
+                except (DataError, IntegrityError) as e:
+                    self.reject(line, user.username, str(e))
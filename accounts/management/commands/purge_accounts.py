@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.purge import run_pending
+
+
+class Command(BaseCommand):
+    help = 'Delete queued accounts and their related rows in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int)
+        parser.add_argument('--pause', type=float, help='Seconds to sleep between chunks')
+        parser.add_argument('--retry-failed', action='store_true')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new purges')
+        parser.add_argument('--interval', type=float, default=10)
+
+    def handle(self, *args, **options):
+        while True:
+            for purge in run_pending(options['chunk_size'], options['pause'], options['retry_failed']):
+                rows = sum(purge.progress.values())
+                if purge.state == purge.State.DONE:
+                    self.stdout.write(self.style.SUCCESS(f'{purge}: {rows} related rows removed'))
+                else:
+                    self.stdout.write(self.style.ERROR(f'{purge}: {purge.error}'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils import timezone
+
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+PHOTO_FIELDS = ('profile_picture', 'license_photo', 'car_photo')
+DEFAULT_VARIANTS = {'thumb': 160, 'display': 1080}
+
+
+def get_variants():
+    # smallest first, the largest variant is written last and marks the set as ready
+    variants = getattr(settings, 'MEDIA_VARIANTS', DEFAULT_VARIANTS)
+    return sorted(variants.items(), key=lambda item: item[1])
+
+
+def store_upload(upload):
+    # Originals are stored under their content hash, so the same photo uploaded
+    # twice (or by two accounts) is written once and shares its variants.
+    # Hashing reads the upload in chunks; Django has already spooled large files
+    # to a temporary file, which FileSystemStorage then moves instead of copying.
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    upload.seek(0)
+    ext = os.path.splitext(upload.name)[1].lower() or '.jpg'
+    name = f'originals/{digest.hexdigest()[:2]}/{digest.hexdigest()}{ext}'
+    if not default_storage.exists(name):
+        name = default_storage.save(name, upload)
+    return name
+
+
+def variant_name(name, variant):
+    return f'variants/{os.path.splitext(name)[0]}_{variant}.jpg'
+
+
+def variant_urls(name):
+    # the original stands in for every size until the background job has finished,
+    # photos stored before variants existed get theirs from build_media_variants
+    if not name:
+        return None
+    largest = get_variants()[-1][0]
+    if not default_storage.exists(variant_name(name, largest)):
+        return {variant: default_storage.url(name) for variant, _ in get_variants()}
+    return {variant: default_storage.url(variant_name(name, variant)) for variant, _ in get_variants()}
+
+
+def build_variants(name):
+    # Pillow is only needed by the workers resizing, not to serve URLs
+    from PIL import Image, ImageOps
+
+    variants = get_variants()
+    if default_storage.exists(variant_name(name, variants[-1][0])):
+        return False
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        # JPEG can decode straight at a reduced scale, still at least the largest size
+        image.draft('RGB', (variants[-1][1], variants[-1][1]))
+        # apply the orientation tag before EXIF is dropped
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    for variant, size in variants:
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        out = BytesIO()
+        # no exif= argument, so location and camera metadata are not written
+        resized.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+        path = variant_name(name, variant)
+        if default_storage.exists(path):
+            default_storage.delete(path)
+        default_storage.save(path, ContentFile(out.getvalue()))
+    return True
+
+
+_building = {}
+_building_lock = threading.Lock()
+
+
+def _lock_for(name):
+    # the same original can be queued twice (two fields, two accounts), build it once
+    with _building_lock:
+        entry = _building.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _release(name):
+    with _building_lock:
+        entry = _building[name]
+        entry[1] -= 1
+        if not entry[1]:
+            del _building[name]
+
+
+def process(name, user_id):
+    try:
+        with _lock_for(name):
+            build_variants(name)
+        # new updated_at so conditional GETs of the profile pick up the URLs
+        User.objects.filter(pk=user_id).update(updated_at=timezone.now())
+    except Exception:
+        logger.exception('Could not build variants for %s', name)
+    finally:
+        _release(name)
+        connection.close()
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(getattr(settings, 'MEDIA_WORKERS', 2), thread_name_prefix='media')
+    return _pool
+
+
+def schedule_variants(name, user_id):
+    return get_pool().submit(process, name, user_id)
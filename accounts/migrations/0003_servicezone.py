@@ -0,0 +1,24 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_remove_userotp_user_remove_user_about_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceZone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('service', 'Service Area'), ('airport', 'Airport'), ('no_pickup', 'No Pickup')], default='service', max_length=20)),
+                ('polygon', models.JSONField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:17
+
+import logging
+
+from django.db import migrations, models
+
+from accounts.contacts import canonical_email, canonical_phone
+
+BATCH_SIZE = 2000
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_canonical_contacts(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    db = schema_editor.connection.alias
+    collisions = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            User.objects.using(db).filter(pk__gt=last_pk).order_by('pk')
+            .only('pk', 'email', 'phone')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for field, canonical, contact in (('email_canonical', canonical_email, 'email'),
+                                          ('phone_canonical', canonical_phone, 'phone')):
+            values = {user.pk: canonical(getattr(user, contact)) for user in batch}
+            # an older account keeps the canonical key when two rows collide, the
+            # newer one stays unindexed until the duplicate is merged; older rows
+            # are the earlier batches, the only ones written so far
+            owners = dict(
+                User.objects.using(db)
+                .filter(pk__lt=batch[0].pk, **{f'{field}__in': {value for value in values.values() if value}})
+                .values_list(field, 'pk')
+            )
+            for user in batch:
+                value = values[user.pk]
+                owner = owners.setdefault(value, user.pk) if value else None
+                if owner != user.pk and value:
+                    collisions += 1
+                    logger.warning('user %s has the same %s as user %s', user.pk, contact, owner)
+                    value = None
+                setattr(user, field, value)
+        User.objects.using(db).bulk_update(batch, ['email_canonical', 'phone_canonical'])
+        last_pk = batch[-1].pk
+    if collisions:
+        logger.warning('%s contacts collide with an older account and were left unindexed, '
+                       'merge these users so they can sign in by contact', collisions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_servicezone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_canonical',
+            field=models.CharField(blank=True, editable=False, max_length=254, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_canonical',
+            field=models.CharField(blank=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(backfill_canonical_contacts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='email_canonical',
+            field=models.CharField(blank=True, editable=False, max_length=254, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_canonical',
+            field=models.CharField(blank=True, editable=False, max_length=16, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:28
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_trip_locations_geocode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.CharField(max_length=100, unique=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('failed', 'Failed'), ('refunded', 'Refunded')], default='pending', max_length=10)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Vehicle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vehicle_number', models.CharField(max_length=50, unique=True)),
+                ('seat_capacity', models.IntegerField(blank=True, null=True)),
+                ('mileage', models.FloatField(blank=True, null=True)),
+                ('vehicle_type', models.CharField(choices=[('BIKE', 'Bike'), ('SEDAN', 'Car Sedan'), ('SUV', 'Car SUV'), ('RIK', 'Rikshaw'), ('BUS', 'Bus')], default='SEDAN', max_length=10)),
+                ('vehicle_photo', models.ImageField(blank=True, null=True, upload_to='vehicles/')),
+                ('driver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='vehicles', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Ride',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_destination_lat', models.FloatField()),
+                ('start_destination_lng', models.FloatField()),
+                ('end_destination_lat', models.FloatField()),
+                ('end_destination_lng', models.FloatField()),
+                ('from_location', models.CharField(blank=True, max_length=255)),
+                ('to_location', models.CharField(blank=True, max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('state', models.CharField(choices=[('requested', 'Requested'), ('accepted', 'Accepted'), ('ongoing', 'Ongoing'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='requested', max_length=10)),
+                ('otp_verified', models.BooleanField(default=False)),
+                ('driver_history', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='driven_rides', to=settings.AUTH_USER_MODEL)),
+                ('payment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.payment')),
+                ('user_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rides', to=settings.AUTH_USER_MODEL)),
+                ('vehicle', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_history', '-created_at'], name='ride_user_created_idx'), models.Index(fields=['driver_history', '-created_at'], name='ride_driver_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BookedTrip',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_destination_lat', models.FloatField()),
+                ('start_destination_lng', models.FloatField()),
+                ('end_destination_lat', models.FloatField()),
+                ('end_destination_lng', models.FloatField()),
+                ('from_location', models.CharField(blank=True, max_length=255)),
+                ('to_location', models.CharField(blank=True, max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('pickup_time', models.DateTimeField()),
+                ('drop_time', models.DateTimeField(blank=True, null=True)),
+                ('state', models.CharField(choices=[('booked', 'Booked'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='booked', max_length=10)),
+                ('driver_history', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='driven_booked_trips', to=settings.AUTH_USER_MODEL)),
+                ('user_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='booked_trips', to=settings.AUTH_USER_MODEL)),
+                ('payment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.payment')),
+                ('vehicle', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_history', '-created_at'], name='booked_user_created_idx'), models.Index(fields=['driver_history', '-created_at'], name='booked_driver_created_idx')],
+            },
+        ),
+    ]
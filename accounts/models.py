@@ -3,11 +3,15 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Permis
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from datetime import timedelta
+import logging
 import random
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+from .contacts import canonical_contact, canonical_email, canonical_phone
+
+logger = logging.getLogger(__name__)
 
 class UserManager(BaseUserManager):
-    def create_user(self, email=None, phone=None, password=None, **extra_fields):
+    def create_user(self, email=None, phone=None, password=None, validate=True, **extra_fields):
         if not email and not phone:
             raise ValueError("Email or phone is required")
         if email and phone:
@@ -21,9 +25,15 @@ class UserManager(BaseUserManager):
 
         user = self.model(username=username, email=email, phone=phone, **extra_fields)
         user.set_password(password)
-        user.save(using=self._db)
+        user.save(using=self._db, validate=validate)
         return user
 
+    def get_by_contact(self, value):
+        field, canonical = canonical_contact(value)
+        if not canonical:
+            return None
+        return self.filter(**{field: canonical}).first()
+
     def create_superuser(self, email=None, phone=None, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', True)
         extra_fields.setdefault('is_superuser', True)
@@ -52,6 +62,9 @@ class User(AbstractBaseUser, PermissionsMixin):
     full_name = models.CharField(max_length=100, blank=True)
     email = models.EmailField(unique=True, blank=True, null=True)
     phone = models.CharField(max_length=20, unique=True, blank=True, null=True)
+    # lookup keys kept in sync by save(), see accounts.contacts
+    email_canonical = models.CharField(max_length=254, unique=True, blank=True, null=True, editable=False)
+    phone_canonical = models.CharField(max_length=16, unique=True, blank=True, null=True, editable=False)
     account_type = models.CharField(max_length=10, choices=AccountType.choices, default=AccountType.USER)
 
     is_verified = models.BooleanField(default=False)
@@ -78,6 +91,13 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     class Meta:
         db_table = 'custom_user'
+        # the admin change list orders by -date_joined, optionally filtered
+        indexes = [
+            models.Index(fields=['date_joined'], name='user_joined_idx'),
+            models.Index(fields=['account_type', 'date_joined'], name='user_type_joined_idx'),
+            models.Index(fields=['is_verified', 'date_joined'], name='user_verified_joined_idx'),
+            models.Index(fields=['is_staff'], name='user_staff_idx', condition=models.Q(is_staff=True)),
+        ]
 
     def clean(self):
         if not self.email and not self.phone:
@@ -85,18 +105,53 @@ class User(AbstractBaseUser, PermissionsMixin):
         if self.email and self.phone:
             raise ValidationError("Only one contact allowed")
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, validate=True, **kwargs):
         if not self.username:
             self.username = self.email or self.phone
-        self.full_clean()
+        stored = getattr(self, '_stored_contacts', {})
+        for field, contact, value in (('email_canonical', self.email, canonical_email(self.email)),
+                                      ('phone_canonical', self.phone, canonical_phone(self.phone))):
+            if (value and getattr(self, field) is None and stored.get(field) == contact
+                    and self.duplicate_contact(field, value)):
+                # left unindexed by migration 0004, it stays so until the duplicate is merged
+                logger.warning('user %s shares %s %s with another account', self.pk, field, value)
+                value = None
+            setattr(self, field, value)
+        # validate=False leaves uniqueness to the database constraints, callers
+        # must be ready for IntegrityError (see UserRegistrationSerializer)
+        if validate:
+            # only the fields being written can break a constraint, each unique
+            # field validated is a SELECT
+            update_fields = kwargs.get('update_fields')
+            exclude = None
+            if update_fields is not None:
+                exclude = [f.name for f in self._meta.fields if f.name not in update_fields]
+            self.full_clean(exclude=exclude)
+        else:
+            self.clean()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        # contacts as loaded, an unchanged one keeps a missing canonical (see save)
+        user._stored_contacts = {'email_canonical': user.__dict__.get('email'),
+                                 'phone_canonical': user.__dict__.get('phone')}
+        return user
+
+    def duplicate_contact(self, field, value):
+        return type(self)._default_manager.filter(**{field: value}).exclude(pk=self.pk).exists()
+
     def __str__(self):
         return self.username
 
-    def generate_otp(self):
+    def set_otp(self):
         self.otp_code = str(random.randint(100000, 999999))
         self.otp_created_at = timezone.now()
+        return self.otp_code
+
+    def generate_otp(self):
+        self.set_otp()
         self.save(update_fields=['otp_code', 'otp_created_at'])
         return self.otp_code
 
@@ -109,10 +164,198 @@ class User(AbstractBaseUser, PermissionsMixin):
             return False
         return True
 
-    def clear_otp(self):
+    def clear_otp(self, *fields):
+        # fields: other changes to write in the same UPDATE
         self.otp_code = None
         self.otp_created_at = None
         self.is_verified = True
-        self.save(update_fields=['otp_code', 'otp_created_at', 'is_verified'])
-         
+        self.save(update_fields=['otp_code', 'otp_created_at', 'is_verified', 'updated_at', *fields])
+
+
+class ServiceZone(models.Model):
+    class Kind(models.TextChoices):
+        SERVICE_AREA = 'service', 'Service Area'
+        AIRPORT = 'airport', 'Airport'
+        NO_PICKUP = 'no_pickup', 'No Pickup'
+
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=20, choices=Kind.choices, default=Kind.SERVICE_AREA)
+    # [[lat, lng], ...] outer ring, first and last point need not repeat
+    polygon = models.JSONField()
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def clean(self):
+        if not isinstance(self.polygon, list) or len(self.polygon) < 3:
+            raise ValidationError("Polygon needs at least 3 points")
+        for point in self.polygon:
+            if not isinstance(point, (list, tuple)) or len(point) != 2:
+                raise ValidationError("Polygon points must be [lat, lng] pairs")
+
+    def __str__(self):
+        return f"{self.name} ({self.get_kind_display()})"
+
+
+
+class AccountPurge(models.Model):
+    # Deleting an account is queued here and carried out in chunks by
+    # accounts.purge, the user row itself goes last.
+    class State(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    # a plain id, the user row is gone once the purge completes
+    user_id = models.BigIntegerField(unique=True)
+    contact = models.CharField(max_length=254, blank=True)
+    state = models.CharField(max_length=10, choices=State.choices, default=State.PENDING)
+    # rows removed so far per relation, e.g. {"contract_app.Message.sender": 1200}
+    progress = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['state', 'updated_at'])]
+
+    def __str__(self):
+        return f"Purge of {self.contact or self.user_id} ({self.get_state_display()})"
+
+
+class TripLocations(models.Model):
+    name = models.CharField(max_length=100)
+    address = models.CharField(max_length=255, blank=True)
+    thumbnail = models.ImageField(upload_to='locations/', blank=True, null=True)
+    lat = models.FloatField()
+    lng = models.FloatField()
+    description = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = 'Trip locations'
+
+    def __str__(self):
+        return self.name
+
+
+class GeocodeResult(models.Model):
+    # reverse-geocoding cache, see accounts.geocoding
+    key = models.CharField(max_length=32, unique=True)
+    data = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class Vehicle(models.Model):
+    class Type(models.TextChoices):
+        BIKE = 'BIKE', 'Bike'
+        CAR_SEDAN = 'SEDAN', 'Car Sedan'
+        CAR_SUV = 'SUV', 'Car SUV'
+        RIKSHAW = 'RIK', 'Rikshaw'
+        BUS = 'BUS', 'Bus'
+
+    driver = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='vehicles')
+    vehicle_number = models.CharField(max_length=50, unique=True)
+    seat_capacity = models.IntegerField(blank=True, null=True)
+    mileage = models.FloatField(blank=True, null=True)
+    vehicle_type = models.CharField(max_length=10, choices=Type.choices, default=Type.CAR_SEDAN)
+    vehicle_photo = models.ImageField(upload_to='vehicles/', blank=True, null=True)
+
+    def __str__(self):
+        return self.vehicle_number
+
+
+class Payment(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        PAID = 'paid', 'Paid'
+        FAILED = 'failed', 'Failed'
+        REFUNDED = 'refunded', 'Refunded'
+
+    transaction_id = models.CharField(max_length=100, unique=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    date = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+
+    def __str__(self):
+        return self.transaction_id
+
+
+class TripBase(models.Model):
+    start_destination_lat = models.FloatField()
+    start_destination_lng = models.FloatField()
+    end_destination_lat = models.FloatField()
+    end_destination_lng = models.FloatField()
+    from_location = models.CharField(max_length=255, blank=True)
+    to_location = models.CharField(max_length=255, blank=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    payment = models.OneToOneField(Payment, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        abstract = True
+
+
+class Ride(TripBase):
+    class State(models.TextChoices):
+        REQUESTED = 'requested', 'Requested'
+        ACCEPTED = 'accepted', 'Accepted'
+        ONGOING = 'ongoing', 'Ongoing'
+        COMPLETED = 'completed', 'Completed'
+        CANCELLED = 'cancelled', 'Cancelled'
+
+    state = models.CharField(max_length=10, choices=State.choices, default=State.REQUESTED)
+    otp_verified = models.BooleanField(default=False)
+    # the rider and the driver, history lists filter on these
+    user_history = models.ForeignKey(User, on_delete=models.CASCADE, related_name='rides')
+    driver_history = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True,
+                                       related_name='driven_rides')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_history', '-created_at'], name='ride_user_created_idx'),
+            models.Index(fields=['driver_history', '-created_at'], name='ride_driver_created_idx'),
+        ]
+
+
+class BookedTrip(TripBase):
+    class State(models.TextChoices):
+        BOOKED = 'booked', 'Booked'
+        COMPLETED = 'completed', 'Completed'
+        CANCELLED = 'cancelled', 'Cancelled'
+
+    pickup_time = models.DateTimeField()
+    drop_time = models.DateTimeField(blank=True, null=True)
+    state = models.CharField(max_length=10, choices=State.choices, default=State.BOOKED)
+    user_history = models.ForeignKey(User, on_delete=models.CASCADE, related_name='booked_trips')
+    driver_history = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True,
+                                       related_name='driven_booked_trips')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_history', '-created_at'], name='booked_user_created_idx'),
+            models.Index(fields=['driver_history', '-created_at'], name='booked_driver_created_idx'),
+        ]
+
+
+class ProfileCapture(models.Model):
+    # stacks sampled by smart_rider.profiling, folded format for flame graphs
+    class Kind(models.TextChoices):
+        HTTP = 'http', 'HTTP request'
+        WS = 'ws', 'WebSocket events'
+
+    kind = models.CharField(max_length=4, choices=Kind.choices)
+    target = models.CharField(max_length=200)
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    duration_ms = models.FloatField()
+    samples = models.IntegerField()
+    folded = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.target} ({self.created_at:%Y-%m-%d %H:%M})"
@@ -0,0 +1,142 @@
+import logging
+import shutil
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .location_history import get_store
+from .models import AccountPurge, User
+
+logger = logging.getLogger(__name__)
+
+
+def related_steps():
+    # every reverse foreign key to User that would cascade or be nulled by
+    # user.delete(); anything else (PROTECT, DO_NOTHING) is left to the final delete
+    steps = []
+    for rel in User._meta.related_objects:
+        if rel.many_to_many:
+            continue
+        if rel.on_delete is models.CASCADE:
+            action = 'delete'
+        elif rel.on_delete is models.SET_NULL:
+            action = 'nullify'
+        else:
+            continue
+        model = rel.related_model
+        label = f'{model._meta.label}.{rel.field.name}'
+        steps.append((label, model, rel.field.name, action))
+    return steps
+
+
+def request_purge(user):
+    # the account is unusable from here on, the rows go in the background
+    with transaction.atomic():
+        user.is_active = False
+        user.otp_code = None
+        user.otp_created_at = None
+        user.save(update_fields=['is_active', 'otp_code', 'otp_created_at', 'updated_at'])
+        purge, _ = AccountPurge.objects.get_or_create(
+            user_id=user.pk, defaults={'contact': user.get_contact()}
+        )
+        if getattr(settings, 'ACCOUNT_PURGE_IN_PROCESS', True):
+            transaction.on_commit(start_worker)
+    return purge
+
+
+def claim(purge_id, retry_failed=False):
+    # a RUNNING purge whose worker stopped heartbeating is taken over
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'ACCOUNT_PURGE_STALE_S', 300))
+    states = Q(state=AccountPurge.State.PENDING) | Q(state=AccountPurge.State.RUNNING, updated_at__lt=stale)
+    if retry_failed:
+        states |= Q(state=AccountPurge.State.FAILED)
+    return AccountPurge.objects.filter(states, pk=purge_id).update(
+        state=AccountPurge.State.RUNNING, error='', updated_at=timezone.now()
+    ) == 1
+
+
+def run_purge(purge, chunk_size=None, pause=None):
+    chunk_size = chunk_size or getattr(settings, 'ACCOUNT_PURGE_CHUNK_SIZE', 500)
+    pause = getattr(settings, 'ACCOUNT_PURGE_PAUSE_S', 0.05) if pause is None else pause
+    user_id = purge.user_id
+    try:
+        for label, model, field, action in related_steps():
+            manager = model._base_manager
+            remaining = manager.filter(**{field: user_id}).order_by('pk').values_list('pk', flat=True)
+            while True:
+                pks = list(remaining[:chunk_size])
+                if not pks:
+                    break
+                # one short transaction per chunk, progress is committed with the rows
+                with transaction.atomic():
+                    if action == 'delete':
+                        manager.filter(pk__in=pks).delete()
+                    else:
+                        manager.filter(pk__in=pks).update(**{field: None})
+                    purge.progress[label] = purge.progress.get(label, 0) + len(pks)
+                    purge.save(update_fields=['progress', 'updated_at'])
+                if pause:
+                    time.sleep(pause)
+
+        shutil.rmtree(get_store().root / str(user_id), ignore_errors=True)
+        with transaction.atomic():
+            User._base_manager.filter(pk=user_id).delete()
+            purge.state = AccountPurge.State.DONE
+            purge.finished_at = timezone.now()
+            purge.save(update_fields=['state', 'finished_at', 'updated_at'])
+    except Exception as e:
+        logger.exception('Purge of user %s failed', user_id)
+        purge.state = AccountPurge.State.FAILED
+        purge.error = str(e)
+        purge.save(update_fields=['state', 'error', 'updated_at'])
+    return purge
+
+
+def run_pending(chunk_size=None, pause=None, retry_failed=False):
+    states = [AccountPurge.State.PENDING, AccountPurge.State.RUNNING]
+    if retry_failed:
+        states.append(AccountPurge.State.FAILED)
+    done = []
+    ids = list(AccountPurge.objects.filter(state__in=states).order_by('pk').values_list('pk', flat=True))
+    for purge_id in ids:
+        if claim(purge_id, retry_failed):
+            done.append(run_purge(AccountPurge.objects.get(pk=purge_id), chunk_size, pause))
+    return done
+
+
+_worker = None
+_wake = False
+_worker_lock = threading.Lock()
+
+
+def _work():
+    global _worker, _wake
+    try:
+        while True:
+            with _worker_lock:
+                if not _wake:
+                    _worker = None
+                    return
+                _wake = False
+            run_pending()
+    except Exception:
+        logger.exception('Account purge worker stopped')
+        with _worker_lock:
+            _worker = None
+    finally:
+        connection.close()
+
+
+def start_worker():
+    # one background thread per process, woken again if purges arrive while it runs
+    global _worker, _wake
+    with _worker_lock:
+        _wake = True
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name='account-purge', daemon=True)
+            _worker.start()
@@ -2,7 +2,12 @@ from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
 import re
+from .contacts import canonical_email, canonical_phone
+from .geocoding import get_geocoder
+from .media import PHOTO_FIELDS, schedule_variants, store_upload, variant_urls
+from .models import TripLocations, Vehicle, Payment, Ride, BookedTrip
 
 User = get_user_model()
 
@@ -18,21 +23,18 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         }
 
     def validate_email_or_phone(self, value):
+        # uniqueness is enforced by the INSERT in create(), not by a lookup here
         if '@' in value:
             # Email validation
             try:
                 serializers.EmailField().run_validation(value)
             except DjangoValidationError:
                 raise serializers.ValidationError("Enter a valid email address.")
-            if User.objects.filter(email=value).exists():
-                raise serializers.ValidationError("This email is already registered.")
             return value
         else:
             # Phone validation
-            if not re.match(r'^\+?\d{7,20}$', value):
+            if not re.match(r'^\+?\d{7,20}$', value) or not canonical_phone(value):
                 raise serializers.ValidationError("Invalid phone format. Use +8801711111111")
-            if User.objects.filter(phone=value).exists():
-                raise serializers.ValidationError("This phone is already registered.")
             return value
 
     def create(self, validated_data):
@@ -46,14 +48,29 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             email = None
             phone = email_or_phone
 
-        user = User.objects.create_user(
-            email=email,
+        user = User(
+            username=User.objects.normalize_email(email) if email else phone,
+            email=User.objects.normalize_email(email) if email else None,
             phone=phone,
-            password=password,
             **validated_data
         )
+        user.set_password(password)
+        user.set_otp()
+        try:
+            with transaction.atomic():
+                user.save(force_insert=True, validate=False)
+        except IntegrityError as e:
+            raise serializers.ValidationError({'email_or_phone': [self.duplicate_message(e, email)]})
         return user
 
+    def duplicate_message(self, error, email):
+        text = str(error)
+        if not any(field in text for field in ('username', 'email', 'phone')):
+            raise error
+        if email:
+            return "This email is already registered."
+        return "This phone is already registered."
+
 
 class UserLoginSerializer(serializers.Serializer):
     email_or_phone = serializers.CharField()
@@ -66,11 +83,7 @@ class UserLoginSerializer(serializers.Serializer):
         if not email_or_phone or not password:
             raise serializers.ValidationError("Both fields are required.")
 
-        user = None
-        if '@' in email_or_phone:
-            user = User.objects.filter(email=email_or_phone).first()
-        else:
-            user = User.objects.filter(phone=email_or_phone).first()
+        user = User.objects.get_by_contact(email_or_phone)
 
         if user and user.check_password(password):
             if not user.is_active:
@@ -101,11 +114,7 @@ class ForgotPasswordSerializer(serializers.Serializer):
     contact = serializers.CharField(max_length=100)
 
     def validate_contact(self, value):
-        user = None
-        if '@' in value:
-            user = User.objects.filter(email=value).first()
-        else:
-            user = User.objects.filter(phone=value).first()
+        user = User.objects.get_by_contact(value)
 
         if not user:
             raise serializers.ValidationError("No account found with this contact.")
@@ -128,11 +137,7 @@ class SendOTPSerializer(serializers.Serializer):
     contact = serializers.CharField(max_length=100)
 
     def validate_contact(self, value):
-        user = None
-        if '@' in value:
-            user = User.objects.filter(email=value).first()
-        else:
-            user = User.objects.filter(phone=value).first()
+        user = User.objects.get_by_contact(value)
 
         if not user:
             raise serializers.ValidationError("User not found.")
@@ -147,11 +152,7 @@ class VerifyOTPSerializer(serializers.Serializer):
         contact = data.get('contact')
         otp = data.get('otp')
 
-        user = None
-        if '@' in contact:
-            user = User.objects.filter(email=contact).first()
-        else:
-            user = User.objects.filter(phone=contact).first()
+        user = User.objects.get_by_contact(contact)
 
         if not user or not user.verify_otp(otp):
             raise serializers.ValidationError("Invalid or expired OTP.")
@@ -179,10 +180,148 @@ class UserSerializer(serializers.ModelSerializer):
             'id', 'username', 'is_verified', 'date_joined', 'updated_at'
         ]
 
+    def validate_email(self, value):
+        return self.validate_canonical('email_canonical', canonical_email(value), value, "This email is already registered.")
+
+    def validate_phone(self, value):
+        return self.validate_canonical('phone_canonical', canonical_phone(value), value, "This phone is already registered.")
+
+    def validate_canonical(self, field, canonical, value, message):
+        if canonical:
+            users = User.objects.filter(**{field: canonical})
+            if self.instance is not None:
+                users = users.exclude(pk=self.instance.pk)
+            if users.exists():
+                raise serializers.ValidationError(message)
+        return value
+
+    def update(self, instance, validated_data):
+        # photos are stored as-is here, resizing happens in accounts.media workers
+        uploads = {field: validated_data.pop(field) for field in PHOTO_FIELDS if field in validated_data}
+        for field, upload in uploads.items():
+            setattr(instance, field, store_upload(upload) if upload else None)
+        instance = super().update(instance, validated_data)
+        for field in uploads:
+            name = getattr(instance, field).name
+            if name:
+                transaction.on_commit(lambda name=name: schedule_variants(name, instance.pk))
+        return instance
+
     def to_representation(self, instance):
         data = super().to_representation(instance)
         if not instance.email:
             data.pop('email', None)
         if not instance.phone:
             data.pop('phone', None)
-        return data
\ No newline at end of file
+        # the EXIF-free variants once they are built, the original until then
+        request = self.context.get('request')
+        variants = {}
+        for field in PHOTO_FIELDS:
+            urls = variant_urls(getattr(instance, field).name)
+            if urls and request is not None:
+                urls = {k: url and request.build_absolute_uri(url) for k, url in urls.items()}
+            variants[field] = urls
+            data[field] = urls and urls['display']
+        data['photo_variants'] = variants
+        return data
+
+class RideRequestSerializer(serializers.Serializer):
+    VEHICLE_TYPES = ['BIKE', 'SEDAN', 'SUV', 'RIK', 'BUS']
+
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    vehicle_type = serializers.ChoiceField(choices=VEHICLE_TYPES)
+
+
+class FareEstimateSerializer(serializers.Serializer):
+    pickup_lat = serializers.FloatField(min_value=-90, max_value=90)
+    pickup_lng = serializers.FloatField(min_value=-180, max_value=180)
+    drop_lat = serializers.FloatField(min_value=-90, max_value=90)
+    drop_lng = serializers.FloatField(min_value=-180, max_value=180)
+    vehicle_type = serializers.ChoiceField(choices=RideRequestSerializer.VEHICLE_TYPES)
+
+
+class LocationHistoryQuerySerializer(serializers.Serializer):
+    start = serializers.IntegerField(min_value=0)
+    end = serializers.IntegerField(min_value=0)
+    interval = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        if data['end'] < data['start']:
+            raise serializers.ValidationError("End must be after start.")
+        if data['end'] - data['start'] > 7 * 24 * 3600:
+            raise serializers.ValidationError("Range can not exceed 7 days.")
+        return data
+
+
+class TripLocationsListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # resolve the whole page in one batch before the rows are serialized
+        locations = list(data.all() if hasattr(data, 'all') else data)
+        details = get_geocoder().resolve_many([(loc.lat, loc.lng) for loc in locations])
+        self.child.geo_details = {loc.pk: geo for loc, geo in zip(locations, details)}
+        return super().to_representation(locations)
+
+
+class TripLocationsSerializer(serializers.ModelSerializer):
+    geo = serializers.SerializerMethodField('get_geo_details')
+
+    class Meta:
+        model = TripLocations
+        fields = ['id', 'name', 'address', 'thumbnail', 'lng', 'lat', 'description', 'geo']
+        list_serializer_class = TripLocationsListSerializer
+
+    def get_geo_details(self, trip_location_obj):
+        geo_details = getattr(self, 'geo_details', {})
+        if trip_location_obj.pk in geo_details:
+            return geo_details[trip_location_obj.pk]
+        return get_geocoder().resolve(trip_location_obj.lat, trip_location_obj.lng)
+
+
+# built once instead of comparing vehicle_type per row
+VEHICLE_TYPE_LABELS = {
+    Vehicle.Type.CAR_SEDAN: 'Sedan',
+    Vehicle.Type.CAR_SUV: 'Suv',
+    Vehicle.Type.RIKSHAW: 'Rikshaw',
+    Vehicle.Type.BUS: 'Bus',
+    Vehicle.Type.BIKE: 'BIKE',
+}
+
+
+class VehicleSerializer(serializers.ModelSerializer):
+    type = serializers.SerializerMethodField('get_vehicle_type')
+
+    class Meta:
+        model = Vehicle
+        fields = ['id', 'vehicle_number', 'seat_capacity', 'mileage', 'type']
+
+    def get_vehicle_type(self, vehicle_obj):
+        return VEHICLE_TYPE_LABELS.get(vehicle_obj.vehicle_type, 'BIKE')
+
+
+class PaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = ['transaction_id', 'amount', 'date', 'status']
+
+
+class RideSerializer(serializers.ModelSerializer):
+    vehicle = VehicleSerializer()
+    payment = PaymentSerializer()
+
+    class Meta:
+        model = Ride
+        fields = ["id", "start_destination_lat", "start_destination_lng", "end_destination_lat", "end_destination_lng",
+                  "from_location", "to_location", "price", "state", "otp_verified", "vehicle", "payment", "user_history",
+                  "driver_history", "created_at", ]
+
+
+class BookedTripSerializer(serializers.ModelSerializer):
+    vehicle = VehicleSerializer()
+    payment = PaymentSerializer()
+
+    class Meta:
+        model = BookedTrip
+        fields = ["id", "start_destination_lat", "start_destination_lng", "end_destination_lat", "end_destination_lng",
+                  "from_location", "to_location", "pickup_time", "drop_time", "price", "state", "vehicle", "payment",
+                  "user_history", "driver_history", "created_at"]
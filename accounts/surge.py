@@ -0,0 +1,141 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import geocells
+
+
+class SurgeHeatmap:
+    # Counters live in a shared cache so ride requests recorded by HTTP workers
+    # and idle drivers reported to consumers in other processes meet in one
+    # window. Per cell and time bucket: the requests, and the idle drivers that
+    # sent a fix in it. Both expire with the window, so a process that dies
+    # without reporting its drivers gone stops counting them within a window.
+    # The cache's incr and add must be atomic, as they are on Redis, Memcached
+    # and smart_rider.cache.FileBasedCache.
+    def __init__(self, cache, window=300, buckets=30, level=0, threshold=1.0, sensitivity=0.5, maximum=3.0,
+                 prefix='surge'):
+        self.cache = cache
+        self.bucket_width = window / buckets
+        self.buckets = buckets
+        self.level = level
+        self.threshold = threshold
+        self.sensitivity = sensitivity
+        self.maximum = maximum
+        self.prefix = prefix
+        # bucket counters outlive the window by a bucket or two, then expire
+        self.ttl = math.ceil(window + 2 * self.bucket_width)
+
+    def cell_for(self, lat, lng):
+        return geocells.cell_for(lat, lng, self.level)
+
+    def _bucket(self, now):
+        return int(now // self.bucket_width)
+
+    def _incr(self, key, delta, timeout):
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            self.cache.add(key, 0, timeout)
+            return self.cache.incr(key, delta)
+
+    def _register(self, cell):
+        # cells are numbered once so snapshot() can list them without a scan
+        if self.cache.add(f'{self.prefix}:cell:{cell}', True, None):
+            slot = self._incr(f'{self.prefix}:cells', 1, None)
+            self.cache.set(f'{self.prefix}:slot:{slot}', cell, None)
+
+    def presence(self, cell, now=None):
+        # an idle driver counts once per cell and bucket, a consumer reports a new mark only
+        return cell, self._bucket(time.time() if now is None else now)
+
+    def driver_present(self, previous, current, now=None):
+        # previous and current are presence() marks, current is None once the driver is busy or gone
+        if previous == current:
+            return
+        bucket = self._bucket(time.time() if now is None else now)
+        if previous is not None and previous[1] == bucket:
+            # left the cell during this bucket, count it where it ended up
+            self._incr(self._present_key(*previous), -1, self.ttl)
+        if current is not None:
+            self._incr(self._present_key(*current), 1, self.ttl)
+            self._register(current[0])
+
+    def _present_key(self, cell, bucket):
+        return f'{self.prefix}:present:{cell}:{bucket}'
+
+    def record_request(self, lat, lng, now=None):
+        cell = self.cell_for(lat, lng)
+        bucket = self._bucket(time.time() if now is None else now)
+        self._incr(f'{self.prefix}:demand:{cell}:{bucket}', 1, self.ttl)
+        self._register(cell)
+
+    def _windows(self, cells, now):
+        # {cell: (idle now, requests in the window, idle drivers averaged over it)}
+        current = self._bucket(now)
+        span = range(current - self.buckets + 1, current + 1)
+        keys = []
+        for cell in cells:
+            keys.extend(f'{self.prefix}:demand:{cell}:{bucket}' for bucket in span)
+            keys.extend(self._present_key(cell, bucket) for bucket in span)
+        values = self.cache.get_many(keys)
+        windows = {}
+        for cell in cells:
+            demand = sum(values.get(f'{self.prefix}:demand:{cell}:{bucket}', 0) for bucket in span)
+            present = [max(values.get(self._present_key(cell, bucket), 0), 0) for bucket in span]
+            # drivers report in the course of a bucket, the one before it is complete
+            idle = max(present[-2:])
+            windows[cell] = (idle, demand, sum(present) / self.buckets)
+        return windows
+
+    def multiplier(self, demand, supply):
+        ratio = demand / max(supply, 1)
+        if ratio <= self.threshold:
+            return 1.0
+        return round(min(1 + self.sensitivity * (ratio - self.threshold), self.maximum), 1)
+
+    def surge_at(self, lat, lng, now=None):
+        now = time.time() if now is None else now
+        cell = self.cell_for(lat, lng)
+        _, demand, supply = self._windows([cell], now)[cell]
+        return self.multiplier(demand, supply)
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        count = self.cache.get(f'{self.prefix}:cells', 0)
+        slots = self.cache.get_many([f'{self.prefix}:slot:{slot}' for slot in range(1, count + 1)])
+        cells = []
+        for cell, (idle, demand, supply) in self._windows(list(slots.values()), now).items():
+            if not demand and not supply:
+                continue
+            lat, lng = geocells.cell_center(cell)
+            cells.append({
+                'cell': cell,
+                'lat': round(lat, 6),
+                'lng': round(lng, 6),
+                'idle_drivers': idle,
+                'supply': round(supply, 2),
+                'demand': demand,
+                'surge': self.multiplier(demand, supply)
+            })
+        return cells
+
+
+_heatmap = None
+
+
+def get_heatmap():
+    global _heatmap
+    if _heatmap is None:
+        _heatmap = SurgeHeatmap(
+            caches[getattr(settings, 'SURGE_CACHE', 'shared')],
+            window=getattr(settings, 'SURGE_WINDOW_S', 300),
+            buckets=getattr(settings, 'SURGE_BUCKETS', 30),
+            level=getattr(settings, 'SURGE_CELL_LEVEL', 0),
+            threshold=getattr(settings, 'SURGE_THRESHOLD', 1.0),
+            sensitivity=getattr(settings, 'SURGE_SENSITIVITY', 0.5),
+            maximum=getattr(settings, 'SURGE_MAX', 3.0),
+        )
+    return _heatmap
@@ -1,169 +1,1181 @@
-from drf_spectacular.utils import extend_schema_serializer
-from rest_framework import serializers
-from .models import User, TripLocations, Vehicle, Ride, Payment, BookedTrip
-import geocoder
+import csv
+import importlib
+import io
+import json
+import math
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
 
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.admin import site as admin_site
+from django.contrib.auth.hashers import check_password, get_hasher
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connections, router
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
 
-class UserSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = User
-        fields = ['id', 'public_id', 'email', 'name', 'username', 'address', 'gender', 'phone', 'dob', 'account_type', 'date_joined', 'about']
+from contract_app.models import Message
+from smart_rider import benchmarking, metrics
+from smart_rider.cache import CacheLogBus, TwoTierCache
+from smart_rider.db_router import REPLICA, use_replica
+from smart_rider.instrumentation import QueryCountMiddleware
+from smart_rider.query_budget import VOLUMES, Budget, QueryBudgetMixin, url_names
+from . import estimates, geocells, location_history, media, purge as purging, tracking, urls, utils, zones
+from .location_history import LocationHistoryStore
+from .management.commands import bench_auth
+from .admin import EstimatedCountPaginator
+from .geocoding import ReverseGeocoder, empty_result
+from .serializers import UserSerializer
+from .surge import SurgeHeatmap
+from .models import AccountPurge, GeocodeResult, User, Vehicle, Payment, Ride, BookedTrip, ServiceZone, TripLocations
 
 
-class VehicleSerializer(serializers.ModelSerializer):
-    type = serializers.SerializerMethodField('get_vehicle_type')
-    class Meta:
-        model = Vehicle
-        fields = ['id', 'vehicle_number', 'seat_capacity', 'mileage', 'type']
+class RideHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.rider = User.objects.create_user(email='rider@example.com', password='pass12345')
+        cls.driver = User.objects.create_user(
+            phone='01711000001', password='pass12345', account_type=User.AccountType.DRIVER
+        )
+        now = timezone.now()
+        types = list(Vehicle.Type)
+        for i in range(30):
+            vehicle = Vehicle.objects.create(vehicle_number=f'DHA-{i}', vehicle_type=types[i % len(types)])
+            payment = Payment.objects.create(transaction_id=f'tx-{i}', amount=100 + i)
+            Ride.objects.create(
+                start_destination_lat=23.8, start_destination_lng=90.4,
+                end_destination_lat=23.7, end_destination_lng=90.3,
+                price=100 + i, vehicle=vehicle, payment=payment,
+                user_history=cls.rider, driver_history=cls.driver,
+                created_at=now - timedelta(minutes=i),
+            )
 
-    def get_vehicle_type(self, vehicle_obj):
-        type_str = vehicle_obj.vehicle_type
-        type_str = 'Sedan' if type_str == vehicle_obj.Type.CAR_SEDAN \
-            else 'Suv' if type_str == vehicle_obj.Type.CAR_SUV \
-            else 'Rikshaw' if type_str == vehicle_obj.Type.RIKSHAW \
-            else 'Bus' if type_str == vehicle_obj.Type.BUS \
-            else 'BIKE'
-        return type_str
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
 
+    def test_query_count_does_not_grow_with_page_size(self):
+        client = self.client_for(self.rider)
+        for page_size in (1, 10, 30):
+            with self.assertNumQueries(1):
+                response = client.get(reverse('ride-history'), {'page_size': page_size})
+            self.assertEqual(len(response.data['results']), page_size)
 
-class TripLocationsSerializer(serializers.ModelSerializer):
-    geo = serializers.SerializerMethodField('get_geo_details')
+    def test_pages_follow_created_at_without_overlap(self):
+        client = self.client_for(self.rider)
+        seen = []
+        url = reverse('ride-history') + '?page_size=7'
+        while url:
+            response = client.get(url)
+            seen.extend(ride['id'] for ride in response.data['results'])
+            url = response.data['next']
+        expected = list(Ride.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
 
-    class Meta:
-        model = TripLocations
-        fields = ['id', 'name', 'address', 'thumbnail', 'lng', 'lat', 'description', 'geo']
+    def test_driver_sees_driven_rides_with_labels(self):
+        response = self.client_for(self.driver).get(reverse('ride-history'), {'page_size': 5})
+        self.assertEqual(len(response.data['results']), 5)
+        labels = {ride['vehicle']['type'] for ride in response.data['results']}
+        self.assertEqual(labels, {'BIKE', 'Sedan', 'Suv', 'Rikshaw', 'Bus'})
 
-    def get_geo_details(self, trip_location_obj):
-        geo = geocoder.osm([trip_location_obj.lat, trip_location_obj.lng], method='reverse')
+
+DHAKA = [[23.70, 90.33], [23.70, 90.50], [23.90, 90.50], [23.90, 90.33]]
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    # payloads in bytes; ride-request includes the zone index load, confirm-delete
+    # the savepoints around queueing the purge, trip-locations the geocode upsert
+    budgets = {
+        'register': Budget(queries=3, payload=150),
+        'verify-otp': Budget(queries=2, payload=1200),
+        'login': Budget(queries=1, payload=1200),
+        'change-password': Budget(queries=2, payload=100),
+        'forgot-password': Budget(queries=2, payload=100),
+        'reset-password': Budget(queries=2, payload=100),
+        'profile': Budget(queries=1, payload=600),
+        'delete-account': Budget(queries=2, payload=100),
+        'confirm-delete': Budget(queries=8, payload=100),
+        'ride-request': Budget(queries=3, payload=100),
+        'fare-estimate': Budget(queries=1, payload=150),
+        'driver-location-history': Budget(queries=1, payload=100),
+        'surge-heatmap': Budget(queries=1, payload=300),
+        'trip-locations': Budget(queries=5, payload=20000),
+        'ride-history': Budget(queries=2, payload=12000),
+        'booked-trip-history': Budget(queries=2, payload=12000),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rider = User.objects.create_user(email='budget@example.com', password='pass12345')
+        cls.rider.generate_otp()
+        cls.driver = User.objects.create_user(
+            phone='01711000009', password='pass12345', account_type=User.AccountType.DRIVER
+        )
+        cls.vehicle = Vehicle.objects.create(vehicle_number='DHA-BUDGET', driver=cls.driver)
+        ServiceZone.objects.create(name='Dhaka', polygon=DHAKA)
+
+    def setUp(self):
+        # the zone index is process wide, another test may have built it without Dhaka
+        zones._index = None
+        self.rows = 0
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        return client
+
+    def grow_to(self, rows):
+        # rows related to the rider: other accounts, rides, booked trips and saved places
+        now = timezone.now()
+        new = range(self.rows, rows)
+        User.objects.bulk_create(
+            User(username=f'other{i}', email=f'other{i}@example.com', password='!') for i in new
+        )
+        trip = dict(
+            start_destination_lat=23.8, start_destination_lng=90.4, end_destination_lat=23.75,
+            end_destination_lng=90.38, price=120, vehicle=self.vehicle,
+            user_history=self.rider, driver_history=self.driver,
+        )
+        Ride.objects.bulk_create(Ride(created_at=now - timedelta(seconds=i), **trip) for i in new)
+        BookedTrip.objects.bulk_create(BookedTrip(pickup_time=now, created_at=now - timedelta(seconds=i), **trip)
+                                       for i in new)
+        TripLocations.objects.bulk_create(
+            TripLocations(name=f'Place {i}', lat=23.7 + i % 200 / 1000, lng=90.35 + i // 200 / 1000) for i in new
+        )
+        self.rows = rows
+
+    def calls(self):
+        rider, driver = self.client_for(self.rider), self.client_for(self.driver)
+        otp = self.rider.otp_code
+        password = {'new_password': 'Budget-pass-2025!', 'new_password_confirm': 'Budget-pass-2025!'}
+        trip = {'pickup_lat': 23.8, 'pickup_lng': 90.4, 'drop_lat': 23.75, 'drop_lng': 90.38, 'vehicle_type': 'SEDAN'}
         return {
-            'country': geo.country,
-            'city': geo.city,
-            'district': geo.district,
-            'region': geo.region,
-            'village': geo.village,
-            'state': geo.state,
-            'display_address': geo.address,
-            'postcode': geo.postal,
-            'place_id': geo.place_id,
-            'accuracy': geo.accuracy
+            'register': lambda: APIClient().post(reverse('register'), {
+                'email_or_phone': f'new{self.rows}@example.com', 'password': 'Budget-pass-2025!'}),
+            'verify-otp': lambda: APIClient().post(reverse('verify-otp'), {'contact': 'budget@example.com', 'otp': otp}),
+            'login': lambda: APIClient().post(reverse('login'), {
+                'email_or_phone': 'budget@example.com', 'password': 'pass12345'}),
+            'change-password': lambda: rider.post(reverse('change-password'), {'old_password': 'pass12345', **password}),
+            'forgot-password': lambda: APIClient().post(reverse('forgot-password'), {'contact': 'budget@example.com'}),
+            'reset-password': lambda: APIClient().post(reverse('reset-password'), {
+                'contact': 'budget@example.com', 'otp': otp, 'password': 'Budget-pass-2025!'}),
+            'profile': lambda: rider.get(reverse('profile')),
+            'delete-account': lambda: rider.post(reverse('delete-account')),
+            'confirm-delete': lambda: rider.post(reverse('confirm-delete'), {'otp': otp}),
+            'ride-request': lambda: rider.post(reverse('ride-request'), {'lat': 23.8, 'lng': 90.4, 'vehicle_type': 'SEDAN'}),
+            'fare-estimate': lambda: rider.post(reverse('fare-estimate'), trip),
+            'driver-location-history': lambda: driver.get(
+                reverse('driver-location-history', args=[self.driver.id]), {'start': 0, 'end': 3600}),
+            'surge-heatmap': lambda: rider.get(reverse('surge-heatmap')),
+            'trip-locations': lambda: rider.get(reverse('trip-locations')),
+            'ride-history': lambda: rider.get(reverse('ride-history')),
+            'booked-trip-history': lambda: rider.get(reverse('booked-trip-history')),
+        }
+
+    def test_every_url_has_a_budget(self):
+        self.assertEveryNameBudgeted(url_names(urls.urlpatterns))
+        self.assertEqual(set(self.calls()), set(self.budgets))
+
+    def test_endpoints_stay_within_budget(self):
+        first = {}
+        for rows in VOLUMES:
+            self.grow_to(rows)
+            for name, call in self.calls().items():
+                with self.subTest(name, rows=rows):
+                    collector, response = self.measure(call)
+                    self.assertLess(response.status_code, 300, response.content[:300])
+                    self.assertWithinBudget(name, collector, len(response.content), rows)
+                    self.assertNotGrowing(name, first.setdefault(name, collector), collector, rows)
+
+
+class RegistrationTests(TestCase):
+    def register(self, contact):
+        return APIClient().post(reverse('register'), {'email_or_phone': contact, 'password': 'Register-pass-2025!'})
+
+    def test_new_user_is_one_insert(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.register('new@example.com')
+        self.assertEqual(response.status_code, 201)
+        statements = [q['sql'].split()[0] for q in queries.captured_queries]
+        self.assertEqual([s for s in statements if s in ('SELECT', 'INSERT', 'UPDATE')], ['INSERT'])
+        user = User.objects.get(email='new@example.com')
+        self.assertEqual(user.email_canonical, 'new@example.com')
+        self.assertTrue(user.otp_code)
+
+    def test_taken_contact_is_a_field_error(self):
+        User.objects.create_user(email='taken@example.com', password='pass12345')
+        User.objects.create_user(phone='+8801711000009', password='pass12345')
+        cases = {
+            'Taken@Example.com': 'This email is already registered.',
+            '+8801711000009': 'This phone is already registered.',
+            '01711000009': 'This phone is already registered.',
+        }
+        for contact, message in cases.items():
+            with self.subTest(contact):
+                response = self.register(contact)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data, {'email_or_phone': [message]})
+        self.assertEqual(User.objects.count(), 2)
+
+
+class CanonicalContactTests(TestCase):
+    def test_backfill_leaves_the_newer_duplicate_unindexed(self):
+        backfill = importlib.import_module('accounts.migrations.0004_contact_canonical').backfill_canonical_contacts
+        older = User.objects.create_user(email='dup@example.com', password='pass12345')
+        newer = User.objects.create_user(email='other@example.com', password='pass12345')
+        User.objects.filter(pk=newer.pk).update(email='Dup@Example.com', email_canonical=None)
+        User.objects.filter(pk=older.pk).update(email_canonical=None)
+        with self.assertLogs('accounts.migrations', 'WARNING') as logs:
+            backfill(django_apps, SimpleNamespace(connection=connections['default']))
+        self.assertIn(f'user {newer.pk} has the same email as user {older.pk}', logs.output[0])
+        self.assertEqual(User.objects.get_by_contact('DUP@example.com'), older)
+
+        newer = User.objects.get(pk=newer.pk)
+        self.assertIsNone(newer.email_canonical)
+        with self.assertLogs('accounts.models', 'WARNING'):
+            newer.save()
+        self.assertIsNone(User.objects.get(pk=newer.pk).email_canonical)
+
+        older.delete()
+        newer = User.objects.get(pk=newer.pk)
+        newer.save()
+        self.assertEqual(User.objects.get_by_contact('dup@example.com'), newer)
+
+    def test_backfill_finds_collisions_across_batches(self):
+        module = importlib.import_module('accounts.migrations.0004_contact_canonical')
+        users = [User.objects.create_user(email=f'user{i}@example.com', password='!') for i in range(5)]
+        # user 3 repeats user 0 in a later batch, user 4 repeats user 3's phone in the same batch
+        User.objects.filter(pk=users[3].pk).update(email='USER0@example.com', phone='+8801711000003')
+        User.objects.filter(pk=users[4].pk).update(phone='01711000003')
+        User.objects.update(email_canonical=None, phone_canonical=None)
+        with mock.patch.object(module, 'BATCH_SIZE', 2), self.assertLogs('accounts.migrations', 'WARNING') as logs:
+            module.backfill_canonical_contacts(django_apps, SimpleNamespace(connection=connections['default']))
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            f'user {users[3].pk} has the same email as user {users[0].pk}',
+            f'user {users[4].pk} has the same phone as user {users[3].pk}',
+            '2 contacts collide with an older account and were left unindexed, '
+            'merge these users so they can sign in by contact',
+        ])
+        self.assertEqual(User.objects.get_by_contact('user0@example.com'), users[0])
+        self.assertEqual(User.objects.get_by_contact('01711000003'), users[3])
+        self.assertEqual(User.objects.filter(email_canonical=None).get(), users[3])
+
+    def test_new_contact_is_still_validated(self):
+        User.objects.create_user(email='dup@example.com', password='pass12345')
+        user = User.objects.create_user(phone='01711000002', password='pass12345')
+        user = User.objects.get(pk=user.pk)
+        user.phone, user.email = None, 'Dup@example.com'
+        with self.assertRaises(ValidationError):
+            user.save()
+
+
+class UserImportExportTests(TestCase):
+    fields = ['id', 'email', 'phone', 'full_name', 'account_type', 'is_verified', 'date_joined',
+              'id_number', 'car_name', 'plate_number', 'password', 'email_canonical', 'phone_canonical']
+
+    def setUp(self):
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+        User.objects.create_user(email='Rider@Example.com', password='pass12345', full_name='Rider', is_verified=True)
+        User.objects.create_user(phone='01711000001', password='pass12345', account_type=User.AccountType.DRIVER,
+                                 id_number='ID-1', car_name='Axio', plate_number='DHA-1')
+        User.objects.filter(phone='01711000001').update(date_joined=timezone.now() - timedelta(days=400))
+
+    def import_users(self, path):
+        call_command('import_users', path, workers=1, stdout=io.StringIO())
+        with open(f'{path}.errors.csv', newline='') as f:
+            return list(csv.reader(f))[1:]
+
+    def test_export_then_import_restores_users(self):
+        before = list(User.objects.order_by('pk').values_list(*self.fields))
+        for name in ('users.csv', 'users.jsonl'):
+            with self.subTest(name):
+                path = os.path.join(self.directory, name)
+                call_command('export_users', path, with_password_hash=True, stderr=io.StringIO())
+                User.objects.all().delete()
+                self.assertEqual(self.import_users(path), [])
+                self.assertEqual(list(User.objects.order_by('pk').values_list(*self.fields)), before)
+
+    def test_bad_rows_are_reported(self):
+        taken = User.objects.get(phone='01711000001').pk
+        rows = [
+            {'phone': 8801711000011, 'full_name': 'Numeric phone'},
+            'not json',
+            {'email': 'nobody'},
+            {'email': 'a@example.com', 'date_joined': 'yesterday'},
+            {'email': 'b@example.com', 'id': 'x'},
+            {'email': 'c@example.com', 'account_type': 'PILOT'},
+            {'email': 'rider@example.com'},
+            {'email': 'd@example.com', 'id': taken},
+        ]
+        path = os.path.join(self.directory, 'users.jsonl')
+        with open(path, 'w') as f:
+            f.writelines((row if isinstance(row, str) else json.dumps(row)) + '\n' for row in rows)
+
+        errors = {int(line): error for line, contact, error in self.import_users(path)}
+        self.assertEqual(sorted(errors), [2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(errors[2], 'unreadable row')
+        self.assertEqual(errors[3], 'invalid phone')
+        self.assertEqual(errors[4], 'invalid date_joined')
+        self.assertEqual(errors[7], 'already registered')
+        self.assertEqual(User.objects.get(phone='8801711000011').phone_canonical, '+8801711000011')
+        self.assertEqual(User.objects.count(), 3)
+
+
+@override_settings(ACCOUNT_PURGE_IN_PROCESS=False)
+class AccountPurgeTests(TestCase):
+    def setUp(self):
+        self.rider = User.objects.create_user(email='leaving@example.com', password='pass12345')
+        self.driver = User.objects.create_user(
+            phone='01711000001', password='pass12345', account_type=User.AccountType.DRIVER
+        )
+        for i in range(7):
+            Ride.objects.create(
+                start_destination_lat=23.8, start_destination_lng=90.4,
+                end_destination_lat=23.7, end_destination_lng=90.3, price=100 + i,
+                vehicle=Vehicle.objects.create(vehicle_number=f'DHA-{i}', vehicle_type=Vehicle.Type.CAR_SEDAN),
+                payment=Payment.objects.create(transaction_id=f'tx-{i}', amount=100),
+                user_history=self.rider, driver_history=self.driver,
+            )
+
+    def test_rows_go_in_chunks(self):
+        purge = purging.request_purge(self.driver)
+        self.assertFalse(User.objects.get(pk=self.driver.pk).is_active)
+        with CaptureQueriesContext(connections['default']) as queries:
+            purging.run_purge(purge, chunk_size=3, pause=0)
+        # the final user delete nulls whatever is left in one more statement, none here
+        chunks = [q for q in queries.captured_queries
+                  if q['sql'].startswith('UPDATE "accounts_ride"') and '"accounts_ride"."id" IN' in q['sql']]
+        self.assertEqual(len(chunks), 3)
+        purge.refresh_from_db()
+        self.assertEqual(purge.state, AccountPurge.State.DONE)
+        self.assertEqual(purge.progress, {'accounts.Ride.driver_history': 7})
+        self.assertFalse(User.objects.filter(pk=self.driver.pk).exists())
+        self.assertEqual(Ride.objects.filter(driver_history=None).count(), 7)
+
+    def test_failed_purge_resumes_where_it_stopped(self):
+        purge = purging.request_purge(self.rider)
+        self.assertTrue(purging.claim(purge.pk))
+        self.assertFalse(purging.claim(purge.pk))
+        with mock.patch('accounts.purge.time.sleep', side_effect=[None, RuntimeError('lost connection')]), \
+                self.assertLogs('accounts.purge', 'ERROR'):
+            purging.run_purge(purge, chunk_size=3, pause=1)
+        purge.refresh_from_db()
+        self.assertEqual((purge.state, purge.error), (AccountPurge.State.FAILED, 'lost connection'))
+        self.assertEqual(purge.progress, {'accounts.Ride.user_history': 6})
+        self.assertEqual(Ride.objects.count(), 1)
+
+        self.assertEqual(purging.run_pending(chunk_size=3, pause=0), [])
+        [purge] = purging.run_pending(chunk_size=3, pause=0, retry_failed=True)
+        self.assertEqual(purge.state, AccountPurge.State.DONE)
+        self.assertEqual(purge.progress, {'accounts.Ride.user_history': 7})
+        self.assertFalse(User.objects.filter(pk=self.rider.pk).exists())
+
+    def test_stalled_purge_is_taken_over(self):
+        purge = purging.request_purge(self.rider)
+        self.assertTrue(purging.claim(purge.pk))
+        AccountPurge.objects.filter(pk=purge.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        [purge] = purging.run_pending(pause=0)
+        self.assertEqual(purge.state, AccountPurge.State.DONE)
+
+
+class UserAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(email='admin@example.com', password='pass12345')
+        User.objects.create_user(email='Alice@Example.com', password='pass12345', full_name='Alice Rahman')
+        User.objects.create_user(email='malik@example.com', password='pass12345', full_name='Malik Ali')
+        User.objects.create_user(phone='01711000001', password='pass12345', full_name='Driver One')
+        User.objects.create_user(phone='+8801811000002', password='pass12345', full_name='Driver Two')
+
+    def search(self, term):
+        model_admin = admin_site._registry[User]
+        queryset, may_have_duplicates = model_admin.get_search_results(None, User.objects.all(), term)
+        self.assertFalse(may_have_duplicates)
+        return sorted(queryset.values_list('full_name', flat=True))
+
+    def test_search_matches_prefixes_and_exact_contacts(self):
+        cases = {
+            'ali': ['Alice Rahman'],
+            'ALICE@': ['Alice Rahman'],
+            '01711': ['Driver One'],
+            '+88018': ['Driver Two'],
+            '=alice@example.com': ['Alice Rahman'],
+            '=8801711000001': ['Driver One'],
+            '=ali': [],
+            '~ali': ['Alice Rahman', 'Malik Ali'],
+            '  ': ['', 'Alice Rahman', 'Driver One', 'Driver Two', 'Malik Ali'],
+        }
+        for term, names in cases.items():
+            with self.subTest(term):
+                self.assertEqual(self.search(term), names)
+
+    def test_count_stops_at_the_limit(self):
+        queryset = User.objects.order_by('pk')
+        paginator = EstimatedCountPaginator(queryset, 2)
+        self.assertEqual(paginator.count, 5)
+        with mock.patch.object(EstimatedCountPaginator, 'count_limit', 3):
+            paginator = EstimatedCountPaginator(queryset, 2)
+            with CaptureQueriesContext(connections['default']) as queries:
+                self.assertEqual(paginator.count, 3)
+            self.assertEqual(paginator.num_pages, 2)
+        self.assertIn('LIMIT 4', queries.captured_queries[0]['sql'])
+
+    def test_change_list_and_batched_actions(self):
+        client = Client()
+        client.force_login(self.admin)
+        url = reverse('admin:accounts_user_changelist')
+        response = client.get(url, {'q': 'driver', 'account_type__exact': 'USER'})
+        self.assertEqual(response.status_code, 200)
+        response = client.get(url, {'q': '017'})
+        self.assertEqual([user.full_name for user in response.context['cl'].result_list], ['Driver One'])
+
+        with mock.patch('accounts.admin.ACTION_BATCH_SIZE', 2):
+            response = client.post(url, {'action': 'verify_selected', 'select_across': '1', 'index': '0',
+                                         '_selected_action': [self.admin.pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.objects.filter(is_verified=False).count(), 0)
+
+
+class MediaVariantTests(TransactionTestCase):
+    def setUp(self):
+        self.enterContext(override_settings(MEDIA_ROOT=self.enterContext(tempfile.TemporaryDirectory())))
+        self.user = User.objects.create_user(email='photo@example.com', password='pass12345')
+
+    def photo(self, name='photo.JPG', color='red'):
+        out = io.BytesIO()
+        Image.new('RGB', (400, 300), color).save(out, 'JPEG')
+        return SimpleUploadedFile(name, out.getvalue(), content_type='image/jpeg')
+
+    def test_same_photo_is_stored_once(self):
+        name = media.store_upload(self.photo())
+        self.assertRegex(name, r'^originals/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(media.store_upload(self.photo('again.jpg')), name)
+        self.assertNotEqual(media.store_upload(self.photo(color='blue')), name)
+        self.assertEqual(len(default_storage.listdir(os.path.dirname(name))[1]), 1)
+
+    def test_variants_are_built_in_the_background(self):
+        name = media.store_upload(self.photo())
+        updated_at = self.user.updated_at
+        media.schedule_variants(name, self.user.pk).result(timeout=30)
+        for variant, size in media.get_variants():
+            with default_storage.open(media.variant_name(name, variant)) as f:
+                self.assertEqual(max(Image.open(f).size), min(size, 400))
+        self.assertGreater(User.objects.get(pk=self.user.pk).updated_at, updated_at)
+        self.assertFalse(media.build_variants(name))
+
+    def test_old_photos_fall_back_to_the_original_until_backfilled(self):
+        name = default_storage.save('profiles/old.jpg', self.photo())
+        User.objects.filter(pk=self.user.pk).update(profile_picture=name)
+        data = UserSerializer(User.objects.get(pk=self.user.pk)).data
+        self.assertEqual(data['profile_picture'], default_storage.url(name))
+        self.assertEqual(set(data['photo_variants']['profile_picture'].values()), {default_storage.url(name)})
+        self.assertIsNone(data['car_photo'])
+
+        output = io.StringIO()
+        call_command('build_media_variants', stdout=output)
+        self.assertIn('1 photos resized, 0 failed', output.getvalue())
+        data = UserSerializer(User.objects.get(pk=self.user.pk)).data
+        self.assertEqual(data['profile_picture'], default_storage.url(media.variant_name(name, 'display')))
+        self.assertEqual(data['photo_variants']['profile_picture']['thumb'],
+                         default_storage.url(media.variant_name(name, 'thumb')))
+
+
+class FakeProvider:
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = set(failing)
+
+    def reverse(self, lat, lng):
+        self.calls.append((lat, lng))
+        if (lat, lng) in self.failing:
+            raise OSError('provider down')
+        return {**empty_result(), 'display_address': f'{lat},{lng}'}
+
+
+class ReverseGeocoderTests(TestCase):
+    points = [(23.80001, 90.4), (23.80003, 90.40002), (23.81, 90.41), (23.82, 90.42)]
+
+    def test_batch_is_one_select_once_cached(self):
+        provider = FakeProvider()
+        geocoder = ReverseGeocoder(provider, workers=2)
+        results = geocoder.resolve_many(self.points)
+        # the first two share a rounded cell, looked up once at its rounded point
+        self.assertEqual(sorted(provider.calls), [(23.8, 90.4), (23.81, 90.41), (23.82, 90.42)])
+        self.assertEqual([r['display_address'] for r in results],
+                         ['23.8,90.4', '23.8,90.4', '23.81,90.41', '23.82,90.42'])
+        with self.assertNumQueries(1):
+            self.assertEqual(geocoder.resolve_many(self.points), results)
+        self.assertEqual(len(provider.calls), 3)
+        self.assertEqual(GeocodeResult.objects.count(), 3)
+
+    def test_failures_are_not_cached(self):
+        provider = FakeProvider(failing=[(23.81, 90.41)])
+        geocoder = ReverseGeocoder(provider, workers=2)
+        with self.assertLogs('accounts.geocoding', 'WARNING'):
+            results = geocoder.resolve_many(self.points[2:])
+        self.assertEqual(results[0], empty_result())
+        provider.failing.clear()
+        self.assertEqual(geocoder.resolve(23.81, 90.41)['display_address'], '23.81,90.41')
+
+    def test_expired_and_least_used_entries_go(self):
+        provider = FakeProvider()
+        geocoder = ReverseGeocoder(provider, ttl=60, max_entries=2, evict_every=1, touch_interval=0)
+        geocoder.resolve_many(self.points[2:])
+        GeocodeResult.objects.update(created_at=timezone.now() - timedelta(minutes=2))
+        geocoder.resolve(23.82, 90.42)
+        self.assertEqual(provider.calls[-1], (23.82, 90.42))
+
+        GeocodeResult.objects.update(last_used_at=timezone.now() - timedelta(hours=1))
+        geocoder.resolve(23.81, 90.41)
+        geocoder.resolve(23.83, 90.43)
+        self.assertEqual(sorted(GeocodeResult.objects.values_list('key', flat=True)),
+                         ['23.8100,90.4100', '23.8300,90.4300'])
+
+
+class InstrumentationTests(TestCase):
+    def test_sampled_request_logs_its_queries(self):
+        user = User.objects.create_user(email='logged@example.com', password='pass12345')
+
+        def view(request):
+            for _ in range(3):
+                User.objects.get(pk=user.pk)
+            list(Ride.objects.filter(user_history=user))
+            return HttpResponse()
+
+        middleware = QueryCountMiddleware(view)
+        with override_settings(INSTRUMENTATION_SAMPLE_RATE=1), \
+                self.assertLogs('smart_rider.instrumentation', 'INFO') as logs:
+            middleware(RequestFactory().get('/probe/'))
+        [record] = logs.records
+        self.assertEqual(record.levelname, 'INFO')
+        line = json.loads(record.getMessage())
+        self.assertEqual({k: line[k] for k in ('kind', 'name', 'method', 'status', 'queries', 'duplicates')},
+                         {'kind': 'http', 'name': '/probe/', 'method': 'GET', 'status': 200,
+                          'queries': 4, 'duplicates': 2})
+        [repeated] = line['repeated']
+        self.assertEqual(repeated['count'], 3)
+        self.assertIn('"custom_user"', repeated['sql'])
+
+    def test_unsampled_request_logs_nothing(self):
+        middleware = QueryCountMiddleware(lambda request: HttpResponse())
+        with self.assertNoLogs('smart_rider.instrumentation'):
+            middleware(RequestFactory().get('/probe/'))
+
+
+class MetricsTests(TestCase):
+    def samples(self, operation):
+        slots = metrics.local_totals().get(('password_hash_duration_seconds', ('pbkdf2_sha256', operation)))
+        return slots[-1] if slots else 0
+
+    def test_password_check_is_one_verify_sample(self):
+        hasher = get_hasher('default')
+        encoded = hasher.encode('pass12345', hasher.salt())
+        encodes, verifies = self.samples('encode'), self.samples('verify')
+        self.assertTrue(check_password('pass12345', encoded))
+        self.assertFalse(hasher.verify('wrong', encoded))
+        self.assertEqual((self.samples('encode'), self.samples('verify')), (encodes, verifies + 2))
+
+    def test_finished_threads_leave_their_counts(self):
+        key = ('otp_delivery_failures_total', ('thread-test',))
+        before = metrics.local_totals().get(key, 0)
+        threads = [threading.Thread(target=metrics.OTP_FAILURES.inc, args=('thread-test',)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        self.assertEqual(metrics.local_totals()[key], before + 5)
+        self.assertFalse(any(thread in metrics._shards for thread in threads))
+
+    def test_files_of_exited_workers_are_folded(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(METRICS_DIR=str(directory)))
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                capture_output=True, text=True).stdout.strip()
+        entries = [['otp_delivery_failures_total', ['file-test'], 3], ['chat_connections_active', [], 2]]
+        for pid in (exited, 1, os.getppid()):
+            (directory / f'{pid}.json').write_text(json.dumps(entries))
+        # init is alive, but its file has not been rewritten for a long time
+        os.utime(directory / '1.json', (0, 0))
+
+        for _ in range(2):
+            totals = metrics.collect()
+            self.assertEqual(totals[('otp_delivery_failures_total', ('file-test',))], 9)
+            self.assertEqual(totals[('chat_connections_active', ())] - metrics.local_totals().get(
+                ('chat_connections_active', ()), 0), 2)
+        self.assertEqual(sorted(path.name for path in directory.glob('*.json')),
+                         sorted([f'{os.getppid()}.json', metrics.EXITED]))
+
+
+class AuthBenchmarkTests(TestCase):
+    def test_failed_sign_up_is_counted_and_ends_the_flow(self):
+        command = bench_auth.Command()
+        command.client = Client()
+        samples = {step: {'timer': benchmarking.Timer(), 'queries': [], 'errors': 0} for step in bench_auth.STEPS}
+        command.run_flow('not an address', samples)
+        command.run_flow(0, samples)
+        self.assertEqual({step: s['errors'] for step, s in samples.items()},
+                         {'register': 1, 'verify-otp': 0, 'login': 0, 'profile': 0, 'change-password': 0})
+        self.assertEqual({step: len(s['timer'].latencies) for step, s in samples.items()},
+                         {'register': 2, 'verify-otp': 1, 'login': 1, 'profile': 1, 'change-password': 1})
+
+    def test_asgi_flow_runs_without_errors(self):
+        # in a child process, the command sets up its own test database; the cache is its own too
+        output = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'auth.json')
+        process = subprocess.run(
+            [sys.executable, 'manage.py', 'bench_auth', '--client', 'asgi', '--users', '2', '--warmup', '0',
+             '--fast-hasher', '--output', output],
+            cwd=settings.BASE_DIR, env={**os.environ, 'CACHE_URL': 'locmemcache://'}, capture_output=True, text=True,
+            timeout=300,
+        )
+        self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+        with open(output) as f:
+            scenarios = json.load(f)['scenarios']
+        self.assertEqual({step: s['errors'] for step, s in scenarios.items()},
+                         dict.fromkeys(('register', 'verify-otp', 'login', 'profile', 'change-password'), 0))
+
+
+class GenerateDataTests(TestCase):
+    def setUp(self):
+        self.store = LocationHistoryStore(self.enterContext(tempfile.TemporaryDirectory()), 3600, 64)
+        self.enterContext(mock.patch('accounts.location_history._store', self.store))
+
+    def generate(self, seed):
+        call_command('generate_data', users=60, messages=300, fixes=3, seed=seed, batch_size=25, stdout=io.StringIO())
+        now = int(time.time())
+        # dates are relative to the run, everything else follows the seed
+        data = (
+            list(User.objects.order_by('pk').values_list(
+                'pk', 'username', 'full_name', 'email_canonical', 'phone_canonical', 'account_type',
+                'is_verified', 'payment_method', 'id_number', 'car_name', 'plate_number', 'password')),
+            list(Vehicle.objects.order_by('pk').values_list(
+                'driver_id', 'vehicle_number', 'vehicle_type', 'seat_capacity', 'mileage')),
+            list(Message.objects.order_by('pk').values_list('sender_id', 'receiver_id', 'message')),
+            {driver: [fix[1:] for fix in self.store.query(driver, now - 3600, now + 3600)]
+             for driver in Vehicle.objects.values_list('driver_id', flat=True)},
+        )
+        Message.objects.all().delete()
+        Vehicle.objects.all().delete()
+        User.objects.all().delete()
+        shutil.rmtree(self.store.root)
+        return data
+
+    def test_same_seed_gives_the_same_data(self):
+        first = self.generate(7)
+        users, vehicles, messages, positions = first
+        self.assertEqual(len(users), 60)
+        self.assertEqual(len(messages), 300)
+        self.assertEqual(len(vehicles), len(positions))
+        self.assertTrue(all(len(trace) == 3 for trace in positions.values()))
+        self.assertEqual(self.generate(7), first)
+        self.assertNotEqual(self.generate(8)[0], users)
+
+    def test_generated_users_can_log_in(self):
+        call_command('generate_data', users=5, messages=0, fixes=0, password='Generated-1', stdout=io.StringIO())
+        user = User.objects.first()
+        self.assertEqual(User.objects.get_by_contact(user.username), user)
+        self.assertTrue(user.check_password('Generated-1'))
+
+
+class StartupImportTests(SimpleTestCase):
+    def test_optional_dependencies_are_imported_on_first_use(self):
+        # a fresh interpreter, this one has imported everything already
+        script = (
+            'import json, sys, django; django.setup(); '
+            'import smart_rider.wsgi, smart_rider.asgi; '
+            'from django.urls import get_resolver; get_resolver().url_patterns; '
+            'print(json.dumps([m for m in ("twilio", "jwt", "pandas", "geopandas", "PIL") if m in sys.modules]))'
+        )
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE}
+        process = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                 capture_output=True, text=True, timeout=120)
+        self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+        self.assertEqual(json.loads(process.stdout.splitlines()[-1]), [])
+
+
+class NearbyDriversTests(SimpleTestCase):
+    def test_nearest_idle_driver_of_the_type_first(self):
+        drivers = {
+            1: {'id': 1, 'lat': 23.81, 'lng': 90.4, 'vehicle_type': 'SEDAN', 'channel_name': 'a'},
+            2: {'id': 2, 'lat': 23.801, 'lng': 90.4, 'vehicle_type': 'SEDAN', 'channel_name': 'b'},
+            3: {'id': 3, 'lat': 23.8, 'lng': 90.4, 'vehicle_type': 'BIKE', 'channel_name': 'c'},
+            4: {'id': 4, 'lat': 24.5, 'lng': 90.4, 'vehicle_type': 'SEDAN', 'channel_name': 'd'},
         }
+        with mock.patch.dict(utils.idle_drivers, clear=True):
+            self.assertEqual(utils.get_nearby_drivers(23.8, 90.4, 'SEDAN')['drivers'], [])
+            utils.idle_drivers.update(drivers)
+            nearby = utils.get_nearby_drivers(23.8, 90.4, 'SEDAN')
+        self.assertEqual([driver['id'] for driver in nearby['drivers']], [2, 1])
+        self.assertEqual(nearby['nearest_driver']['id'], 2)
+        self.assertNotIn('channel_name', nearby['nearest_driver'])
+
 
+@override_settings(GEOCELL_LEVELS=(0.01, 0.04, 0.16))
+class GeocellTests(SimpleTestCase):
+    def offset(self, lat, lng, meters, bearing):
+        bearing = math.radians(bearing)
+        dlat = meters * math.cos(bearing) / geocells.METERS_PER_DEGREE
+        dlng = meters * math.sin(bearing) / (geocells.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        return lat + dlat, lng + dlng
 
-class PaymentSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Payment
-        fields = ['transaction_id', 'amount', 'date', 'status']
+    def test_a_point_sits_in_one_cell_per_level(self):
+        for lat, lng in ((23.8, 90.4), (-33.86, 151.2), (0, 0), (89.99, -179.99)):
+            cells = geocells.cells_for(lat, lng)
+            self.assertEqual([geocells.parse_cell(cell)[0] for cell in cells], [0, 1, 2])
+            for cell in cells:
+                south, west, north, east = geocells.cell_bounds(cell)
+                # 23.8 lies on an edge, which float division may put on either side
+                self.assertTrue(south - 1e-9 <= lat <= north + 1e-9 and west - 1e-9 <= lng <= east + 1e-9,
+                                (lat, lng, cell))
 
+    def test_points_either_side_of_an_edge_are_in_neighbouring_cells(self):
+        cell = geocells.cell_for(23.8, 90.4)
+        level, row, col = geocells.parse_cell(cell)
+        south, west, north, east = geocells.cell_bounds(cell)
+        self.assertEqual(geocells.cell_for(north - 1e-9, west + 1e-9), cell)
+        self.assertEqual(geocells.parse_cell(geocells.cell_for(north + 1e-9, west + 1e-9)), (0, row + 1, col))
+        self.assertEqual(geocells.parse_cell(geocells.cell_for(south - 1e-9, east + 1e-9)), (0, row - 1, col + 1))
 
-class RideSerializer(serializers.ModelSerializer):
-    vehicle = VehicleSerializer()
-    payment = PaymentSerializer()
-    class Meta:
-        model = Ride
-        fields = ["id", "start_destination_lat", "start_destination_lng", "end_destination_lat", "end_destination_lng",
-                  "from_location", "to_location", "price", "state", "otp_verified", "vehicle", "payment", "user_history",
-                  "driver_history", "created_at", ]
+    def test_radius_picks_the_finest_level_at_least_as_wide(self):
+        cases = {100: 0, 1113: 0, 1200: 1, 4450: 1, 4460: 2, 17800: 2, 100000: 2}
+        self.assertEqual({radius: geocells.level_for_radius(radius) for radius in cases}, cases)
 
+    def test_covering_cells_reach_the_whole_circle(self):
+        for lat, lng, radius in ((23.8, 90.4, 500), (23.8, 90.4, 5000), (23.7999, 90.4001, 1200), (60.0, 10.0, 3000)):
+            cells = geocells.cells_covering(lat, lng, radius)
+            level = geocells.level_for_radius(radius)
+            self.assertLessEqual(len(cells), 9)
+            for distance in (0, radius / 2, radius * 0.95):
+                for bearing in range(0, 360, 15):
+                    point = self.offset(lat, lng, distance, bearing)
+                    self.assertLessEqual(geocells.haversine(lat, lng, *point), radius)
+                    self.assertIn(geocells.cell_for(*point, level), cells, (lat, lng, radius, point))
 
-class BookedTripSerializer(serializers.ModelSerializer):
-    vehicle = VehicleSerializer()
-    payment = PaymentSerializer()
-    class Meta:
-        model = BookedTrip
-        fields = ["id", "start_destination_lat", "start_destination_lng", "end_destination_lat", "end_destination_lng",
-                  "from_location", "to_location", "pickup_time", "drop_time", "price", "state", "vehicle", "payment",
-                  "user_history", "driver_history"]
+    def test_neighbours_are_covered_only_when_the_circle_reaches_them(self):
+        cell = geocells.cell_for(23.81, 90.41, 1)
+        _, row, col = geocells.parse_cell(cell)
+        south, west, north, east = geocells.cell_bounds(cell)
+        # 100 m below the north east corner of a 4.4 km cell
+        lat, lng = north - 0.0009, east - 0.0009
+        corner = {f'1_{row + dr}_{col + dc}' for dr in (0, 1) for dc in (0, 1)}
+        self.assertEqual(set(geocells.cells_covering(lat, lng, 1200)), corner)
+        self.assertEqual(geocells.cells_covering(lat - 0.02, lng - 0.02, 1200), [cell])
 
 
-class UserGeneralSerializer(serializers.Serializer):
-    id = serializers.IntegerField()
-    public_id = serializers.UUIDField()
-    email = serializers.EmailField()
-    name = serializers.CharField()
-    username = serializers.CharField()
-    address = serializers.CharField(allow_null=True, allow_blank=True)
-    gender = serializers.CharField()
-    phone = serializers.CharField(allow_null=True, allow_blank=True)
-    dob = serializers.DateField(allow_null=True)
-    account_type = serializers.ChoiceField(choices=User.AccountType.choices)
-    date_joined = serializers.DateTimeField()
-    about = serializers.CharField()
+class TrackingTests(SimpleTestCase):
+    def test_frames_are_12_bytes_at_micro_degree_precision(self):
+        for t, lat, lng in ((1700000000.9, 23.8103, 90.4125), (0, -33.8688197, 151.2092955), (2 ** 32 - 1, -90, 180)):
+            frame = tracking.encode_position(t, lat, lng)
+            self.assertEqual(len(frame), 12)
+            decoded = tracking.decode_position(frame)
+            self.assertEqual(decoded[0], int(t))
+            self.assertAlmostEqual(decoded[1], lat, delta=5e-7)
+            self.assertAlmostEqual(decoded[2], lng, delta=5e-7)
 
+    @override_settings(TRACKING_MIN_MOVE_M=15, TRACKING_HEARTBEAT_S=30)
+    def test_publish_on_first_fix_a_real_move_or_the_heartbeat(self):
+        last = (100, 23.8, 90.4)
+        self.assertTrue(tracking.should_publish(None, 100, 23.8, 90.4))
+        self.assertFalse(tracking.should_publish(last, 129, 23.8001, 90.4))
+        self.assertTrue(tracking.should_publish(last, 101, 23.8002, 90.4))
+        self.assertTrue(tracking.should_publish(last, 130, 23.8, 90.4))
 
-class GeneralResponse(serializers.Serializer):
-    status = serializers.BooleanField()
-    message = serializers.CharField()
 
+class LocationHistoryTests(SimpleTestCase):
+    def setUp(self):
+        self.store = LocationHistoryStore(self.enterContext(tempfile.TemporaryDirectory()), 3600, 64)
 
-@extend_schema_serializer(exclude_fields=['id'])
-class User_UserProfileResponse(UserGeneralSerializer):
-    pass
+    def segment(self, t=0):
+        return self.store.segment_path(1, t - t % 3600)
 
+    def test_a_delta_that_overflows_int16_starts_a_new_block(self):
+        # a 0.04 degree jump and a 10 hour gap do not fit in int16
+        fixes = [(0, 23.8, 90.4), (1, 23.8001, 90.4), (2, 23.8401, 90.4), (3, 23.8402, 90.3999),
+                 (36003, 23.8402, 90.3999)]
+        data = location_history._encode(fixes)
+        self.assertEqual(len(data), 3 * location_history.BLOCK_HEADER.size + 2 * location_history.DELTA_SIZE)
+        block = location_history.BLOCK_HEADER.size + location_history.DELTA_SIZE
+        self.assertEqual([location_history.BLOCK_HEADER.unpack_from(data, offset)[0] for offset in (0, block, 2 * block)],
+                         [2, 2, 1])
+        decoded = list(location_history._decode(data))
+        self.assertEqual([t for t, *_ in decoded], [t for t, *_ in fixes])
+        for (_, lat, lng), (_, want_lat, want_lng) in zip(decoded, fixes):
+            self.assertAlmostEqual(lat, want_lat, places=6)
+            self.assertAlmostEqual(lng, want_lng, places=6)
 
-class UserProfileResponse(GeneralResponse):
-    user = User_UserProfileResponse(allow_null=True, required=False)
+    def test_query_bounds_are_inclusive_across_windows(self):
+        for t in (3599, 3600, 7199, 7200):
+            self.store.record(1, 23.8, 90.4, t)
+        self.store.flush()
+        self.assertEqual(len(list((self.store.root / '1').iterdir())), 3)
+        times = lambda start, end: [t for t, *_ in self.store.query(1, start, end)]
+        self.assertEqual(times(3600, 7199), [3600, 7199])
+        self.assertEqual(times(3599, 3600), [3599, 3600])
+        self.assertEqual(times(0, 10 ** 5), [3599, 3600, 7199, 7200])
+        self.assertEqual(times(7201, 10 ** 5), [])
 
+    def test_batches_arriving_out_of_order_are_sorted(self):
+        self.store.append(1, [(20, 23.8, 90.4), (30, 23.8, 90.4)])
+        self.store.append(1, [(10, 23.8, 90.4)])
+        self.assertEqual([t for t, *_ in self.store.query(1, 0, 100)], [10, 20, 30])
 
-class UserRegisterRequest(serializers.Serializer):
-    email = serializers.EmailField()
-    password = serializers.CharField()
-    name = serializers.CharField(max_length=150)
-    gender = serializers.ChoiceField(choices=User.Gender.choices)
-    phone = serializers.CharField(max_length=20)
-    address = serializers.CharField(max_length=200)
-    account_type = serializers.ChoiceField(choices=User.AccountType.choices)
+    def test_downsample_keeps_the_first_fix_of_each_interval(self):
+        self.store.append(1, [(t, 23.8, 90.4) for t in range(0, 40, 3)])
+        self.assertEqual([t for t, *_ in self.store.query(1, 0, 100, interval=10)], [0, 12, 24, 36])
+        self.assertEqual(len(self.store.query(1, 0, 100, interval=1)), 14)
+
+    def test_a_partial_block_from_a_crash_is_skipped_and_trimmed(self):
+        self.store.append(1, [(0, 23.8, 90.4), (1, 23.8001, 90.4)])
+        whole = self.segment().stat().st_size
+        for cut in (1, 13, 14, 17, 20):
+            with self.subTest(cut=cut):
+                with open(self.segment(), 'ab') as f:
+                    f.write(location_history._encode([(t, 23.8, 90.4) for t in range(5, 8)])[:cut])
+                self.assertEqual([t for t, *_ in self.store.query(1, 0, 100)], [0, 1])
+                self.segment().write_bytes(self.segment().read_bytes()[:whole])
+        with open(self.segment(), 'ab') as f:
+            f.write(b'\x03\x00\x05')
+        # a new process trims the partial block before appending after it
+        store = LocationHistoryStore(self.store.root, 3600, 64)
+        store.append(1, [(9, 23.8, 90.4)])
+        self.assertEqual([t for t, *_ in store.query(1, 0, 100)], [0, 1, 9])
+        self.assertEqual(self.segment().stat().st_size, whole + location_history.BLOCK_HEADER.size)
+
+
+class EstimateGridTests(TestCase):
+    trip = (23.80, 90.40, 23.75, 90.38)
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'grid.bin')
+        estimates._grid = None
+        self.addCleanup(setattr, estimates, '_grid', None)
+
+    def save(self, grid, mtime):
+        grid.save(self.path)
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def test_rewritten_file_is_picked_up_without_restart(self):
+        grid = estimates.build_grid()
+        grid.precompute()
+        self.save(grid, 10 ** 18)
+        with override_settings(ESTIMATE_GRID_PATH=self.path):
+            before = estimates.get_grid().estimate(*self.trip)
+            self.assertIs(estimates.get_grid(), estimates.get_grid())
+            for i in range(len(grid.durations)):
+                grid.durations[i] *= 2
+            self.save(grid, 2 * 10 ** 18)
+            after = estimates.get_grid().estimate(*self.trip)
+        self.assertAlmostEqual(after[0], 2 * before[0], delta=2)
+        self.assertEqual(after[1], before[1])
+
+    def test_truncated_file_falls_back_to_live_tables(self):
+        live = estimates.build_grid()
+        live.precompute()
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 1000)
+        with override_settings(ESTIMATE_GRID_PATH=self.path), self.assertLogs('accounts.estimates', 'WARNING'):
+            self.assertEqual(estimates.get_grid().estimate(*self.trip), live.estimate(*self.trip))
+        with self.assertRaisesMessage(ValueError, '1000 bytes'):
+            estimates.build_grid().load(self.path)
+
+    def test_points_outside_the_service_area_have_no_estimate(self):
+        with override_settings(ESTIMATE_GRID_PATH=None):
+            grid = estimates.get_grid()
+        self.assertIsNone(grid.estimate(22.35, 91.78, 23.75, 90.38))
+        duration, distance = grid.estimate(*self.trip)
+        self.assertGreater(distance, 0)
+        self.assertAlmostEqual(duration, distance / estimates.AVERAGE_SPEED_MPS, delta=1)
+
+
+class SurgeHeatmapTests(TestCase):
+    point = (23.8, 90.4)
+
+    def setUp(self):
+        # two processes: a web worker counting requests, a consumer process counting drivers
+        self.cache = LocMemCache(f'surge-{self.id()}', {})
+        self.web = SurgeHeatmap(self.cache, window=300, buckets=30)
+        self.sockets = SurgeHeatmap(self.cache, window=300, buckets=30)
+        self.cell = self.web.cell_for(*self.point)
+
+    def drive(self, cell, start, stop, mark=None):
+        # an idle driver sending a fix every 5 seconds, as a consumer reports it
+        for t in range(start, stop, 5):
+            current = self.sockets.presence(cell, t)
+            self.sockets.driver_present(mark, current, t)
+            mark = current
+        return mark
+
+    def test_processes_share_one_window(self):
+        now = 1000000
+        self.drive(self.cell, now, now + 1)
+        for _ in range(3):
+            self.web.record_request(*self.point, now=now)
+        # one idle driver for the last of 30 buckets, three requests
+        self.assertEqual(self.web.surge_at(*self.point, now=now), 2.0)
+        self.assertEqual(self.sockets.surge_at(*self.point, now=now), 2.0)
+        [cell] = self.sockets.snapshot(now=now)
+        self.assertEqual((cell['cell'], cell['idle_drivers'], cell['demand']), (self.cell, 1, 3))
+
+    def test_supply_is_averaged_over_the_window(self):
+        now = 1000000
+        self.drive(self.cell, now, now + 300)
+        mark = self.drive(self.cell, now + 150, now + 200)
+        self.sockets.driver_present(mark, None, now + 200)
+        [cell] = self.web.snapshot(now=now + 299)
+        # 1 driver for 30 buckets, a second for the 5 it left in
+        self.assertEqual(cell['supply'], round((30 + 5) / 30, 2))
+        self.assertEqual(cell['idle_drivers'], 1)
+
+    def test_a_driver_that_leaves_mid_bucket_is_not_counted_in_it(self):
+        now = 1000000
+        other = self.web.cell_for(23.9, 90.4)
+        mark = self.drive(self.cell, now, now + 5)
+        mark = self.drive(other, now + 5, now + 10, mark)
+        self.assertEqual({cell['cell']: cell['idle_drivers'] for cell in self.web.snapshot(now=now + 9)}, {other: 1})
+        self.sockets.driver_present(mark, None, now + 9)
+        self.assertEqual(self.web.snapshot(now=now + 9), [])
+
+    def test_drivers_of_a_dead_process_expire_with_the_window(self):
+        now = 1000000
+        # never reported gone, the process died
+        self.drive(self.cell, now, now + 60)
+        self.assertEqual(self.web.snapshot(now=now + 60)[0]['idle_drivers'], 1)
+        self.assertEqual(self.web.snapshot(now=now + 80)[0]['idle_drivers'], 0)
+        self.assertEqual(self.web.snapshot(now=now + 360), [])
+        self.web.record_request(*self.point, now=now + 360)
+        self.web.record_request(*self.point, now=now + 360)
+        self.assertEqual(self.web.surge_at(*self.point, now=now + 360), 1.5)
+
+    def test_requests_leave_the_window(self):
+        now = 1000000
+        for _ in range(4):
+            self.web.record_request(*self.point, now=now)
+        self.assertEqual(self.web.surge_at(*self.point, now=now + 10), 2.5)
+        self.assertEqual(self.web.surge_at(*self.point, now=now + 310), 1.0)
+        self.assertEqual(self.web.snapshot(now=now + 310), [])
+
+
+class ZoneIndexTests(TestCase):
+    # an L-shaped service area, so the raster has a concave corner to get wrong
+    AREA = [[23.70, 90.33], [23.70, 90.50], [23.80, 90.50], [23.80, 90.42], [23.90, 90.42], [23.90, 90.33]]
+    AIRPORT = [[23.84, 90.39], [23.84, 90.41], [23.86, 90.41], [23.86, 90.39]]
+
+    def setUp(self):
+        zones._index = None
+        self.addCleanup(setattr, zones, '_index', None)
+        self.area = ServiceZone.objects.create(name='Dhaka', polygon=self.AREA)
+        self.airport = ServiceZone.objects.create(name='Airport', kind=ServiceZone.Kind.NO_PICKUP,
+                                                  polygon=self.AIRPORT)
+
+    def test_raster_agrees_with_point_in_polygon(self):
+        index = zones.get_zone_index()
+        rng = random.Random(1)
+        for _ in range(5000):
+            lat, lng = rng.uniform(23.65, 23.95), rng.uniform(90.30, 90.55)
+            expected = {zone.id for zone in (self.area, self.airport)
+                        if zones.point_in_polygon(lat, lng, zone.polygon)}
+            self.assertEqual({zone.id for zone in index.zones_at(lat, lng)}, expected, (lat, lng))
+
+    def test_pickup_errors(self):
+        index = zones.get_zone_index()
+        self.assertIsNone(index.pickup_error(23.75, 90.45))
+        self.assertEqual(index.pickup_error(23.85, 90.45), 'Pickup is outside the service area')
+        self.assertEqual(index.pickup_error(23.85, 90.40), 'Pickup is not allowed in Airport')
+        self.assertFalse(index.in_service_area(23.85, 90.45))
+        self.assertTrue(index.in_service_area(23.85, 90.40))
+
+    def test_ride_request_outside_the_area_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(email='zone@example.com', password='!'))
+        response = client.post(reverse('ride-request'), {'lat': 23.85, 'lng': 90.45, 'vehicle_type': 'SEDAN'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Pickup is outside the service area'})
+
+    @override_settings(ZONE_RELOAD_INTERVAL_S=0)
+    def test_index_is_rebuilt_when_zones_change(self):
+        index = zones.get_zone_index()
+        with self.assertNumQueries(1):
+            self.assertIs(zones.get_zone_index(), index)
+        self.airport.is_active = False
+        self.airport.save()
+        rebuilt = zones.get_zone_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertIsNone(rebuilt.pickup_error(23.85, 90.40))
+
+
+@unittest.skipUnless(connections['default'].vendor == 'sqlite', 'copies the SQLite test database')
+class ReplicaRoutingTests(TransactionTestCase):
+    # The replica is a second SQLite file copied from default and then left
+    # behind, so which database answered shows in the data; it is query_only,
+    # so a write routed to it fails. It is added once the test case validated
+    # its databases, and as a test mirror it is never flushed.
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite3')
+        default = connections['default'].settings_dict
+        connections.settings[REPLICA] = {
+            **default, 'NAME': cls.path, 'OPTIONS': {'init_command': 'PRAGMA query_only=ON;'},
+            'TEST': {**default['TEST'], 'MIRROR': 'default'},
+        }
+        cls.databases = {'default', REPLICA}
 
+    @classmethod
+    def tearDownClass(cls):
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        cls.databases = {'default'}
+        super().tearDownClass()
 
-class Context_UserRegisterResponse(serializers.Serializer):
-    email = serializers.EmailField()
-    name = serializers.CharField()
-    gender = serializers.CharField()
-    phone = serializers.CharField()
-    address = serializers.CharField()
-    account_type = serializers.ChoiceField(choices=User.AccountType.choices)
+    def setUp(self):
+        self.user = User.objects.create_user(email='replica@example.com', password='!', full_name='On replica')
+        connections[REPLICA].close()
+        connections['default'].ensure_connection()
+        copy = sqlite3.connect(self.path)
+        connections['default'].connection.backup(copy)
+        copy.close()
+        User.objects.filter(pk=self.user.pk).update(full_name='On default')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
 
+    def test_reads_in_replica_views_use_the_replica(self):
+        with CaptureQueriesContext(connections['default']) as primary:
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.data['full_name'], 'On replica')
+        self.assertEqual(len(primary), 0)
+        # the flag does not outlive the request
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertEqual(User.objects.get(pk=self.user.pk).full_name, 'On default')
 
-class UserRegisterResponse(GeneralResponse):
-    context = Context_UserRegisterResponse(allow_null=True, required=False)
+    def test_writes_and_their_reads_stay_on_default(self):
+        with CaptureQueriesContext(connections[REPLICA]) as replica:
+            response = self.client.patch(reverse('profile'), {'full_name': 'Renamed'})
+            self.assertEqual(response.data['user']['full_name'], 'Renamed')
+            response = self.client.post(reverse('message-list', args=[self.user.id]), {'message': 'Hi'})
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(replica), 0)
+        self.assertEqual(User.objects.get(pk=self.user.pk).full_name, 'Renamed')
 
+    def test_flag_resets_after_an_error(self):
+        with self.assertRaises(ZeroDivisionError), use_replica():
+            self.assertEqual(router.db_for_read(User), REPLICA)
+            1 / 0
+        self.assertEqual(router.db_for_read(User), 'default')
 
-class UserLoginRequest(serializers.Serializer):
-    email = serializers.EmailField()
-    password = serializers.CharField()
 
+class TwoTierCacheTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.enterContext(override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'smart_rider.cache.FileBasedCache', 'LOCATION': self.location},
+        }))
 
-class UserLoginResponse(GeneralResponse):
-    access_token = serializers.CharField(allow_null=True, required=False)
-    refresh_token = serializers.CharField(allow_null=True, required=False)
-    csrf_token = serializers.CharField(allow_null=True, required=False)
-    user = UserGeneralSerializer(allow_null=True, required=False)
+    def tier(self):
+        # one per worker process, all over the same shared directory
+        return TwoTierCache('', {'OPTIONS': {'SHARED': 'shared', 'POLL_INTERVAL': 0}})
 
+    def test_tiers_see_each_others_invalidation(self):
+        a, b = self.tier(), self.tier()
+        a.set('fare', 100)
+        self.assertEqual(b.get('fare'), 100)
+        self.assertEqual(b.get('fare'), 100)
+        a.set('fare', 120)
+        self.assertEqual(b.get('fare'), 120)
+        b.delete('fare')
+        self.assertIsNone(a.get('fare'))
+        self.assertEqual(b.get_stats()['l1_hits'], 1)
+        self.assertEqual(b.get_stats()['invalidations'], 1)
 
-class RefreshTokenResponse(GeneralResponse):
-    access_token = serializers.CharField(required=False, allow_null=True)
+    def test_concurrent_publishers_get_distinct_sequence_numbers(self):
+        seqs = []
 
+        def publish():
+            bus = CacheLogBus(caches['shared'])
+            seqs.extend(bus.publish(f'key{i}') for i in range(25))
+        threads = [threading.Thread(target=publish) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(seqs), list(range(1, 201)))
 
-class UserUpdateRequest(serializers.Serializer):
-    email = serializers.EmailField(required=False)
-    name = serializers.CharField(required=False)
-    username = serializers.CharField(required=False)
-    dob = serializers.DateField(required=False)
-    about = serializers.CharField(required=False)
-    gender = serializers.CharField(required=False)
-    phone = serializers.CharField(required=False)
-    address = serializers.CharField(required=False)
+    def test_incr_keeps_the_expiry(self):
+        shared = caches['shared']
+        shared.set('counter', 1, None)
+        shared.set('short', 1, 60)
+        self.assertEqual(shared.incr('counter', 2), 3)
+        self.assertEqual(shared.incr('short'), 2)
+        with open(shared._key_to_file('counter'), 'rb') as f:
+            self.assertIsNone(pickle.load(f))
+        with open(shared._key_to_file('short'), 'rb') as f:
+            self.assertLess(pickle.load(f), time.time() + 61)
+        with self.assertRaises(ValueError):
+            shared.incr('missing')
 
+    def test_backends_without_atomic_incr_are_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            CacheLogBus(FileBasedCache(self.location, {}))
+        CacheLogBus(LocMemCache('bus', {}))
 
-class UserUpdateResponse(GeneralResponse):
-    context = UserUpdateRequest(required=False, allow_null=True)
+    def test_own_publications_are_bounded_without_polling(self):
+        tier = self.tier()
+        tier.bus.size = 5
+        for i in range(100):
+            tier.set(f'key{i}', i)
+        self.assertLessEqual(len(tier._published), 10)
 
 
-class UserUpdatePasswordRequest(serializers.Serializer):
-    new_password = serializers.CharField()
-    old_password = serializers.CharField()
+class ConditionalProfileTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='etag@example.com', password='!', full_name='Etag')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
 
+    def test_unchanged_profile_is_not_sent_again(self):
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Authorization', response['Vary'])
+        etag = response['ETag']
+        response = self.client.get(reverse('profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(reverse('profile'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
 
-class UserForgetPasswordRequest(serializers.Serializer):
-    email = serializers.CharField()
-    password = serializers.CharField()
-    skey = serializers.CharField()
+    def test_etag_changes_after_an_update(self):
+        etag = self.client.get(reverse('profile'))['ETag']
+        self.client.patch(reverse('profile'), {'full_name': 'Renamed'})
+        response = self.client.get(reverse('profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['full_name'], 'Renamed')
@@ -0,0 +1,38 @@
+import struct
+
+from django.conf import settings
+
+from .geocells import haversine
+
+# ts (uint32 seconds), lat and lng (int32, 1e-6 degrees): 12 bytes per update
+FRAME = struct.Struct('<Iii')
+
+
+def group_name(driver_id):
+    return f'track.{driver_id}'
+
+
+def rider_group(rider_id):
+    return f'rider.{rider_id}'
+
+
+def assignment_key(rider_id):
+    return f'trip_driver_{rider_id}'
+
+
+def encode_position(t, lat, lng):
+    return FRAME.pack(int(t), round(lat * 1000000), round(lng * 1000000))
+
+
+def decode_position(frame):
+    t, lat, lng = FRAME.unpack(frame)
+    return t, lat / 1000000, lng / 1000000
+
+
+def should_publish(last, t, lat, lng):
+    # last: (t, lat, lng) of the previously published update or None
+    if last is None:
+        return True
+    if t - last[0] >= getattr(settings, 'TRACKING_HEARTBEAT_S', 30):
+        return True
+    return haversine(last[1], last[2], lat, lng) >= getattr(settings, 'TRACKING_MIN_MOVE_M', 15)
@@ -2,15 +2,22 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('register/', views.UserRegistrationView.as_view()), #done
-    path('verify-otp/', views.VerifyOTPView.as_view()), #phone verify not working
-    path('login/', views.UserLoginView.as_view()), #done
-    path('change-password/', views.ChangePasswordView.as_view()), #not working 
-    path('forgot-password/', views.ForgotPasswordView.as_view()), #error
-    path('reset-password/', views.ResetPasswordView.as_view()), #done
-    path('profile/', views.UserProfileView.as_view()),#done
-    path('delete-account/', views.DeleteAccountView.as_view()), #error
-    path('confirm-delete/', views.ConfirmDeleteView.as_view()), #NOT WORKING
+    path('register/', views.UserRegistrationView.as_view(), name='register'), #done
+    path('verify-otp/', views.VerifyOTPView.as_view(), name='verify-otp'), #phone verify not working
+    path('login/', views.UserLoginView.as_view(), name='login'), #done
+    path('change-password/', views.ChangePasswordView.as_view(), name='change-password'), #not working 
+    path('forgot-password/', views.ForgotPasswordView.as_view(), name='forgot-password'), #error
+    path('reset-password/', views.ResetPasswordView.as_view(), name='reset-password'), #done
+    path('profile/', views.UserProfileView.as_view(), name='profile'),#done
+    path('delete-account/', views.DeleteAccountView.as_view(), name='delete-account'), #error
+    path('confirm-delete/', views.ConfirmDeleteView.as_view(), name='confirm-delete'), #NOT WORKING
+    path('ride-request/', views.RideRequestView.as_view(), name='ride-request'),
+    path('fare-estimate/', views.FareEstimateView.as_view(), name='fare-estimate'),
+    path('drivers/<int:driver_id>/history/', views.DriverLocationHistoryView.as_view(), name='driver-location-history'),
+    path('heatmap/', views.SurgeHeatmapView.as_view(), name='surge-heatmap'),
+    path('locations/', views.TripLocationsListView.as_view(), name='trip-locations'),
+    path('rides/history/', views.RideHistoryView.as_view(), name='ride-history'),
+    path('booked-trips/history/', views.BookedTripHistoryView.as_view(), name='booked-trip-history'),
     
 ]
 
@@ -1,9 +1,14 @@
 from rest_framework.views import exception_handler
 from datetime import datetime, timedelta
-import jwt
 from django.conf import settings
 import math
 
+from .geocells import haversine
+
+# driver id -> last reported position, maintained by contract_app.consumers.DriverConsumer
+idle_drivers = {}
+NEARBY_RADIUS_M = 3845.885 * 3
+
 
 def generate_access_token(user):
 
@@ -12,6 +17,7 @@ def generate_access_token(user):
         'exp': datetime.utcnow() + timedelta(days=1),
         'iat': datetime.utcnow()
     }
+    import jwt
     access_token = jwt.encode(access_token_payload, settings.SECRET_KEY, algorithm='HS256').decode('utf-8')
     if access_token in blackListedTokens:
         blackListedTokens.discard(access_token)
@@ -24,6 +30,7 @@ def generate_refresh_token(user):
         'exp': datetime.utcnow() + timedelta(days=7),
         'iat': datetime.utcnow()
     }
+    import jwt
     refresh_token = jwt.encode(refresh_token_payload, settings.REFRESH_SECRET_KEY, algorithm='HS256').decode('utf-8')
     if refresh_token in blackListedTokens:
         blackListedTokens.discard(refresh_token)
@@ -44,41 +51,27 @@ def custom_exception_handler(exc, context):
     return response
 
 
-def get_nearby_drivers(lat, lng, vehicle_type):
-    cust_cords = [{'lat': lat, 'lng': lng}]
-    driver_cords = [v for v in idle_drivers.values()]
-    print(idle_drivers)
-    print(driver_cords)
+def get_nearby_drivers(lat, lng, vehicle_type, radius_m=NEARBY_RADIUS_M):
+    # idle drivers of the type within radius_m, nearest first
     if len(idle_drivers) == 0:
         return {
             'drivers': [],
             'message': 'currently, no drivers are idle'
         }
-    driver_df = pd.DataFrame(driver_cords)
-    cust_df = pd.DataFrame(cust_cords)
-    driver_df = driver_df[driver_df['vehicle_type'] == vehicle_type]
-    driver_gdf = gpd.GeoDataFrame(driver_df, geometry=gpd.points_from_xy(driver_df['lat'], driver_df['lng']), crs="EPSG:4326")
-    cust_gdf = gpd.GeoDataFrame(cust_df, geometry=gpd.points_from_xy(cust_df['lat'], cust_df['lng']), crs="EPSG:4326")
-    driver_gdf_proj = driver_gdf.to_crs("EPSG:3857")
-    cust_gdf_proj = cust_gdf.to_crs("EPSG:3857")
-    x = cust_gdf_proj.buffer(3845.885 * 3).unary_union
-    neighbours1 = driver_gdf_proj['geometry'].intersection(x)
-    nearby_drivers = driver_gdf_proj[~neighbours1.is_empty]
-    nearby_drivers.drop('geometry', axis=1, inplace=True)
-    nearby_drivers.drop('channel_name', axis=1, inplace=True)
-    #distances = [geopy.distance.distance([lat, lng], [point['lat'], point['lng']]).meters for point in nearby_drivers.to_dict('records')]
-    distances = {k: v for k, v in enumerate(distances)}
-    distances = dict(sorted(distances.items(), key=lambda item: item[1]))
-    if len(list(distances.keys())) > 0:
-        return {
-            'drivers': nearby_drivers.to_dict('records'),
-            'nearest_driver': nearby_drivers.to_dict('records')[list(distances.keys())[0]]
-        }
+    nearby_drivers = []
+    for driver in list(idle_drivers.values()):
+        if driver['vehicle_type'] != vehicle_type:
+            continue
+        distance = haversine(lat, lng, driver['lat'], driver['lng'])
+        if distance <= radius_m:
+            nearby = {k: v for k, v in driver.items() if k != 'channel_name'}
+            nearby['distance_m'] = round(distance, 1)
+            nearby_drivers.append(nearby)
+    nearby_drivers.sort(key=lambda driver: driver['distance_m'])
     return {
-        'drivers': nearby_drivers.to_dict('records'),
-        'nearest_driver': None
+        'drivers': nearby_drivers,
+        'nearest_driver': nearby_drivers[0] if nearby_drivers else None
     }
 
-
 def float_formatter(number, decimals=6):
     return round(number, decimals)
@@ -1,4 +1,7 @@
-from rest_framework import status, permissions
+import time
+
+from rest_framework import generics, status, permissions
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
@@ -6,27 +9,38 @@ from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
 from django.conf import settings
 from django.core.cache import cache
-from django.utils import timezone
-from twilio.rest import Client
-import requests
+from asgiref.sync import async_to_sync
+from smart_rider.db_router import ReplicaReadMixin
+from smart_rider.conditional import conditional_get
+from smart_rider import metrics
 
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer, ChangePasswordSerializer,
     ForgotPasswordSerializer, ResetPasswordSerializer, SendOTPSerializer,
-    VerifyOTPSerializer, DeleteAccountSerializer, UserSerializer
+    VerifyOTPSerializer, DeleteAccountSerializer, UserSerializer,
+    RideRequestSerializer, FareEstimateSerializer, LocationHistoryQuerySerializer,
+    TripLocationsSerializer, RideSerializer, BookedTripSerializer
 )
+from .geocells import publish_ride_offer
+from .estimates import estimate_trip
+from .location_history import get_store
+from .surge import get_heatmap
+from .zones import get_zone_index
+from .purge import request_purge
+from . import tracking
+from .models import TripLocations, Ride, BookedTrip
 
 User = get_user_model()
 
 def get_user_by_identifier(identifier):
-    if '@' in identifier:
-        return User.objects.filter(email=identifier).first()
-    else:
-        return User.objects.filter(phone=identifier).first()
+    return User.objects.get_by_contact(identifier)
 
 def send_otp_verification(user, purpose='general'):
     otp = user.otp_code
     if user.phone:
+        # imported on first use, twilio pulls in requests and is only needed for phone accounts
+        from twilio.rest import Client
+        start = time.perf_counter()
         try:
             client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
             message = f"Your OTP: {otp}. Expires in 10 mins."
@@ -41,8 +55,12 @@ def send_otp_verification(user, purpose='general'):
             )
             return True, "SMS sent"
         except Exception as e:
+            metrics.OTP_FAILURES.inc('twilio')
             return False, str(e)
+        finally:
+            metrics.OTP_LATENCY.observe(time.perf_counter() - start, 'twilio')
     elif user.email:
+        start = time.perf_counter()
         try:
             subject = "Your OTP - Riding App"
             message = f"Your OTP: {otp}. Expires in 10 mins."
@@ -53,7 +71,10 @@ def send_otp_verification(user, purpose='general'):
             send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email])
             return True, "Email sent"
         except Exception as e:
+            metrics.OTP_FAILURES.inc('email')
             return False, str(e)
+        finally:
+            metrics.OTP_LATENCY.observe(time.perf_counter() - start, 'email')
     return False, "No contact"
 
 
@@ -63,9 +84,8 @@ class UserRegistrationView(APIView):
     def post(self, request):
         serializer = UserRegistrationSerializer(data=request.data)
         if serializer.is_valid():
+            # the user is inserted with its OTP already set, no follow-up writes
             user = serializer.save()
-            user.generate_otp()
-            user.save()
 
             send_otp_verification(user)
             print(f"OTP: {user.otp_code}")  
@@ -84,15 +104,9 @@ class VerifyOTPView(APIView):
     def post(self, request):
         serializer = VerifyOTPSerializer(data=request.data)
         if serializer.is_valid():
-            contact = serializer.validated_data['contact']
-            otp = serializer.validated_data['otp']
-            user = get_user_by_identifier(contact)
-            if not user or not user.verify_otp(otp):
-                return Response({'error': 'Invalid OTP'}, status=status.HTTP_400_BAD_REQUEST)
-
-            user.is_verified = True
+            # the serializer already looked the user up and checked the OTP
+            user = serializer.validated_data['user']
             user.clear_otp()
-            user.save()
 
             refresh = RefreshToken.for_user(user)
             return Response({
@@ -103,12 +117,6 @@ class VerifyOTPView(APIView):
             }, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-def get_user_by_identifier(identifier):
-    if '@' in identifier:
-        return User.objects.filter(email=identifier).first()
-    else:
-        return User.objects.filter(phone=identifier).first()
-
 class UserLoginView(APIView):
     permission_classes = [permissions.AllowAny]
 
@@ -132,9 +140,9 @@ class ChangePasswordView(APIView):
     def post(self, request):
         serializer = ChangePasswordSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            user = serializer.save()
-            user.last_password_change = timezone.now()
-            user.save()
+            user = request.user
+            user.set_password(serializer.validated_data['new_password'])
+            user.save(update_fields=['password', 'updated_at'])
             return Response({'message': 'Password changed'}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -145,13 +153,8 @@ class ForgotPasswordView(APIView):
     def post(self, request):
         serializer = ForgotPasswordSerializer(data=request.data)
         if serializer.is_valid():
-            contact = serializer.validated_data['contact']
-            user = get_user_by_identifier(contact)
-            if not user:
-                return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
-
+            user = serializer.context['user']
             user.generate_otp()
-            user.save()
             send_otp_verification(user, 'password_reset')
             return Response({
                 'message': 'OTP sent for reset',
@@ -174,17 +177,22 @@ class ResetPasswordView(APIView):
                 return Response({'error': 'Invalid OTP'}, status=status.HTTP_400_BAD_REQUEST)
 
             user.set_password(password)
-            user.clear_otp()
-            user.save()
+            user.clear_otp('password')
             return Response({'message': 'Password reset'}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserProfileView(APIView):
+class UserProfileView(ReplicaReadMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
-        return Response(UserSerializer(request.user).data)
+        user = request.user
+        return conditional_get(
+            request,
+            etag=f'user-{user.id}-{user.updated_at.timestamp()}',
+            last_modified=user.updated_at,
+            build=lambda: Response(UserSerializer(user).data)
+        )
 
     def patch(self, request):
         serializer = UserSerializer(request.user, data=request.data, partial=True)
@@ -200,7 +208,6 @@ class DeleteAccountView(APIView):
     def post(self, request):
         user = request.user
         user.generate_otp()
-        user.save()
         cache.set(f'delete_{user.id}', True, 600)
         send_otp_verification(user, 'deletion')
         return Response({
@@ -218,6 +225,123 @@ class ConfirmDeleteView(APIView):
         if not user.verify_otp(otp):
             return Response({'error': 'Invalid OTP'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user.delete()
+        request_purge(user)
         cache.delete(f'delete_{user.id}')
-        return Response({'message': 'Account deleted'})  
\ No newline at end of file
+        return Response({'message': 'Account deleted'}, status=status.HTTP_202_ACCEPTED)
+
+
+class RideRequestView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = RideRequestSerializer(data=request.data)
+        if serializer.is_valid():
+            data = serializer.validated_data
+            zones = get_zone_index()
+            error = zones.pickup_error(data['lat'], data['lng'])
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+            offer = {
+                'rider_id': request.user.id,
+                'rider_name': request.user.full_name,
+                'lat': data['lat'],
+                'lng': data['lng'],
+                'vehicle_type': data['vehicle_type'],
+                'pickup_zones': [zone.name for zone in zones.zones_at(data['lat'], data['lng'])]
+            }
+            get_heatmap().record_request(data['lat'], data['lng'])
+            # a new request ends the previous trip, the first driver to accept gets this one
+            cache.delete(tracking.assignment_key(request.user.id))
+            cells = async_to_sync(publish_ride_offer)(data['lat'], data['lng'], data['vehicle_type'], offer)
+            return Response({'message': 'Ride offered', 'cells': len(cells)}, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class FareEstimateView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = FareEstimateSerializer(data=request.data)
+        if serializer.is_valid():
+            data = serializer.validated_data
+            zones = get_zone_index()
+            error = zones.pickup_error(data['pickup_lat'], data['pickup_lng'])
+            if not error and not zones.in_service_area(data['drop_lat'], data['drop_lng']):
+                error = 'Drop-off is outside the service area'
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+            estimate = estimate_trip(
+                data['pickup_lat'], data['pickup_lng'],
+                data['drop_lat'], data['drop_lng'],
+                data['vehicle_type']
+            )
+            if estimate is None:
+                return Response({'error': 'Outside service area'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(estimate, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class DriverLocationHistoryView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, driver_id):
+        if not request.user.is_staff and request.user.id != driver_id:
+            return Response({'error': 'Not allowed'}, status=status.HTTP_403_FORBIDDEN)
+        serializer = LocationHistoryQuerySerializer(data=request.query_params)
+        if serializer.is_valid():
+            data = serializer.validated_data
+            points = get_store().query(driver_id, data['start'], data['end'], data.get('interval'))
+            return Response({
+                'driver_id': driver_id,
+                'points': [{'t': t, 'lat': lat, 'lng': lng} for t, lat, lng in points]
+            })
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SurgeHeatmapView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        return Response({'cells': get_heatmap().snapshot()})
+
+
+class TripLocationsPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class TripLocationsListView(ReplicaReadMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    queryset = TripLocations.objects.order_by('name', 'id')
+    serializer_class = TripLocationsSerializer
+    pagination_class = TripLocationsPagination
+
+
+class HistoryPagination(CursorPagination):
+    # keyset pages: WHERE created_at < cursor, no COUNT and no OFFSET scans
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class TripHistoryView(ReplicaReadMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = HistoryPagination
+    model = None
+
+    def get_queryset(self):
+        user = self.request.user
+        owner = 'driver_history' if user.account_type == User.AccountType.DRIVER else 'user_history'
+        return self.model.objects.filter(**{owner: user}).select_related('vehicle', 'payment')
+
+
+class RideHistoryView(TripHistoryView):
+    model = Ride
+    serializer_class = RideSerializer
+
+
+class BookedTripHistoryView(TripHistoryView):
+    model = BookedTrip
+    serializer_class = BookedTripSerializer
@@ -0,0 +1,146 @@
+import math
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import ServiceZone
+
+INSIDE = 1
+BOUNDARY = 2
+# grid origin, cells are counted from the south-west corner of the map
+SOUTH = -90.0
+WEST = -180.0
+
+
+def point_in_polygon(lat, lng, polygon):
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            cross = lng_i + (lat - lat_i) * (lng_j - lng_i) / (lat_j - lat_i)
+            if lng < cross:
+                inside = not inside
+        j = i
+    return inside
+
+
+def _segment_cells(a, b, size):
+    # cells the segment a-b passes through: sample every 1/8 cell and also take
+    # the neighbour whenever a sample lies within 1/8 cell of a cell edge
+    steps = max(1, int(math.ceil(max(abs(b[0] - a[0]), abs(b[1] - a[1])) * 8 / size)))
+    cells = set()
+    for k in range(steps + 1):
+        y = (a[0] + (b[0] - a[0]) * k / steps - SOUTH) / size
+        x = (a[1] + (b[1] - a[1]) * k / steps - WEST) / size
+        row, col = int(y // 1), int(x // 1)
+        rows = [row] + ([row - 1] if y - row < 0.125 else []) + ([row + 1] if y - row > 0.875 else [])
+        cols = [col] + ([col - 1] if x - col < 0.125 else []) + ([col + 1] if x - col > 0.875 else [])
+        for r in rows:
+            for c in cols:
+                cells.add((r, c))
+    return cells
+
+
+class ZoneIndex:
+    # Zones are rasterized onto a grid: cells fully inside a zone answer from the
+    # dict alone, cells missing from it are outside, and only cells crossed by a
+    # zone edge fall back to an exact point-in-polygon test.
+    def __init__(self, zones, cell_size, version=None):
+        self.cell_size = cell_size
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.zones = {}
+        self.cells = {}
+        self.has_service_area = False
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        polygon = [(float(lat), float(lng)) for lat, lng in zone.polygon]
+        self.zones[zone.id] = (zone, polygon)
+        if zone.kind == ServiceZone.Kind.SERVICE_AREA:
+            self.has_service_area = True
+
+        size = self.cell_size
+        boundary = set()
+        for i in range(len(polygon)):
+            boundary |= _segment_cells(polygon[i - 1], polygon[i], size)
+
+        lats = [p[0] for p in polygon]
+        row_min = int((min(lats) - SOUTH) // size)
+        row_max = int((max(lats) - SOUTH) // size)
+        for row in range(row_min, row_max + 1):
+            # scanline through the row's center, fill cells between crossings
+            lat = SOUTH + (row + 0.5) * size
+            crossings = []
+            for i in range(len(polygon)):
+                lat_a, lng_a = polygon[i - 1]
+                lat_b, lng_b = polygon[i]
+                if (lat_a > lat) != (lat_b > lat):
+                    crossings.append(lng_a + (lat - lat_a) * (lng_b - lng_a) / (lat_b - lat_a))
+            crossings.sort()
+            for start, end in zip(crossings[::2], crossings[1::2]):
+                col_start = int((start - WEST) // size)
+                col_end = int((end - WEST) // size)
+                for col in range(col_start, col_end + 1):
+                    cell = (row, col)
+                    if cell not in boundary and start <= WEST + (col + 0.5) * size <= end:
+                        self.cells.setdefault(cell, []).append((zone.id, INSIDE))
+        for cell in boundary:
+            self.cells.setdefault(cell, []).append((zone.id, BOUNDARY))
+
+    def zones_at(self, lat, lng):
+        cell = (int((lat - SOUTH) // self.cell_size), int((lng - WEST) // self.cell_size))
+        found = []
+        for zone_id, state in self.cells.get(cell, ()):
+            zone, polygon = self.zones[zone_id]
+            if state == INSIDE or point_in_polygon(lat, lng, polygon):
+                found.append(zone)
+        return found
+
+    def in_service_area(self, lat, lng):
+        if not self.has_service_area:
+            return True
+        return any(zone.kind == ServiceZone.Kind.SERVICE_AREA for zone in self.zones_at(lat, lng))
+
+    def pickup_error(self, lat, lng):
+        zones = self.zones_at(lat, lng)
+        if self.has_service_area and not any(z.kind == ServiceZone.Kind.SERVICE_AREA for z in zones):
+            return "Pickup is outside the service area"
+        for zone in zones:
+            if zone.kind == ServiceZone.Kind.NO_PICKUP:
+                return f"Pickup is not allowed in {zone.name}"
+        return None
+
+    def is_stale(self):
+        interval = getattr(settings, 'ZONE_RELOAD_INTERVAL_S', 30)
+        return time.monotonic() - self.checked_at > interval
+
+
+_index = None
+
+
+def zones_version():
+    stats = ServiceZone.objects.filter(is_active=True).aggregate(count=Count('id'), updated=Max('updated_at'))
+    return stats['count'], stats['updated']
+
+
+def cached_index():
+    return _index
+
+
+def get_zone_index():
+    # rebuilt whenever active zones change, checked at most every ZONE_RELOAD_INTERVAL_S
+    global _index
+    if _index is not None and not _index.is_stale():
+        return _index
+    version = zones_version()
+    if _index is not None and _index.version == version:
+        _index.checked_at = time.monotonic()
+        return _index
+    zones = ServiceZone.objects.filter(is_active=True)
+    _index = ZoneIndex(zones, getattr(settings, 'ZONE_CELL_DEG', 0.005), version)
+    return _index
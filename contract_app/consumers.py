@@ -1,24 +1,42 @@
 # chat/consumers.py
+import asyncio
 import json
+import time
+from django.conf import settings
+from django.core.cache import cache
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from .models import Message
-from accounts.models import User
+from accounts.models import User, Vehicle
+from accounts import geocells
+from accounts.utils import idle_drivers
+from accounts.location_history import get_store
+from accounts import tracking
+from accounts.surge import get_heatmap
+from accounts import zones
+from smart_rider.instrumentation import InstrumentedConsumerMixin
+from smart_rider import metrics
+from smart_rider.profiling import ProfiledConsumerMixin
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(ProfiledConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         if self.user.is_anonymous:
             await self.close()
             return
 
-        self.other_user_id = self.scope["url_route"]["kwargs"]["user_id"]
+        self.other_user_id = int(self.scope["url_route"]["kwargs"]["user_id"])
         self.room_name = f"chat_{min(self.user.id, self.other_user_id)}_{max(self.user.id, self.other_user_id)}"
 
         await self.channel_layer.group_add(self.room_name, self.channel_name)
         await self.accept()
+        self.counted = True
+        metrics.CHAT_CONNECTIONS.inc()
 
     async def disconnect(self, close_code):
+        if getattr(self, 'counted', False):
+            metrics.CHAT_CONNECTIONS.dec()
         await self.channel_layer.group_discard(self.room_name, self.channel_name)
 
     async def receive(self, text_data):
@@ -28,7 +46,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if msg_type == 'message':
             message = data['message']
             saved_msg = await self.save_message(message)
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'chat_message',
                 'message': message,
                 'sender_id': self.user.id,
@@ -39,7 +57,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             })
 
         elif msg_type == 'call_initiate':
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'incoming_call',
                 'from_id': self.user.id,
                 'from_contact': self.user.get_contact(),
@@ -47,26 +65,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             })
 
         elif msg_type == 'call_offer':
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'call_offer',
                 'offer': data['offer'],
                 'from': self.user.get_contact()
             })
 
         elif msg_type == 'call_answer':
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'call_answer',
                 'answer': data['answer']
             })
 
         elif msg_type == 'ice_candidate':
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'ice_candidate',
                 'candidate': data['candidate']
             })
 
         elif msg_type == 'call_end':
-            await self.channel_layer.group_send(self.room_name, {
+            await metrics.group_send(self.channel_layer, self.room_name, {
                 'type': 'call_end'
             })
 
@@ -116,4 +134,242 @@ class ChatConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def save_message(self, message):
         receiver = User.objects.get(id=self.other_user_id)
-        return Message.objects.create(sender=self.user, receiver=receiver, message=message)
\ No newline at end of file
+        return Message.objects.create(sender=self.user, receiver=receiver, message=message)
+
+
+class DriverConsumer(ProfiledConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope["user"]
+        if self.user.is_anonymous or self.user.account_type != User.AccountType.DRIVER:
+            await self.close()
+            return
+
+        self.groups_joined = set()
+        self.surge_mark = None
+        self.position = None
+        self.last_published = None
+        self.busy = False
+        # rider id -> monotonic deadline of each offer this driver was shown
+        self.offers = {}
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        # rejected connections never had a feed, and flush(None) would write every driver's
+        if not hasattr(self, 'groups_joined'):
+            return
+        await self.leave_cells()
+        await sync_to_async(get_store().flush)(self.user.id)
+
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        msg_type = data.get('type', 'location')
+
+        if msg_type == 'location':
+            try:
+                lat = float(data['lat'])
+                lng = float(data['lng'])
+            except (KeyError, TypeError, ValueError):
+                await self.send_error('lat and lng must be numbers')
+                return
+            if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                await self.send_error('lat and lng are out of range')
+                return
+            # the type names a channel group, so only known vehicle types get one
+            vehicle_type = data.get('vehicle_type')
+            if vehicle_type not in Vehicle.Type.values:
+                await self.send_error('Unknown vehicle_type')
+                return
+            self.position = (lat, lng)
+            # a full batch is written to disk, keep that off the event loop
+            await sync_to_async(get_store().record)(self.user.id, lat, lng)
+            in_area = await self.in_service_area(lat, lng)
+            if not in_area:
+                await self.leave_cells()
+                await self.send_error('Outside service area')
+            elif not self.busy:
+                idle_drivers[self.user.id] = {
+                    'id': self.user.id,
+                    'lat': lat,
+                    'lng': lng,
+                    'vehicle_type': vehicle_type,
+                    'channel_name': self.channel_name
+                }
+                await self.move_to(lat, lng, vehicle_type)
+            await self.publish_position(lat, lng)
+
+        elif msg_type == 'busy':
+            self.busy = True
+            await self.leave_cells()
+
+        elif msg_type == 'available':
+            self.busy = False
+
+        elif msg_type == 'accept':
+            await self.accept_ride(data.get('rider_id'))
+
+    async def accept_ride(self, rider_id):
+        # only a ride that was offered to this driver, and only if no other driver took it first
+        try:
+            rider_id = int(rider_id)
+        except (TypeError, ValueError):
+            await self.send_error('rider_id is required')
+            return
+        deadline = self.offers.pop(rider_id, None)
+        if deadline is None or deadline < time.monotonic():
+            await self.send_error('No pending offer from this rider')
+            return
+        if not await cache.aadd(tracking.assignment_key(rider_id), self.user.id, 3 * 3600):
+            await self.send_error('Ride already taken')
+            return
+        self.busy = True
+        await self.leave_cells()
+        await self.send(text_data=json.dumps({
+            'type': 'ride_accepted',
+            'rider_id': rider_id
+        }))
+        await metrics.group_send(self.channel_layer, tracking.rider_group(rider_id), {
+            'type': 'ride_accepted',
+            'driver_id': self.user.id
+        })
+        # the rider has no position yet, publish the next fix even if the driver stands still
+        self.last_published = None
+
+    async def send_error(self, message):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'message': message
+        }))
+
+    async def in_service_area(self, lat, lng):
+        index = zones.cached_index()
+        if index is None or index.is_stale():
+            index = await database_sync_to_async(zones.get_zone_index)()
+        return index.in_service_area(lat, lng)
+
+    async def publish_position(self, lat, lng):
+        # encode once here, so watchers only forward bytes
+        now = time.time()
+        if not tracking.should_publish(self.last_published, now, lat, lng):
+            return
+        self.last_published = (now, lat, lng)
+        await metrics.group_send(self.channel_layer, tracking.group_name(self.user.id), {
+            'type': 'track_position',
+            'frame': tracking.encode_position(now, lat, lng)
+        })
+
+    async def move_to(self, lat, lng, vehicle_type):
+        groups = {geocells.group_name(vehicle_type, cell) for cell in geocells.cells_for(lat, lng)}
+        for group in self.groups_joined - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.groups_joined = groups
+
+        heatmap = get_heatmap()
+        mark = heatmap.presence(heatmap.cell_for(lat, lng))
+        if mark != self.surge_mark:
+            await sync_to_async(heatmap.driver_present)(self.surge_mark, mark)
+        self.surge_mark = mark
+
+    async def leave_cells(self):
+        idle_drivers.pop(self.user.id, None)
+        for group in getattr(self, 'groups_joined', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.groups_joined = set()
+        if getattr(self, 'surge_mark', None):
+            await sync_to_async(get_heatmap().driver_present)(self.surge_mark, None)
+            self.surge_mark = None
+
+    async def ride_offer(self, event):
+        # cells over-approximate the search circle, drop offers that are out of reach
+        if self.position is None:
+            return
+        if geocells.haversine(event['lat'], event['lng'], *self.position) > event['radius']:
+            return
+        now = time.monotonic()
+        self.offers = {rider: deadline for rider, deadline in self.offers.items() if deadline > now}
+        self.offers[event['offer']['rider_id']] = now + getattr(settings, 'RIDE_OFFER_TTL_S', 120)
+        await self.send(text_data=json.dumps({
+            'type': 'ride_offer',
+            'offer': event['offer']
+        }))
+
+
+class TripTrackingConsumer(ProfiledConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope["user"]
+        if self.user.is_anonymous:
+            await self.close()
+            return
+
+        self.group = None
+        self.rider_group = None
+        self.last_sent = 0
+        self.pending = None
+        self.flush_task = None
+        driver_id = self.scope["url_route"]["kwargs"].get("driver_id")
+        if driver_id is None:
+            # a rider waiting for a driver, the accept switches this socket to the driver's feed
+            self.rider_group = tracking.rider_group(self.user.id)
+            await self.channel_layer.group_add(self.rider_group, self.channel_name)
+            await self.accept()
+            assigned = await cache.aget(tracking.assignment_key(self.user.id))
+            if assigned is not None:
+                await self.ride_accepted({'driver_id': assigned})
+            return
+
+        driver_id = int(driver_id)
+        if not self.user.is_staff:
+            assigned = await cache.aget(tracking.assignment_key(self.user.id))
+            if assigned != driver_id:
+                await self.close()
+                return
+        await self.follow(driver_id)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'flush_task', None):
+            self.flush_task.cancel()
+        for group in (getattr(self, 'group', None), getattr(self, 'rider_group', None)):
+            if group:
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def follow(self, driver_id):
+        group = tracking.group_name(driver_id)
+        if group == self.group:
+            return False
+        if self.group:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+        self.driver_id = driver_id
+        self.group = group
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        return True
+
+    async def ride_accepted(self, event):
+        if await self.follow(event['driver_id']):
+            await self.send(text_data=json.dumps({
+                'type': 'ride_accepted',
+                'driver_id': event['driver_id']
+            }))
+
+    async def track_position(self, event):
+        # at most one frame per interval per watcher, always ending on the latest position
+        interval = getattr(settings, 'TRACKING_MIN_INTERVAL_S', 1)
+        wait = self.last_sent + interval - time.monotonic()
+        if wait <= 0:
+            await self.send_frame(event['frame'])
+            return
+        self.pending = event['frame']
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later(wait))
+
+    async def flush_later(self, wait):
+        await asyncio.sleep(wait)
+        self.flush_task = None
+        frame, self.pending = self.pending, None
+        if frame is not None:
+            await self.send_frame(frame)
+
+    async def send_frame(self, frame):
+        self.last_sent = time.monotonic()
+        await self.send(bytes_data=frame)
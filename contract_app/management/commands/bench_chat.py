@@ -0,0 +1,291 @@
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+from collections import Counter
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import User
+from contract_app.consumers import ChatConsumer
+from contract_app.rounting import websocket_urlpatterns
+from smart_rider import benchmarking
+from smart_rider.instrumentation import collect_queries
+
+# the size of a typical browser offer, so the layer moves realistic payloads
+FAKE_SDP = ('v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n'
+            + 'a=candidate:0 1 UDP 2122252543 10.0.0.1 50000 typ host\r\n' * 40)
+TIMEOUT = 60
+
+
+class SimulatedClient:
+    # one browser tab: a communicator plus a reader task that counts frames by
+    # type and times the ones tagged by the peer
+    def __init__(self, application, user, peer, bench):
+        self.user = user
+        self.bench = bench
+        self.prefix = f'{user.id}:'
+        self.communicator = WebsocketCommunicator(application, f'/ws/chat/{peer.id}/')
+        self.communicator.scope['user'] = user
+        self.counts = Counter()
+        self.waiters = []
+        self.reader = None
+        self.sent = 0
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=TIMEOUT)
+        if not connected:
+            raise CommandError(f'ChatConsumer refused user {self.user.id}')
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect(timeout=TIMEOUT)
+
+    async def read(self):
+        # receive_from cancels the application when it times out, so never let it
+        while True:
+            self.on_frame(json.loads(await self.communicator.receive_from(timeout=3600)))
+
+    def on_frame(self, data):
+        kind = data['type']
+        self.counts[kind] += 1
+        self.bench.frames += 1
+        if kind == 'message':
+            tag = data['message']
+        elif kind == 'ice_candidate':
+            tag = data['candidate'].get('tag')
+        else:
+            tag = None
+        # our own frames come back through the room group too, those are not timed
+        if tag and not tag.startswith(self.prefix):
+            sent_at = self.bench.sent_at.pop(tag, None)
+            if sent_at is not None:
+                self.bench.latencies.append(time.perf_counter() - sent_at)
+        for waiter in list(self.waiters):
+            if self.counts[waiter[0]] >= waiter[1]:
+                self.waiters.remove(waiter)
+                waiter[2].set_result(None)
+
+    def expect(self, kind, count=1):
+        future = asyncio.get_running_loop().create_future()
+        if count <= 0:
+            future.set_result(None)
+        else:
+            self.waiters.append((kind, self.counts[kind] + count, future))
+        return future
+
+    def tag(self):
+        self.sent += 1
+        tag = f'{self.prefix}{self.sent}'
+        self.bench.sent_at[tag] = time.perf_counter()
+        return tag
+
+    async def send(self, **data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+
+class Command(BaseCommand):
+    help = ('Load test ChatConsumer with simulated clients over the in-memory channel layer. The clients '
+            'run in the same process, so frames per CPU second is a lower bound for the consumer alone.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500, help='Connections, paired into 1:1 rooms')
+        parser.add_argument('--concurrency', type=int, default=100, help='Connections opened at once')
+        parser.add_argument('--burst', type=int, default=20, help='Messages each side of a room sends back to back')
+        parser.add_argument('--candidates', type=int, default=30, help='ICE candidates each side sends per call')
+        parser.add_argument('--capacity', type=int, default=100,
+                            help='Channel capacity of the in-memory layer, frames past it are dropped')
+        parser.add_argument('--memory-sample', type=int, default=100,
+                            help='Connections opened under tracemalloc to estimate memory per connection')
+        parser.add_argument('--output', help='Write the results as JSON')
+        parser.add_argument('--baseline', help='Earlier --output to compare against')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative latency increase over the baseline')
+
+    def handle(self, *args, **options):
+        pairs = max(1, options['clients'] // 2)
+        layers = {'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': options['capacity']},
+        }}
+        self.save_timer = benchmarking.Timer()
+        self.save_queries = []
+        # the sampler's log lines would be timed along with the consumer
+        with benchmarking.bench_environment(CHANNEL_LAYERS=layers, INSTRUMENTATION_SAMPLE_RATE=0), \
+                mock.patch.object(ChatConsumer, 'save_message', self.timed_save_message()):
+            users = self.create_users(2 * (pairs + options['memory_sample'] // 2))
+            self.application = URLRouter(websocket_urlpatterns)
+            results = async_to_sync(self.run)(users, pairs, options)
+
+        results.update({
+            'benchmark': 'chat',
+            'environment': benchmarking.environment(),
+            'config': {k: options[k] for k in ('clients', 'burst', 'candidates', 'capacity')},
+        })
+        results['scenarios']['save_message'] = benchmarking.summarize(self.save_timer.latencies, self.save_queries)
+        self.report(results)
+        benchmarking.check_errors(results)
+        if options['output']:
+            benchmarking.save(options['output'], results)
+        if options['baseline']:
+            benchmarking.check_baseline(self, results, options['baseline'], options['threshold'])
+
+    def timed_save_message(self):
+        # the body that runs on the database thread, without the wait for that thread
+        save_message = ChatConsumer.__dict__['save_message'].func
+
+        def timed(consumer, message):
+            with collect_queries() as collector, self.save_timer.measure():
+                saved = save_message(consumer, message)
+            self.save_queries.append(collector.count)
+            return saved
+        return database_sync_to_async(timed)
+
+    def create_users(self, count):
+        # alternating riders and drivers, rooms pair one of each like real chats
+        User.objects.bulk_create(
+            User(
+                username=f'chatbench{i}',
+                email=f'chatbench{i}@example.com',
+                full_name=f'Chat Bench {i}',
+                account_type=User.AccountType.DRIVER if i % 2 else User.AccountType.USER,
+                password='!',
+            )
+            for i in range(count)
+        )
+        return list(User.objects.filter(username__startswith='chatbench').order_by('id'))
+
+    def clients(self, users):
+        clients = []
+        for rider, driver in zip(users[::2], users[1::2]):
+            clients.append(SimulatedClient(self.application, rider, driver, self))
+            clients.append(SimulatedClient(self.application, driver, rider, self))
+        return clients
+
+    async def run(self, users, pairs, options):
+        self.frames = 0
+        self.sent_at = {}
+        self.latencies = []
+        sample, users = users[2 * pairs:], users[:2 * pairs]
+        scenarios = {}
+        bytes_per_connection = await self.measure_memory(self.clients(sample), options['concurrency'])
+
+        clients = self.clients(users)
+        timer = benchmarking.Timer()
+        started = time.perf_counter()
+        for i in range(0, len(clients), options['concurrency']):
+            await asyncio.gather(*(self.timed_connect(client, timer) for client in clients[i:i + options['concurrency']]))
+        scenarios['connect'] = benchmarking.summarize(timer.latencies, elapsed=time.perf_counter() - started)
+
+        rooms = list(zip(clients[::2], clients[1::2]))
+        try:
+            scenarios['chat_burst'] = await self.scenario(rooms, self.chat_burst, options['burst'])
+            setups = benchmarking.Timer()
+            scenarios['ice_storm'] = await self.scenario(rooms, self.call, options['candidates'], setups)
+            scenarios['call_setup'] = benchmarking.summarize(setups.latencies)
+        finally:
+            for i in range(0, len(clients), options['concurrency']):
+                await asyncio.gather(*(client.disconnect() for client in clients[i:i + options['concurrency']]))
+        return {
+            'connections_per_s': scenarios['connect']['throughput_per_s'],
+            'bytes_per_connection': bytes_per_connection,
+            'scenarios': scenarios,
+        }
+
+    async def timed_connect(self, client, timer):
+        with timer.measure():
+            await client.connect()
+
+    async def measure_memory(self, clients, concurrency):
+        # includes the communicator's queues and task, so an upper bound for the consumer
+        if not clients:
+            return None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(0, len(clients), concurrency):
+                await asyncio.gather(*(client.connect() for client in clients[i:i + concurrency]))
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        for i in range(0, len(clients), concurrency):
+            await asyncio.gather(*(client.disconnect() for client in clients[i:i + concurrency]))
+        return round(used / len(clients))
+
+    async def scenario(self, rooms, play, count, *args):
+        # every room plays at once; frames that never arrive count as errors
+        self.frames = 0
+        self.sent_at.clear()
+        self.latencies = []
+        cpu, started = time.process_time(), time.perf_counter()
+        outcomes = await asyncio.gather(*(play(a, b, count, *args) for a, b in rooms))
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+        result = benchmarking.summarize(self.latencies, elapsed=elapsed, errors=sum(outcomes))
+        result['frames_per_s'] = round(self.frames / elapsed, 2)
+        result['frames_per_cpu_s'] = round(self.frames / cpu, 2) if cpu else None
+        return result
+
+    async def wait(self, futures):
+        _, pending = await asyncio.wait(futures, timeout=TIMEOUT)
+        for future in pending:
+            future.cancel()
+        return len(pending)
+
+    async def chat_burst(self, a, b, count):
+        # both sides type at once, each sees its own messages echoed and the peer's
+        arrived = [a.expect('message', 2 * count), b.expect('message', 2 * count)]
+        for _ in range(count):
+            await a.send(type='message', message=a.tag())
+            await b.send(type='message', message=b.tag())
+        return await self.wait(arrived)
+
+    async def call(self, a, b, count, setups):
+        missed = 0
+        with setups.measure():
+            for sender, receiver, kind, data in (
+                (a, b, 'incoming_call', {'type': 'call_initiate'}),
+                (a, b, 'call_offer', {'type': 'call_offer', 'offer': {'type': 'offer', 'sdp': FAKE_SDP}}),
+                (b, a, 'call_answer', {'type': 'call_answer', 'answer': {'type': 'answer', 'sdp': FAKE_SDP}}),
+            ):
+                arrived = receiver.expect(kind)
+                await sender.send(**data)
+                missed += await self.wait([arrived])
+
+        arrived = [a.expect('ice_candidate', 2 * count), b.expect('ice_candidate', 2 * count)]
+        for i in range(count):
+            for client in (a, b):
+                await client.send(type='ice_candidate', candidate={
+                    'candidate': f'candidate:{i} 1 UDP 2122252543 10.0.0.{i % 250} {50000 + i} typ host',
+                    'sdpMid': '0',
+                    'sdpMLineIndex': 0,
+                    'tag': client.tag(),
+                })
+        missed += await self.wait(arrived)
+
+        ended = [a.expect('call_end'), b.expect('call_end')]
+        await a.send(type='call_end')
+        return missed + await self.wait(ended)
+
+    def report(self, results):
+        self.stdout.write(f'{"scenario":<14}{"count":>8}{"per s":>11}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+                          f'{"errors":>8}')
+        for name, s in results['scenarios'].items():
+            self.stdout.write(f'{name:<14}{s["count"]:>8}{s["throughput_per_s"]!s:>11}{s["p50_ms"]!s:>10}'
+                              f'{s["p95_ms"]!s:>10}{s["p99_ms"]!s:>10}{s["errors"]:>8}')
+        for name in ('chat_burst', 'ice_storm'):
+            s = results['scenarios'][name]
+            self.stdout.write(f'{name}: {s["frames_per_s"]} frames/s, {s["frames_per_cpu_s"]} frames per CPU second')
+        save = results['scenarios']['save_message']
+        self.stdout.write(f'save_message: {save.get("queries_per_request")} queries per call')
+        self.stdout.write(f'{results["connections_per_s"]} connections/s, '
+                          f'~{results["bytes_per_connection"]} bytes per connection')
@@ -10,6 +10,9 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'timestamp']),
+        ]
 
     def __str__(self):
         return f"{self.sender.get_contact()} → {self.receiver.get_contact()}"
\ No newline at end of file
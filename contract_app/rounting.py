@@ -4,4 +4,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<user_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/driver/$', consumers.DriverConsumer.as_asgi()),
+    re_path(r'ws/track/$', consumers.TripTrackingConsumer.as_asgi()),
+    re_path(r'ws/track/(?P<driver_id>\d+)/$', consumers.TripTrackingConsumer.as_asgi()),
 ] 
\ No newline at end of file
@@ -5,7 +5,7 @@ from accounts.models import User
 
 class UserContactSerializer(serializers.ModelSerializer):
     contact = serializers.SerializerMethodField()
-    account_type = serializers.CharField(source='account_type')
+    account_type = serializers.CharField()
 
     class Meta:
         model = User
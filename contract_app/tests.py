@@ -1,3 +1,579 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts import geocells, tracking, zones
+from accounts.location_history import LocationHistoryStore
+from accounts.models import ProfileCapture, User, ServiceZone
+from smart_rider import profiling
+from smart_rider.instrumentation import QueryCollector
+from smart_rider.query_budget import VOLUMES, Budget, QueryBudgetMixin, url_names
+from . import rounting, urls
+from .models import Message
+
+DHAKA = [[23.70, 90.33], [23.70, 90.50], [23.90, 90.50], [23.90, 90.33]]
+
+
+def create_pair():
+    rider = User.objects.create_user(email='chat-rider@example.com', password='!')
+    driver = User.objects.create_user(phone='01711000010', password='!', account_type=User.AccountType.DRIVER)
+    return rider, driver
+
+
+def grow_conversation(rider, driver, rows):
+    # messages between the two and as many strangers, so filters must use the index
+    have = Message.objects.filter(sender__in=(rider, driver), receiver__in=(rider, driver)).count()
+    new = range(have, rows)
+    strangers = User.objects.bulk_create(
+        User(username=f'stranger{i}', email=f'stranger{i}@example.com', password='!') for i in new
+    )
+    Message.objects.bulk_create(
+        Message(sender=(rider, driver)[i % 2], receiver=(driver, rider)[i % 2], message=f'Message {i}')
+        for i in new
+    )
+    Message.objects.bulk_create(
+        Message(sender=stranger, receiver=rider, message='Hi') for stranger in strangers[:rows // 10]
+    )
+
+
+class MessageBudgetTests(QueryBudgetMixin, TestCase):
+    budgets = {
+        'contract-list': Budget(queries=1, payload=100),
+        # the conversation is returned whole, a row is a message with both users
+        'message-list': Budget(queries=4, payload=300, payload_per_row=320),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rider, cls.driver = create_pair()
+
+    def test_every_url_has_a_budget(self):
+        self.assertEveryNameBudgeted(url_names(urls.urlpatterns))
+
+    def test_endpoints_stay_within_budget(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.rider).access_token}')
+        conversation = reverse('message-list', args=[self.driver.id])
+        calls = {
+            'contract-list': lambda: client.get(reverse('contract-list')),
+            'message-list': lambda: client.get(conversation),
+            'message-list:post': lambda: client.post(conversation, {'message': 'On my way'}),
+        }
+        first = {}
+        for rows in VOLUMES:
+            grow_conversation(self.rider, self.driver, rows)
+            for key, call in calls.items():
+                name = key.split(':')[0]
+                with self.subTest(key, rows=rows):
+                    collector, response = self.measure(call)
+                    self.assertLess(response.status_code, 300, response.content[:300])
+                    self.assertWithinBudget(name, collector, len(response.content), rows)
+                    self.assertNotGrowing(key, first.setdefault(key, collector), collector, rows)
+
+
+class ConditionalMessageTests(TestCase):
+    def setUp(self):
+        self.rider, self.driver = create_pair()
+        Message.objects.create(sender=self.driver, receiver=self.rider, message='Arriving')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.rider).access_token}')
+        self.url = reverse('message-list', args=[self.driver.id])
+
+    def revalidate(self, etag):
+        return self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_conversation_is_not_sent_again(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(3):
+            response = self.revalidate(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_etag_changes_after_writes(self):
+        etag = self.client.get(self.url)['ETag']
+        changes = [
+            lambda: self.client.post(self.url, {'message': 'On my way'}),
+            lambda: Message.objects.filter(receiver=self.rider).update(is_read=True),
+            lambda: self.driver.save(),
+            # a message with someone else is not part of this conversation
+            lambda: Message.objects.create(sender=self.rider, receiver=self.rider, message='Note'),
+        ]
+        expected = [200, 200, 200, 304]
+        for change, status in zip(changes, expected):
+            change()
+            response = self.revalidate(etag)
+            self.assertEqual(response.status_code, status)
+            etag = response['ETag']
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1)
+class ConsumerBudgetTests(QueryBudgetMixin, TransactionTestCase):
+    # Every event is measured across the consumers it reaches: the queries of all
+    # dispatches it causes and the largest frame any client receives. A
+    # TransactionTestCase, database_sync_to_async closes connections between calls.
+    budgets = {
+        'ChatConsumer.connect': Budget(queries=0, payload=0),
+        'ChatConsumer.message': Budget(queries=2, payload=300),
+        'ChatConsumer.call_initiate': Budget(queries=0, payload=200),
+        'ChatConsumer.call_offer': Budget(queries=0, payload=400),
+        'ChatConsumer.call_answer': Budget(queries=0, payload=400),
+        'ChatConsumer.ice_candidate': Budget(queries=0, payload=300),
+        'ChatConsumer.call_end': Budget(queries=0, payload=100),
+        'ChatConsumer.disconnect': Budget(queries=0, payload=0),
+        'DriverConsumer.connect': Budget(queries=0, payload=0),
+        # the first fix after startup loads the zone index
+        'DriverConsumer.location': Budget(queries=2, payload=100),
+        'DriverConsumer.ride_offer': Budget(queries=0, payload=400),
+        'DriverConsumer.accept': Budget(queries=0, payload=100),
+        'TripTrackingConsumer.connect': Budget(queries=0, payload=0),
+        'TripTrackingConsumer.track_position': Budget(queries=0, payload=100),
+        'DriverConsumer.available': Budget(queries=0, payload=0),
+        'DriverConsumer.busy': Budget(queries=0, payload=0),
+        'TripTrackingConsumer.disconnect': Budget(queries=0, payload=0),
+        'DriverConsumer.disconnect': Budget(queries=0, payload=0),
+    }
+    sdp = 'v=0\r\n' + 'a=candidate:0 1 UDP 2122252543 10.0.0.1 50000 typ host\r\n' * 5
+
+    def setUp(self):
+        self.rider, self.driver = create_pair()
+        ServiceZone.objects.create(name='Dhaka', polygon=DHAKA)
+        zones._index = None
+        self.application = URLRouter(rounting.websocket_urlpatterns)
+        self.records = []
+        store = LocationHistoryStore(tempfile.mkdtemp(), 3600, 64)
+        patches = [
+            mock.patch('accounts.location_history._store', store),
+            mock.patch('smart_rider.instrumentation.emit', self.record),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def record(self, kind, name, elapsed, collector=None, **extra):
+        self.records.append(collector)
+
+    def communicator(self, path, user):
+        communicator = WebsocketCommunicator(self.application, path)
+        communicator.scope['user'] = user
+        return communicator
+
+    async def drain(self, communicators):
+        frames = []
+        for communicator in communicators:
+            while not await communicator.receive_nothing(timeout=0.05):
+                message = await communicator.receive_output()
+                if message['type'] == 'websocket.send':
+                    frames.append(message.get('text') or message.get('bytes') or '')
+        return frames
+
+    async def step(self, action, communicators):
+        # (collector summing every dispatch the action caused, largest frame size)
+        start = len(self.records)
+        await action()
+        frames = await self.drain(communicators)
+        total = QueryCollector()
+        for collector in self.records[start:]:
+            if collector is not None:
+                total.count += collector.count
+                total.fingerprints.update(collector.fingerprints)
+        return total, max((len(frame) for frame in frames), default=0)
+
+    async def play(self):
+        rider = self.communicator(f'/ws/chat/{self.driver.id}/', self.rider)
+        driver = self.communicator(f'/ws/chat/{self.rider.id}/', self.driver)
+        room = [rider, driver]
+        feed = self.communicator('/ws/driver/', self.driver)
+        watcher = self.communicator(f'/ws/track/{self.driver.id}/', self.rider)
+
+        async def connect(*communicators):
+            for communicator in communicators:
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+
+        def send(communicator, **data):
+            return lambda: communicator.send_json_to(data)
+
+        def offer():
+            return geocells.publish_ride_offer(23.8, 90.4, 'SEDAN', {'rider_id': self.rider.id, 'lat': 23.8,
+                                                                     'lng': 90.4, 'vehicle_type': 'SEDAN'})
+
+        steps = [
+            ('ChatConsumer.connect', lambda: connect(rider, driver), room),
+            ('ChatConsumer.message', send(rider, type='message', message='Where are you?'), room),
+            ('ChatConsumer.call_initiate', send(rider, type='call_initiate'), room),
+            ('ChatConsumer.call_offer', send(rider, type='call_offer', offer={'type': 'offer', 'sdp': self.sdp}), room),
+            ('ChatConsumer.call_answer', send(driver, type='call_answer', answer={'type': 'answer', 'sdp': self.sdp}),
+             room),
+            ('ChatConsumer.ice_candidate', send(driver, type='ice_candidate', candidate={
+                'candidate': 'candidate:1 1 UDP 2122252543 10.0.0.2 50001 typ host', 'sdpMid': '0'}), room),
+            ('ChatConsumer.call_end', send(rider, type='call_end'), room),
+            ('ChatConsumer.disconnect', lambda: self.disconnect(rider, driver), []),
+            ('DriverConsumer.connect', lambda: connect(feed), [feed]),
+            ('DriverConsumer.location', send(feed, type='location', lat=23.8, lng=90.4, vehicle_type='SEDAN'),
+             [feed]),
+            ('DriverConsumer.ride_offer', offer, [feed]),
+            ('DriverConsumer.accept', send(feed, type='accept', rider_id=self.rider.id), [feed]),
+            ('TripTrackingConsumer.connect', lambda: connect(watcher), [watcher]),
+            ('TripTrackingConsumer.track_position', send(feed, type='location', lat=23.81, lng=90.4,
+                                                         vehicle_type='SEDAN'), [feed, watcher]),
+            ('DriverConsumer.available', send(feed, type='available'), [feed]),
+            ('DriverConsumer.busy', send(feed, type='busy'), [feed]),
+            ('TripTrackingConsumer.disconnect', lambda: self.disconnect(watcher), []),
+            ('DriverConsumer.disconnect', lambda: self.disconnect(feed), []),
+        ]
+        results = []
+        for key, action, communicators in steps:
+            results.append((key, *await self.step(action, communicators)))
+        return results
+
+    async def disconnect(self, *communicators):
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def test_every_consumer_has_a_budget(self):
+        consumers = {route.callback.consumer_class.__name__ for route in rounting.websocket_urlpatterns}
+        self.assertEqual({key.split('.')[0] for key in self.budgets}, consumers)
+
+    def test_events_stay_within_budget(self):
+        first = {}
+        for rows in VOLUMES:
+            grow_conversation(self.rider, self.driver, rows)
+            zones._index = None
+            cache.delete(tracking.assignment_key(self.rider.id))
+            results = async_to_sync(self.play)()
+            self.assertEqual({key for key, *_ in results}, set(self.budgets))
+            for key, collector, payload in results:
+                with self.subTest(key, rows=rows):
+                    self.assertWithinBudget(key, collector, payload, rows)
+                    self.assertNotGrowing(key, first.setdefault(key, collector), collector, rows)
+
+
+class DriverConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.rider, self.driver = create_pair()
+        ServiceZone.objects.create(name='Dhaka', polygon=DHAKA)
+        zones._index = None
+        self.application = URLRouter(rounting.websocket_urlpatterns)
+        self.store = LocationHistoryStore(tempfile.mkdtemp(), 3600, 64)
+        patch = mock.patch('accounts.location_history._store', self.store)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def communicator(self, path, user):
+        communicator = WebsocketCommunicator(self.application, path)
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_fixes_are_written_when_the_driver_leaves(self):
+        async def play():
+            feed = self.communicator('/ws/driver/', self.driver)
+            self.assertTrue((await feed.connect())[0])
+            for i in range(3):
+                await feed.send_json_to({'type': 'location', 'lat': 23.8 + i / 1000, 'lng': 90.4,
+                                         'vehicle_type': 'SEDAN'})
+            await feed.receive_nothing(timeout=0.1)
+            self.assertEqual(len(self.store.pending[self.driver.id]), 3)
+            await feed.disconnect()
+        async_to_sync(play)()
+        self.assertEqual(self.store.pending, {})
+        now = time.time()
+        self.assertEqual(len(self.store.query(self.driver.id, now - 60, now)), 3)
+
+    def test_rejected_connection_does_not_flush_other_drivers(self):
+        self.store.record(self.driver.id, 23.8, 90.4)
+
+        async def play():
+            for user in (AnonymousUser(), self.rider):
+                feed = self.communicator('/ws/driver/', user)
+                self.assertFalse((await feed.connect())[0])
+                await feed.disconnect()
+        async_to_sync(play)()
+        self.assertEqual(len(self.store.pending[self.driver.id]), 1)
+
+    def test_bad_locations_are_answered_with_errors(self):
+        async def play():
+            feed = self.communicator('/ws/driver/', self.driver)
+            self.assertTrue((await feed.connect())[0])
+            errors = []
+            for data in ({'lat': 23.8, 'vehicle_type': 'SEDAN'}, {'lat': 'north', 'lng': 90.4, 'vehicle_type': 'SEDAN'},
+                         {'lat': None, 'lng': 90.4, 'vehicle_type': 'SEDAN'}, {'lat': 'nan', 'lng': 90.4, 'vehicle_type': 'SEDAN'},
+                         {'lat': 23.8, 'lng': 190, 'vehicle_type': 'SEDAN'}, {'lat': 23.8, 'lng': 90.4},
+                         {'lat': 23.8, 'lng': 90.4, 'vehicle_type': 'x.y'}):
+                await feed.send_json_to({'type': 'location', **data})
+                errors.append((await feed.receive_json_from())['message'])
+            groups = set(get_channel_layer().groups)
+            self.assertNotIn(self.driver.id, self.store.pending)
+            # the socket stays usable
+            await feed.send_json_to({'type': 'location', 'lat': 23.8, 'lng': 90.4, 'vehicle_type': 'SEDAN'})
+            self.assertTrue(await feed.receive_nothing(timeout=0.1))
+            self.assertEqual(len(self.store.pending[self.driver.id]), 1)
+            await feed.disconnect()
+            return errors, groups
+        errors, groups = async_to_sync(play)()
+        self.assertEqual(errors, ['lat and lng must be numbers'] * 3 + ['lat and lng are out of range'] * 2
+                         + ['Unknown vehicle_type'] * 2)
+        self.assertFalse([group for group in groups if group.startswith('drivers.')])
+
+    def offer(self, rider):
+        return geocells.publish_ride_offer(23.8, 90.4, 'SEDAN', {'rider_id': rider.id, 'lat': 23.8, 'lng': 90.4})
+
+    async def start_feed(self, driver):
+        feed = self.communicator('/ws/driver/', driver)
+        self.assertTrue((await feed.connect())[0])
+        await feed.send_json_to({'type': 'location', 'lat': 23.8, 'lng': 90.4, 'vehicle_type': 'SEDAN'})
+        self.assertTrue(await feed.receive_nothing(timeout=0.1))
+        return feed
+
+    def test_accept_needs_an_offer_shown_to_the_driver(self):
+        other = User.objects.create_user(phone='01711000011', password='!', account_type=User.AccountType.DRIVER)
+        key = tracking.assignment_key(self.rider.id)
+        cache.delete(key)
+
+        async def play():
+            feed, rival = await self.start_feed(self.driver), await self.start_feed(other)
+            errors = []
+            for data in ({'type': 'accept'}, {'type': 'accept', 'rider_id': 'x'},
+                         {'type': 'accept', 'rider_id': self.rider.id}):
+                await feed.send_json_to(data)
+                errors.append((await feed.receive_json_from())['message'])
+            self.assertIsNone(await cache.aget(key))
+
+            await self.offer(self.rider)
+            for communicator in (feed, rival):
+                self.assertEqual((await communicator.receive_json_from())['type'], 'ride_offer')
+            await feed.send_json_to({'type': 'accept', 'rider_id': self.rider.id})
+            self.assertEqual(await feed.receive_json_from(), {'type': 'ride_accepted', 'rider_id': self.rider.id})
+            await rival.send_json_to({'type': 'accept', 'rider_id': self.rider.id})
+            errors.append((await rival.receive_json_from())['message'])
+            # an offer is accepted once
+            await feed.send_json_to({'type': 'accept', 'rider_id': self.rider.id})
+            errors.append((await feed.receive_json_from())['message'])
+            await feed.disconnect()
+            await rival.disconnect()
+            return errors
+        errors = async_to_sync(play)()
+        self.assertEqual(errors, ['rider_id is required', 'rider_id is required', 'No pending offer from this rider',
+                                  'Ride already taken', 'No pending offer from this rider'])
+        self.assertEqual(cache.get(key), self.driver.id)
+
+    @override_settings(RIDE_OFFER_TTL_S=0)
+    def test_expired_offer_can_not_be_accepted(self):
+        cache.delete(tracking.assignment_key(self.rider.id))
+
+        async def play():
+            feed = await self.start_feed(self.driver)
+            await self.offer(self.rider)
+            await feed.receive_json_from()
+            await feed.send_json_to({'type': 'accept', 'rider_id': self.rider.id})
+            message = (await feed.receive_json_from())['message']
+            await feed.disconnect()
+            return message
+        self.assertEqual(async_to_sync(play)(), 'No pending offer from this rider')
+        self.assertIsNone(cache.get(tracking.assignment_key(self.rider.id)))
+
+
+@override_settings(TRACKING_MIN_MOVE_M=15, TRACKING_HEARTBEAT_S=30, TRACKING_MIN_INTERVAL_S=0)
+class TripTrackingTests(TransactionTestCase):
+    def setUp(self):
+        self.rider, self.driver = create_pair()
+        ServiceZone.objects.create(name='Dhaka', polygon=DHAKA)
+        zones._index = None
+        self.application = URLRouter(rounting.websocket_urlpatterns)
+        patch = mock.patch('accounts.location_history._store', LocationHistoryStore(tempfile.mkdtemp(), 3600, 64))
+        patch.start()
+        self.addCleanup(patch.stop)
+        cache.set(tracking.assignment_key(self.rider.id), self.driver.id)
+        self.addCleanup(cache.delete, tracking.assignment_key(self.rider.id))
+
+    def communicator(self, path, user):
+        communicator = WebsocketCommunicator(self.application, path)
+        communicator.scope['user'] = user
+        return communicator
+
+    async def connect(self):
+        feed = self.communicator('/ws/driver/', self.driver)
+        watcher = self.communicator(f'/ws/track/{self.driver.id}/', self.rider)
+        for communicator in (feed, watcher):
+            self.assertTrue((await communicator.connect())[0])
+        return feed, watcher
+
+    async def move(self, feed, lat, lng=90.4):
+        await feed.send_json_to({'type': 'location', 'lat': lat, 'lng': lng, 'vehicle_type': 'SEDAN'})
+
+    async def positions(self, watcher, timeout=0.2):
+        positions = []
+        while not await watcher.receive_nothing(timeout=timeout):
+            frame = (await watcher.receive_output())['bytes']
+            self.assertEqual(len(frame), 12)
+            positions.append(tracking.decode_position(frame)[1:])
+        return positions
+
+    def play(self, script):
+        async def run():
+            feed, watcher = await self.connect()
+            try:
+                return await script(feed, watcher)
+            finally:
+                for communicator in (feed, watcher):
+                    await communicator.disconnect()
+        return async_to_sync(run)()
+
+    def test_small_moves_are_not_published(self):
+        async def script(feed, watcher):
+            # 1e-4 degrees of latitude is about 11 m
+            for lat in (23.8, 23.8001, 23.8, 23.8001, 23.8003):
+                await self.move(feed, lat)
+            return await self.positions(watcher)
+        self.assertEqual(self.play(script), [(23.8, 90.4), (23.8003, 90.4)])
+
+    @override_settings(TRACKING_HEARTBEAT_S=1)
+    def test_a_driver_standing_still_is_republished_at_the_heartbeat(self):
+        async def script(feed, watcher):
+            await self.move(feed, 23.8)
+            await self.move(feed, 23.8)
+            first = await self.positions(watcher)
+            await asyncio.sleep(1.1)
+            await self.move(feed, 23.8)
+            await self.move(feed, 23.8)
+            return first, await self.positions(watcher)
+        self.assertEqual(self.play(script), ([(23.8, 90.4)], [(23.8, 90.4)]))
+
+    @override_settings(TRACKING_MIN_INTERVAL_S=0.5)
+    def test_each_watcher_gets_at_most_one_frame_per_interval(self):
+        async def script(feed, watcher):
+            admin = self.communicator(f'/ws/track/{self.driver.id}/', await database_sync_to_async(
+                User.objects.create_superuser)(email='watch@example.com', password='!'))
+            self.assertTrue((await admin.connect())[0])
+            for lat in (23.80, 23.81, 23.82, 23.83):
+                await self.move(feed, lat)
+            first = await self.positions(watcher, timeout=0.1)
+            admin_first = await self.positions(admin, timeout=0.1)
+            # the last position arrives once the interval is over, the ones between are dropped
+            later = await self.positions(watcher, timeout=0.6)
+            admin_later = await self.positions(admin, timeout=0.6)
+            await admin.disconnect()
+            return first, admin_first, later, admin_later
+        first, admin_first, later, admin_later = self.play(script)
+        self.assertEqual(first, [(23.8, 90.4)])
+        self.assertEqual(admin_first, [(23.8, 90.4)])
+        self.assertEqual(later, [(23.83, 90.4)])
+        self.assertEqual(admin_later, [(23.83, 90.4)])
+
+    def test_accept_tells_the_driver_and_switches_the_waiting_rider_to_the_feed(self):
+        cache.delete(tracking.assignment_key(self.rider.id))
+
+        async def play():
+            feed = self.communicator('/ws/driver/', self.driver)
+            waiting = self.communicator('/ws/track/', self.rider)
+            for communicator in (feed, waiting):
+                self.assertTrue((await communicator.connect())[0])
+            await self.move(feed, 23.8)
+            self.assertTrue(await waiting.receive_nothing(timeout=0.1))
+            await geocells.publish_ride_offer(23.8, 90.4, 'SEDAN', {'rider_id': self.rider.id})
+            self.assertEqual((await feed.receive_json_from())['type'], 'ride_offer')
+            await feed.send_json_to({'type': 'accept', 'rider_id': self.rider.id})
+            accepted = [await feed.receive_json_from(), await waiting.receive_json_from()]
+            # the first fix after the accept is published even though the driver did not move
+            await self.move(feed, 23.8)
+            positions = await self.positions(waiting)
+            # a rider connecting after the accept is told straight away
+            late = self.communicator('/ws/track/', self.rider)
+            self.assertTrue((await late.connect())[0])
+            accepted.append(await late.receive_json_from())
+            for communicator in (feed, waiting, late):
+                await communicator.disconnect()
+            return accepted, positions
+        accepted, positions = async_to_sync(play)()
+        self.assertEqual(accepted, [{'type': 'ride_accepted', 'rider_id': self.rider.id},
+                                    {'type': 'ride_accepted', 'driver_id': self.driver.id},
+                                    {'type': 'ride_accepted', 'driver_id': self.driver.id}])
+        self.assertEqual(positions, [(23.8, 90.4)])
+
+
+class ProfilingTests(TransactionTestCase):
+    def setUp(self):
+        self.rider, self.driver = create_pair()
+        self.admin = User.objects.create_superuser(email='admin@example.com', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def token(self, scope, seconds=10):
+        response = self.client.post(reverse('profile-token'), {'scope': scope, 'seconds': seconds})
+        return response.data['token']
+
+    def slot_is_free(self):
+        if not profiling._slot.acquire(blocking=False):
+            return False
+        profiling._slot.release()
+        return True
+
+    def test_http_token_profiles_one_request(self):
+        token = self.token('http')
+        url = reverse('profile')
+        first = self.client.get(url, HTTP_X_PROFILE_TOKEN=token)
+        self.assertEqual(ProfileCapture.objects.get().pk, int(first['X-Profile']))
+        self.assertEqual(self.client.get(url, HTTP_X_PROFILE_TOKEN=token)['X-Profile'], 'used')
+        self.assertNotIn('X-Profile', self.client.get(url, HTTP_X_PROFILE_TOKEN=token + 'x'))
+        self.assertEqual(ProfileCapture.objects.count(), 1)
+
+    def test_quiet_socket_gives_the_slot_back_at_the_deadline(self):
+        token = self.token('ws', seconds=1)
+        application = URLRouter(rounting.websocket_urlpatterns)
+
+        async def play():
+            feed = WebsocketCommunicator(application, f'/ws/driver/?_profile={token}')
+            feed.scope['user'] = self.driver
+            self.assertTrue((await feed.connect())[0])
+            self.assertFalse(self.slot_is_free())
+            await asyncio.sleep(1.5)
+            self.assertTrue(self.slot_is_free())
+
+            again = WebsocketCommunicator(application, f'/ws/driver/?_profile={token}')
+            again.scope['user'] = self.driver
+            self.assertTrue((await again.connect())[0])
+            self.assertTrue(self.slot_is_free())
+            for communicator in (feed, again):
+                await communicator.disconnect()
+        async_to_sync(play)()
+        capture = ProfileCapture.objects.get()
+        self.assertEqual((capture.kind, capture.target), ('ws', 'DriverConsumer'))
+
+
+class ChatBenchmarkTests(SimpleTestCase):
+    def test_small_run_has_no_errors(self):
+        # in a child process, the command sets up its own test database; the cache is its own too
+        output = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'chat.json')
+        process = subprocess.run(
+            [sys.executable, 'manage.py', 'bench_chat', '--clients', '4', '--concurrency', '4', '--burst', '3',
+             '--candidates', '3', '--memory-sample', '2', '--output', output],
+            cwd=settings.BASE_DIR, env={**os.environ, 'CACHE_URL': 'locmemcache://'}, capture_output=True, text=True,
+            timeout=300,
+        )
+        self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+        with open(output) as f:
+            results = json.load(f)
+        scenarios = results['scenarios']
+        self.assertEqual(sorted(scenarios), ['call_setup', 'chat_burst', 'connect', 'ice_storm', 'save_message'])
+        self.assertEqual({name: s['errors'] for name, s in scenarios.items() if s['errors']}, {})
+        self.assertEqual(scenarios['connect']['count'], 4)
+        # each side of both rooms sends 3 messages, all of them are saved
+        self.assertEqual(scenarios['save_message']['count'], 12)
+        self.assertGreater(results['bytes_per_connection'], 0)
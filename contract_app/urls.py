@@ -3,4 +3,5 @@ from . import views
 
 urlpatterns = [
     path('', views.ContractListView.as_view(), name='contract-list'),
+    path('messages/<int:user_id>/', views.MessageListAPI.as_view(), name='message-list'),
 ]
\ No newline at end of file
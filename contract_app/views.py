@@ -6,20 +6,34 @@ from rest_framework import status
 from .models import Message
 from .serializers import MessageSerializer
 from django.shortcuts import get_object_or_404
+from django.db.models import Count, Max, Q
 from accounts.models import User
+from smart_rider.db_router import ReplicaReadMixin
+from smart_rider.conditional import conditional_get
 
-class MessageListAPI(APIView):
+class MessageListAPI(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, user_id):
         other_user = get_object_or_404(User, id=user_id)
         messages = Message.objects.filter(
-            sender=request.user, receiver=other_user
-        ) | Message.objects.filter(
-            sender=other_user, receiver=request.user
+            Q(sender=request.user, receiver=other_user) | Q(sender=other_user, receiver=request.user)
+        ).select_related('sender', 'receiver')
+        # one aggregate decides whether the conversation changed since the client's copy
+        state = messages.aggregate(
+            last_id=Max('id'), count=Count('id'),
+            read=Count('id', filter=Q(is_read=True)), last_at=Max('timestamp')
+        )
+        users = (request.user, other_user)
+        etag = '-'.join(
+            ['msgs', str(state['last_id']), str(state['count']), str(state['read'])]
+            + [f'{u.id}.{u.updated_at.timestamp()}' for u in users]
+        )
+        last_modified = max([u.updated_at for u in users] + ([state['last_at']] if state['last_at'] else []))
+        return conditional_get(
+            request, etag=etag, last_modified=last_modified,
+            build=lambda: Response(MessageSerializer(messages, many=True).data)
         )
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
 
     def post(self, request, user_id):
         receiver = get_object_or_404(User, id=user_id)
@@ -12,14 +12,15 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-import chat.routing
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_rider.settings')
 
-application = get_asgi_application()
+django_asgi_app = get_asgi_application()
+
+import contract_app.rounting
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
-        URLRouter(chat.routing.websocket_urlpatterns)
+        URLRouter(contract_app.rounting.websocket_urlpatterns)
     ),
 })
\ No newline at end of file
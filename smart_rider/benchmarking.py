@@ -0,0 +1,132 @@
+import json
+import math
+import platform
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import CommandError
+from django.db import connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+# Shared by the bench_* management commands: a throwaway database, latency
+# summaries, and comparison against a saved baseline so CI can fail on regressions.
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(latencies, queries=None, elapsed=None, errors=0):
+    ms = [value * 1000 for value in latencies]
+    total = elapsed if elapsed is not None else sum(latencies)
+    result = {
+        'count': len(ms),
+        'errors': errors,
+        'throughput_per_s': round(len(ms) / total, 2) if total else None,
+        'p50_ms': round(percentile(ms, 50), 3) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 3) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 3) if ms else None,
+        'max_ms': round(max(ms), 3) if ms else None,
+    }
+    if queries:
+        result['queries_per_request'] = round(sum(queries) / len(queries), 2)
+        result['max_queries'] = max(queries)
+    return result
+
+
+class Timer:
+    def __init__(self):
+        self.latencies = []
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+@contextmanager
+def bench_environment(fast_hasher=False, keepdb=False, **settings):
+    # a test database (never the configured one), the locmem email backend, and
+    # no replica routing since only the default database is created
+    setup_test_environment()
+    connection = connections['default']
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, keepdb=keepdb)
+    overrides = {'DATABASE_ROUTERS': [], **settings}
+    if fast_hasher:
+        overrides['PASSWORD_HASHERS'] = FAST_HASHERS
+    try:
+        with override_settings(**overrides):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': connections['default'].vendor,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+# lower is better for these, a rise past the threshold is a regression
+REGRESSION_KEYS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+
+
+def compare(results, baseline, threshold):
+    # [(scenario, key, baseline value, new value)] for every regression
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for key in REGRESSION_KEYS:
+            old, new = previous.get(key), current.get(key)
+            if old is None or new is None:
+                continue
+            # query counts are exact, any increase counts
+            limit = old if key == 'queries_per_request' else old * (1 + threshold)
+            if new > limit:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_errors(results):
+    # numbers from failed calls are not a baseline
+    failed = [name for name, scenario in results['scenarios'].items() if scenario.get('errors')]
+    if failed:
+        raise CommandError(f'{", ".join(failed)} had errors, results not saved')
+
+
+def check_baseline(command, results, path, threshold):
+    # writes each regression to the command's stderr and fails the run on any
+    baseline = load(path)
+    if baseline.get('config') != results['config']:
+        command.stderr.write(f'Baseline was run with {baseline.get("config")}, numbers may not be comparable')
+    regressions = compare(results, baseline, threshold)
+    for name, key, old, new in regressions:
+        command.stderr.write(f'{name} {key}: {old} -> {new}')
+    if regressions:
+        raise CommandError(f'{len(regressions)} regressions against {path}')
@@ -0,0 +1,259 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.core.cache.backends import filebased
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import locks
+from django.utils.functional import cached_property
+
+_MISSING = object()
+
+
+class FileBasedCache(filebased.FileBasedCache):
+    # Django's file cache with add and incr made atomic across processes by an
+    # exclusive lock, so it can stand in for Redis as the shared tier. incr also
+    # keeps the entry's expiry where BaseCache.incr resets it to the default.
+    @contextmanager
+    def _locked(self):
+        self._createdir()
+        with open(os.path.join(self._dir, 'counters.lock'), 'a') as f:
+            locks.lock(f, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(f)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            return super().add(key, value, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        fname = self._key_to_file(key, version)
+        with self._locked():
+            try:
+                with open(fname, 'rb') as f:
+                    expiry = pickle.load(f)
+                    value = pickle.loads(zlib.decompress(f.read()))
+            except FileNotFoundError:
+                expiry, value = 0, None
+            if value is None or (expiry is not None and expiry < time.time()):
+                raise ValueError(f"Key '{key}' not found")
+            value += delta
+            fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+            with open(fd, 'wb') as f:
+                f.write(pickle.dumps(expiry, self.pickle_protocol))
+                f.write(zlib.compress(pickle.dumps(value, self.pickle_protocol)))
+            os.replace(tmp_path, fname)
+        return value
+
+
+class CacheLogBus:
+    # Invalidation broadcast over the shared cache itself: keys are written to a
+    # numbered ring of slots and every worker drains the slots it has not seen.
+    # This is the local stand-in, a Redis deployment can plug in pub/sub instead.
+    # Sequence numbers come from incr, which must be atomic or two publishers can
+    # get the same slot and one invalidation is lost.
+    def __init__(self, cache, prefix='l1inv', size=10000, timeout=3600):
+        if type(cache).incr is BaseCache.incr:
+            raise ImproperlyConfigured(
+                f'{type(cache).__name__} has no atomic incr, use Redis, Memcached or smart_rider.cache.FileBasedCache'
+            )
+        self.cache = cache
+        self.prefix = prefix
+        self.size = size
+        self.timeout = timeout
+
+    def _seq_key(self):
+        return f'{self.prefix}:seq'
+
+    def _slot_key(self, seq):
+        return f'{self.prefix}:{seq % self.size}'
+
+    def latest(self):
+        return self.cache.get(self._seq_key(), 0)
+
+    def publish(self, key):
+        self.cache.add(self._seq_key(), 0, None)
+        seq = self.cache.incr(self._seq_key())
+        self.cache.set(self._slot_key(seq), (seq, key), self.timeout)
+        return seq
+
+    def poll(self, since):
+        # returns (latest seq, [(seq, key), ...]) or (latest seq, None) when the log was missed
+        latest = self.latest()
+        if latest == since:
+            return latest, []
+        # the shared store was cleared, or this worker fell behind the ring
+        if latest < since or latest - since > self.size:
+            return latest, None
+        slots = self.cache.get_many([self._slot_key(seq) for seq in range(since + 1, latest + 1)])
+        entries = []
+        for seq in range(since + 1, latest + 1):
+            entry = slots.get(self._slot_key(seq))
+            if entry is None or entry[0] != seq:
+                return latest, None
+            entries.append(entry)
+        return latest, entries
+
+
+class TwoTierCache(BaseCache):
+    # A small per-process LRU (L1) in front of a shared cache alias (L2). Writes go
+    # through to L2 and are broadcast so other workers drop their L1 copy; L1
+    # entries also expire after L1_TIMEOUT to bound staleness if a broadcast is lost.
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = options.get('SHARED', 'shared')
+        self.l1_max_entries = options.get('L1_MAX_ENTRIES', 1000)
+        self.l1_timeout = options.get('L1_TIMEOUT', 30)
+        self.poll_interval = options.get('POLL_INTERVAL', 0.5)
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+        self._seen = None
+        self._published = set()
+        self._polled_at = 0
+        self.stats = Counter()
+
+    @cached_property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    @cached_property
+    def bus(self):
+        return CacheLogBus(self.shared)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['l1_entries'] = len(self._l1)
+        return stats
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval:
+            return
+        self._polled_at = now
+        if self._seen is None:
+            # anything written to L1 before the first poll can not be checked against the log
+            self._seen = self.bus.latest()
+            with self._lock:
+                self._l1.clear()
+            return
+        self._seen, entries = self.bus.poll(self._seen)
+        with self._lock:
+            if entries is None:
+                self._published.clear()
+                self._l1.clear()
+                return
+            for seq, key in entries:
+                # our own writes already updated L1
+                if seq in self._published:
+                    self._published.discard(seq)
+                elif key == '*':
+                    self._l1.clear()
+                elif self._l1.pop(key, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[1] < time.monotonic():
+                del self._l1[key]
+                return _MISSING
+            self._l1.move_to_end(key)
+        return pickle.loads(entry[0])
+
+    def _l1_set(self, key, value, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        ttl = self.l1_timeout if timeout is None else min(timeout, self.l1_timeout)
+        entry = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + ttl)
+        with self._lock:
+            self._l1[key] = entry
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _l1_delete(self, key):
+        with self._lock:
+            self._l1.pop(key, None)
+
+    def _invalidate(self, key):
+        self._l1_delete(key)
+        seq = self.bus.publish(key)
+        with self._lock:
+            self._published.add(seq)
+            # a worker that publishes but never reads would keep these forever;
+            # past the ring a poll can not match them anyway
+            if len(self._published) > 2 * self.bus.size:
+                self._published = {s for s in self._published if s > seq - self.bus.size}
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._sync()
+        value = self._l1_get(key)
+        if value is not _MISSING:
+            self.stats['l1_hits'] += 1
+            return value
+        value = self.shared.get(key, _MISSING)
+        if value is _MISSING:
+            self.stats['misses'] += 1
+            return default
+        self.stats['l2_hits'] += 1
+        self._l1_set(key, value, self.l1_timeout)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self.shared.set(key, value, timeout)
+        self._invalidate(key)
+        if timeout is None or timeout is DEFAULT_TIMEOUT or timeout > 0:
+            self._l1_set(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        if not self.shared.add(key, value, timeout):
+            return False
+        self._invalidate(key)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.shared.touch(key, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        deleted = self.shared.delete(key)
+        self._invalidate(key)
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        value = self.shared.incr(key, delta)
+        self._invalidate(key)
+        return value
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def clear(self):
+        self.shared.clear()
+        with self._lock:
+            self._l1.clear()
+            self._published.clear()
+        self._seen = None
+        self.bus.publish('*')
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
@@ -0,0 +1,29 @@
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def not_modified(request, etag=None, last_modified=None):
+    # a 304 (or 412) response when the client's validators still match, else None
+    return get_conditional_response(
+        request,
+        etag=quote_etag(etag) if etag else None,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag:
+        response.headers['ETag'] = quote_etag(etag)
+    if last_modified:
+        response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+    # per-user payloads: shared caches must not reuse them, clients must revalidate
+    patch_vary_headers(response, ('Authorization',))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_get(request, etag=None, last_modified=None, build=None):
+    response = not_modified(request, etag, last_modified)
+    if response is None:
+        response = build()
+    return set_validators(response, etag, last_modified)
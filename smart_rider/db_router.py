@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+
+REPLICA = 'replica'
+
+_read_from_replica = ContextVar('read_from_replica', default=False)
+
+
+@contextmanager
+def use_replica():
+    token = _read_from_replica.set(True)
+    try:
+        yield
+    finally:
+        _read_from_replica.reset(token)
+
+
+class ReplicaRouter:
+    # Reads go to the replica only inside use_replica(), everything else,
+    # including reads that must see the request's own writes, stays on default.
+    def db_for_read(self, model, **hints):
+        if _read_from_replica.get() and REPLICA in connections.databases:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaReadMixin:
+    # for APIViews: run the listed methods, authentication included, against the replica
+    replica_methods = ('get',)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method.lower() in self.replica_methods:
+            with use_replica():
+                return super().dispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,19 @@
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.utils.crypto import constant_time_compare
+
+from .metrics import PASSWORD_HASH_LATENCY
+
+
+class TimedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    # same algorithm name, so existing pbkdf2_sha256 hashes keep verifying
+    def encode(self, password, salt, iterations=None):
+        with PASSWORD_HASH_LATENCY.time(self.algorithm, 'encode'):
+            return super().encode(password, salt, iterations)
+
+    def verify(self, password, encoded):
+        # PBKDF2PasswordHasher.verify goes through self.encode, which would count
+        # every check as an encode too
+        with PASSWORD_HASH_LATENCY.time(self.algorithm, 'verify'):
+            decoded = self.decode(encoded)
+            encoded_2 = super().encode(password, decoded['salt'], decoded['iterations'])
+            return constant_time_compare(encoded, encoded_2)
@@ -0,0 +1,157 @@
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger('smart_rider.instrumentation')
+
+# the collector of the request or WebSocket event being sampled, if any; a
+# ContextVar so it follows database_sync_to_async into its worker thread
+_collector = ContextVar('query_collector', default=None)
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+VALUES_LIST = re.compile(r'(\((?:%s, )*%s\))(?:, \((?:%s, )*%s\))+')
+SAVEPOINT = re.compile(r'"s\d+_x\d+"')
+NUMBER = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    # placeholders are already separate from the params, only IN lists, bulk
+    # VALUES rows, savepoint ids and inlined LIMIT/OFFSET numbers vary between
+    # otherwise identical queries
+    sql = VALUES_LIST.sub(r'\1, ...', IN_LIST.sub('IN (...)', sql))
+    return NUMBER.sub('N', SAVEPOINT.sub('"sN"', sql))
+
+
+class QueryCollector:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self):
+        return sum(n - 1 for n in self.fingerprints.values())
+
+    def summary(self, top=5):
+        return {
+            'queries': self.count,
+            'db_ms': round(self.time * 1000, 2),
+            'duplicates': self.duplicates(),
+            'repeated': [
+                {'sql': sql[:200], 'count': n}
+                for sql, n in self.fingerprints.most_common(top) if n > 1
+            ],
+        }
+
+
+def _record(execute, sql, params, many, context):
+    collector = _collector.get()
+    if collector is None:
+        return execute(sql, params, many, context)
+    return collector(execute, sql, params, many, context)
+
+
+def install(connection, **kwargs):
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+connection_created.connect(install)
+
+
+def sample_rate():
+    return getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 1.0 if settings.DEBUG else 0.01)
+
+
+def start():
+    # (collector, token) when this unit of work is sampled, else (None, None);
+    # work nested in an active collector (collect_queries) is counted there
+    if _collector.get() is not None or random.random() >= sample_rate():
+        return None, None
+    collector = QueryCollector()
+    return collector, _collector.set(collector)
+
+
+def finish(token):
+    if token is not None:
+        _collector.reset(token)
+
+
+@contextmanager
+def collect_queries():
+    # explicit collection for tests and benchmarks, regardless of sampling
+    collector = QueryCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+def emit(kind, name, elapsed, collector=None, **extra):
+    record = {'kind': kind, 'name': name, 'ms': round(elapsed * 1000, 2), **extra}
+    if collector is not None:
+        record.update(collector.summary())
+    slow = elapsed * 1000 >= getattr(settings, 'INSTRUMENTATION_SLOW_MS', 1000)
+    logger.log(logging.WARNING if slow else logging.INFO, json.dumps(record))
+
+
+class QueryCountMiddleware:
+    # Samples INSTRUMENTATION_SAMPLE_RATE of requests (all of them in DEBUG). A
+    # sampled request records every query through the connection wrapper above;
+    # the rest only pay for a random() call and a ContextVar lookup per query.
+    def __init__(self, get_response):
+        self.get_response = get_response
+        for connection in connections.all(initialized_only=True):
+            install(connection)
+
+    def __call__(self, request):
+        collector, token = start()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish(token)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        name = (match.view_name or match.route) if match else request.path
+        if settings.DEBUG and collector is not None:
+            response['X-DB-Queries'] = str(collector.count)
+            response['X-DB-Duplicates'] = str(collector.duplicates())
+            response['Server-Timing'] = f'db;dur={collector.time * 1000:.2f}, total;dur={elapsed * 1000:.2f}'
+        elif collector is not None or elapsed * 1000 >= getattr(settings, 'INSTRUMENTATION_SLOW_MS', 1000):
+            emit('http', name, elapsed, collector, method=request.method, status=response.status_code)
+        return response
+
+
+class InstrumentedConsumerMixin:
+    # The Channels counterpart: every event dispatched to the consumer (connect,
+    # receive, group messages) is one sampled unit, logged as a structured line.
+    async def dispatch(self, message):
+        collector, token = start()
+        started = time.perf_counter()
+        try:
+            return await super().dispatch(message)
+        finally:
+            finish(token)
+            elapsed = time.perf_counter() - started
+            if collector is not None or elapsed * 1000 >= getattr(settings, 'INSTRUMENTATION_SLOW_MS', 1000):
+                emit('ws', f'{type(self).__name__}.{message["type"]}', elapsed, collector)
@@ -0,0 +1,330 @@
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import locks
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Every thread updates its own shard, so the hot path takes no lock: a counter
+# is a dict add, a histogram a list increment. Shards are summed at scrape time.
+# With METRICS_DIR set, each process also writes its totals to <pid>.json every
+# METRICS_FLUSH_INTERVAL_S and the scrape endpoint sums all the files. Shards of
+# finished threads and files of exited processes are folded into one total so
+# neither piles up while counters keep counting.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+EXITED = 'exited.json'
+
+_metrics = {}
+# thread -> shard, plus what finished threads left behind
+_shards = {}
+_retired = {}
+_shards_lock = threading.Lock()
+_local = threading.local()
+_flusher = None
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _prune()
+            _shards[threading.current_thread()] = shard
+        if metrics_dir():
+            _start_flusher()
+    return shard
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _metrics[name] = self
+
+    def key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}')
+        return (self.name, tuple(str(label) for label in labels))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = _shard()
+        key = self.key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    # summed over threads and live processes, only inc/dec so shards stay additive
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = _shard()
+        key = self.key(labels)
+        slots = shard.get(key)
+        if slots is None:
+            # one count per bucket plus +Inf, then sum and count
+            slots = shard[key] = [0] * (len(self.buckets) + 3)
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-2] += value
+        slots[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+def _add(totals, key, value):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(current, list):
+        for i, v in enumerate(value):
+            current[i] += v
+    else:
+        totals[key] = current + value
+
+
+def _prune():
+    # with _shards_lock held; a finished thread no longer writes its shard
+    for thread in [thread for thread in _shards if not thread.is_alive()]:
+        for key, value in _shards.pop(thread).items():
+            _add(_retired, key, value)
+
+
+def local_totals():
+    totals = {}
+    with _shards_lock:
+        _prune()
+        shards = list(_shards.values())
+        for key, value in _retired.items():
+            _add(totals, key, value)
+    for shard in shards:
+        # dict.copy() runs under the GIL, the owner thread may keep writing
+        for key, value in shard.copy().items():
+            _add(totals, key, value)
+    return totals
+
+
+def metrics_dir():
+    path = getattr(settings, 'METRICS_DIR', None)
+    return Path(path) if path else None
+
+
+def _write(path, totals):
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps([[name, labels, value] for (name, labels), value in totals.items()]))
+    os.replace(tmp, path)
+
+
+def _read(path):
+    # totals of a file, metrics this process does not define are left out
+    try:
+        entries = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+    return {(name, tuple(labels)): value for name, labels, value in entries if name in _metrics}
+
+
+def flush():
+    directory = metrics_dir()
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    _write(directory / f'{os.getpid()}.json', local_totals())
+
+
+def _flush_loop():
+    while True:
+        time.sleep(getattr(settings, 'METRICS_FLUSH_INTERVAL_S', 5))
+        flush()
+
+
+def _start_flusher():
+    global _flusher
+    with _shards_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+        _flusher.start()
+    atexit.register(flush)
+
+
+def _after_fork():
+    # a forked worker starts from zero, its parent's numbers are the parent's file
+    global _flusher, _shards_lock
+    _shards.clear()
+    _retired.clear()
+    _local.__dict__.clear()
+    _shards_lock = threading.Lock()
+    _flusher = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _exited(path, pid):
+    # a live worker rewrites its file every flush interval, an old one is left
+    # over from a process whose pid has been reused since
+    if not _alive(pid):
+        return True
+    try:
+        age = time.time() - path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return age > max(60, 10 * getattr(settings, 'METRICS_FLUSH_INTERVAL_S', 5))
+
+
+def _retire(directory, path):
+    # counters of exited workers still count, their gauges do not
+    with open(directory / 'exited.lock', 'a') as lock:
+        locks.lock(lock, locks.LOCK_EX)
+        try:
+            if not path.exists():
+                # another scrape got there first
+                return
+            exited = _read(directory / EXITED)
+            for key, value in _read(path).items():
+                if _metrics[key[0]].kind != 'gauge':
+                    _add(exited, key, value)
+            _write(directory / EXITED, exited)
+            path.unlink()
+        finally:
+            locks.unlock(lock)
+
+
+def collect():
+    totals = local_totals()
+    directory = metrics_dir()
+    if directory is not None and directory.exists():
+        for path in directory.glob('*.json'):
+            if not path.stem.isdigit() or int(path.stem) == os.getpid():
+                continue
+            if _exited(path, int(path.stem)):
+                _retire(directory, path)
+                continue
+            for key, value in _read(path).items():
+                _add(totals, key, value)
+        for key, value in _read(directory / EXITED).items():
+            _add(totals, key, value)
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals=None):
+    # Prometheus text exposition format 0.0.4
+    totals = collect() if totals is None else totals
+    series = {}
+    for (name, labels), value in totals.items():
+        series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, value in sorted(series.get(name, [])):
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{_labels(metric.labelnames, labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(float(bound))
+                lines.append(f'{name}_bucket{_labels(metric.labelnames, labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(metric.labelnames, labels)} {_number(float(value[-2]))}')
+            lines.append(f'{name}_count{_labels(metric.labelnames, labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency by URL name',
+                         ['view', 'method', 'status'])
+CHAT_CONNECTIONS = Gauge('chat_connections_active', 'Open ChatConsumer WebSocket connections')
+GROUP_SEND_LATENCY = Histogram('channel_group_send_duration_seconds', 'Channel layer group_send latency',
+                               ['type'])
+OTP_LATENCY = Histogram('otp_delivery_duration_seconds', 'OTP delivery latency', ['provider'])
+OTP_FAILURES = Counter('otp_delivery_failures_total', 'Failed OTP deliveries', ['provider'])
+PASSWORD_HASH_LATENCY = Histogram('password_hash_duration_seconds', 'Password hashing and verification time',
+                                  ['algorithm', 'operation'], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5))
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        # unmatched paths share one label so scanners can not blow up the series count
+        view = (match.view_name or match.route) if match else 'unmatched'
+        HTTP_LATENCY.observe(time.perf_counter() - start, view, request.method, response.status_code)
+        return response
+
+
+async def group_send(channel_layer, group, message):
+    start = time.perf_counter()
+    try:
+        return await channel_layer.group_send(group, message)
+    finally:
+        GROUP_SEND_LATENCY.observe(time.perf_counter() - start, message.get('type', ''))
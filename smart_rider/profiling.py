@@ -0,0 +1,234 @@
+import asyncio
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from rest_framework import permissions, serializers
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+# Opt-in profiling of single requests (or a short window of WebSocket events)
+# in production. A staff user mints a signed, short-lived token; a request that
+# carries it in X-Profile-Token (or ?_profile=) runs with a sampler thread that
+# reads the handling thread's stack every PROFILING_INTERVAL_S. Stacks are
+# stored in folded format ("a;b;c <count>"), the input of flamegraph.pl and
+# speedscope. Without a valid token nothing is sampled, and a token profiles
+# one request or connection.
+
+SALT = 'smart_rider.profiling'
+# one profile per process at a time bounds the overhead of a leaked token
+_slot = threading.Semaphore(1)
+
+
+def token_max_age():
+    return getattr(settings, 'PROFILING_TOKEN_MAX_AGE_S', 600)
+
+
+def make_token(user, scope, seconds=0):
+    return signing.dumps({'u': user.pk, 's': scope, 'd': seconds, 'n': secrets.token_urlsafe(12)}, salt=SALT)
+
+
+def read_token(token, scope):
+    if not token or not getattr(settings, 'PROFILING_ENABLED', True):
+        return None
+    try:
+        payload = signing.loads(token, salt=SALT, max_age=token_max_age())
+    except signing.BadSignature:
+        return None
+    return payload if payload.get('s') == scope and payload.get('n') else None
+
+
+def nonce_key(payload):
+    # remembered until the token expires anyway, the first claim wins
+    return f'profiling:token:{payload["n"]}'
+
+
+def claim_token(payload):
+    return cache.add(nonce_key(payload), 1, token_max_age())
+
+
+async def aclaim_token(payload):
+    return await cache.aadd(nonce_key(payload), 1, token_max_age())
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class Sampler:
+    def __init__(self, thread_id, interval=None, max_samples=50000):
+        self.thread_id = thread_id
+        self.interval = interval or getattr(settings, 'PROFILING_INTERVAL_S', 0.005)
+        self.max_samples = max_samples
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # can be started and stopped repeatedly, samples accumulate
+        self._stop.clear()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed += time.perf_counter() - self._started
+
+    def _run(self):
+        while not self._stop.wait(self.interval) and self.samples < self.max_samples:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def folded(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def save_capture(kind, target, sampler, payload):
+    from accounts.models import ProfileCapture
+    return ProfileCapture.objects.create(
+        kind=kind,
+        target=target[:200],
+        requested_by_id=payload.get('u'),
+        duration_ms=round(sampler.elapsed * 1000, 2),
+        samples=sampler.samples,
+        folded=sampler.folded(),
+    )
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.headers.get('X-Profile-Token') or request.GET.get('_profile')
+        payload = read_token(token, 'http') if token else None
+        if payload is None:
+            return self.get_response(request)
+        # the slot first, so a busy process does not use up the token
+        if not _slot.acquire(blocking=False):
+            refused = 'busy'
+        elif not claim_token(payload):
+            _slot.release()
+            refused = 'used'
+        else:
+            refused = None
+        if refused:
+            response = self.get_response(request)
+            response['X-Profile'] = refused
+            return response
+        try:
+            with Sampler(threading.get_ident()) as sampler:
+                response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            target = f'{request.method} {(match.view_name if match else None) or request.path}'
+            response['X-Profile'] = str(save_capture('http', target, sampler, payload).pk)
+        finally:
+            _slot.release()
+        return response
+
+
+class ProfiledConsumerMixin:
+    # A connection opened with ?_profile=<ws token> has the events it handles in
+    # the next d seconds (capped by PROFILING_MAX_WINDOW_S) sampled into one
+    # capture. The sampler watches the event loop thread only while one of this
+    # consumer's handlers runs, but other coroutines interleaved at that moment
+    # show up too. The capture is saved at the end of the window even when the
+    # connection goes quiet, so the process-wide slot is not held by an idle socket.
+    async def dispatch(self, message):
+        profile = getattr(self, '_profile', None)
+        if message['type'] == 'websocket.connect' and profile is None:
+            profile = self._profile = await self._start_profile()
+        if not profile:
+            return await super().dispatch(message)
+
+        profile['running'] += 1
+        if profile['running'] == 1:
+            profile['sampler'].start()
+        try:
+            return await super().dispatch(message)
+        finally:
+            profile['running'] -= 1
+            if not profile['running']:
+                profile['sampler'].stop()
+                if message['type'] == 'websocket.disconnect' or time.monotonic() >= profile['until']:
+                    await self._end_profile(profile)
+
+    async def _start_profile(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        payload = read_token(query.get('_profile', [None])[0], 'ws')
+        if payload is None or not _slot.acquire(blocking=False):
+            return False
+        if not await aclaim_token(payload):
+            _slot.release()
+            return False
+        window = min(payload.get('d') or 10, getattr(settings, 'PROFILING_MAX_WINDOW_S', 60))
+        profile = {
+            'payload': payload,
+            'until': time.monotonic() + window,
+            'sampler': Sampler(threading.get_ident()),
+            'running': 0,
+        }
+        profile['timer'] = asyncio.ensure_future(self._profile_deadline(profile, window))
+        return profile
+
+    async def _profile_deadline(self, profile, window):
+        await asyncio.sleep(window)
+        # a handler still running ends the profile itself when it returns
+        if not profile['running']:
+            await self._end_profile(profile)
+
+    async def _end_profile(self, profile):
+        # once, from whichever comes first: disconnect, an event past the window, the timer
+        if self._profile is not profile:
+            return
+        self._profile = False
+        if profile['timer'] is not asyncio.current_task():
+            profile['timer'].cancel()
+        try:
+            await database_sync_to_async(save_capture)(
+                'ws', type(self).__name__, profile['sampler'], profile['payload'])
+        finally:
+            _slot.release()
+
+
+class ProfileTokenSerializer(serializers.Serializer):
+    scope = serializers.ChoiceField(choices=['http', 'ws'], default='http')
+    seconds = serializers.IntegerField(min_value=1, max_value=600, default=10)
+
+
+class ProfileTokenView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        serializer = ProfileTokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        return Response({
+            'token': make_token(request.user, data['scope'], data['seconds']),
+            'expires_in': getattr(settings, 'PROFILING_TOKEN_MAX_AGE_S', 600),
+        })
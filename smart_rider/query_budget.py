@@ -0,0 +1,77 @@
+import os
+
+from django.db import transaction
+from django.urls import URLResolver
+
+from smart_rider.instrumentation import collect_queries
+
+# Query and payload budgets for the test suites. Every URL name and consumer
+# event declares the most queries it may run and the largest body it may send;
+# the tests replay them at each of VOLUMES related rows, so a query per row
+# fails with the SQL fingerprints that repeated instead of reaching production.
+
+# 1 and 100 rows already catch a query per row; QUERY_BUDGET_LARGE=1 adds a
+# 10,000 row run for payload growth, which takes most of a minute
+VOLUMES = (1, 100, 1000)
+if os.environ.get('QUERY_BUDGET_LARGE'):
+    VOLUMES += (10000,)
+
+
+class Budget:
+    def __init__(self, queries, payload, payload_per_row=0):
+        self.queries = queries
+        self.payload = payload
+        # only for endpoints that return every row by design
+        self.payload_per_row = payload_per_row
+
+    def max_payload(self, rows):
+        return self.payload + self.payload_per_row * rows
+
+
+def url_names(urlpatterns):
+    # None stands for a pattern without a name, which can not have a budget
+    names = []
+    for pattern in urlpatterns:
+        if isinstance(pattern, URLResolver):
+            names.extend(url_names(pattern.url_patterns))
+        else:
+            names.append(pattern.name)
+    return names
+
+
+def describe(collector):
+    return '\n'.join(f'  {count} x {sql}' for sql, count in collector.fingerprints.most_common())
+
+
+class QueryBudgetMixin:
+    budgets = {}
+
+    def assertEveryNameBudgeted(self, names):
+        self.assertNotIn(None, names, 'Name every URL pattern so it can be given a budget')
+        self.assertEqual(set(names), set(self.budgets))
+
+    def measure(self, call):
+        # call() runs in a savepoint that is rolled back, writes do not pile up
+        # between runs; the savepoint statements themselves are not counted
+        with transaction.atomic():
+            with collect_queries() as collector:
+                result = call()
+            transaction.set_rollback(True)
+        return collector, result
+
+    def assertWithinBudget(self, key, collector, payload, rows):
+        budget = self.budgets[key]
+        if collector.count > budget.queries:
+            self.fail(f'{key} ran {collector.count} queries with {rows} rows, the budget is '
+                      f'{budget.queries}:\n{describe(collector)}')
+        if payload > budget.max_payload(rows):
+            self.fail(f'{key} sent {payload} bytes with {rows} rows, the budget is {budget.max_payload(rows)}')
+
+    def assertNotGrowing(self, key, first, collector, rows):
+        # a statement that runs more often with more rows is an O(n) pattern; one
+        # that shows up once is not, a cache that was warm for the first run misses
+        grown = {sql: count for sql, count in collector.fingerprints.items()
+                 if count > max(first.fingerprints[sql], 1)}
+        if grown:
+            lines = '\n'.join(f'  {first.fingerprints[sql]} -> {count} x {sql}' for sql, count in grown.items())
+            self.fail(f'{key} runs more queries with {rows} rows than with {VOLUMES[0]}:\n{lines}')
@@ -11,13 +11,12 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
-from datetime import timedelta  
+from datetime import timedelta
 import os
-from pathlib import Path
-import environ 
+import sys
+import environ
 env = environ.Env()
 environ.Env.read_env()
-import environ
 
 
 
@@ -34,6 +33,9 @@ SECRET_KEY = 'django-insecure-u$6+ys#te@atk^c2+nub#u@+)3#aobr1vu^=%^3uoo28=d%_al
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# manage.py test, keeps the suite's output free of request log lines
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = []
 
 AUTH_USER_MODEL = 'accounts.User'  # correct format: 'app_name.ModelName'
@@ -62,6 +64,9 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'smart_rider.profiling.ProfilingMiddleware',
+    'smart_rider.metrics.MetricsMiddleware',
+    'smart_rider.instrumentation.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,22 +94,175 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'smart_rider.wsgi.application'
+ASGI_APPLICATION = 'smart_rider.asgi.application'
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+# Drivers join one channel group per geocell level (sizes in degrees)
+GEOCELL_LEVELS = (0.01, 0.04, 0.16)
+DRIVER_SEARCH_RADIUS_M = 5000
+# how long a driver shown an offer may accept it
+RIDE_OFFER_TTL_S = 120
+
+# ETA and fare estimation grid (see accounts.estimates)
+SERVICE_AREA = {'south': 23.65, 'west': 90.30, 'north': 23.92, 'east': 90.52}
+ESTIMATE_CELL_DEG = 0.02
+ESTIMATE_GRID_PATH = BASE_DIR / 'estimate_grid.bin'
+
+# Driver location history segments (see accounts.location_history)
+LOCATION_HISTORY_ROOT = BASE_DIR / 'location_history'
+LOCATION_HISTORY_WINDOW = 3600
+LOCATION_HISTORY_BATCH = 64
+
+# Live trip tracking: publish on movement or heartbeat, throttle per watcher
+TRACKING_MIN_MOVE_M = 15
+TRACKING_HEARTBEAT_S = 30
+TRACKING_MIN_INTERVAL_S = 1
+
+# Surge pricing from sliding-window supply and demand per geocell, counted in
+# a cache alias every HTTP worker and consumer process shares
+SURGE_CACHE = 'shared'
+SURGE_WINDOW_S = 300
+SURGE_BUCKETS = 30
+SURGE_CELL_LEVEL = 0
+SURGE_THRESHOLD = 1.0
+SURGE_SENSITIVITY = 0.5
+SURGE_MAX = 3.0
+
+# Service-area zones are rasterized into cells of this size (see accounts.zones)
+ZONE_CELL_DEG = 0.005
+ZONE_RELOAD_INTERVAL_S = 30
+
+# Per-request/per-event query counts and latency (see smart_rider.instrumentation):
+# response headers in DEBUG, JSON log lines on the smart_rider.instrumentation logger otherwise.
+# Off under tests, which turn it on where they check it
+INSTRUMENTATION_SAMPLE_RATE = env.float('INSTRUMENTATION_SAMPLE_RATE',
+                                        default=0 if TESTING else 1.0 if DEBUG else 0.01)
+INSTRUMENTATION_SLOW_MS = 1000
+
+# Prometheus-style metrics at /metrics (see smart_rider.metrics). With several
+# worker processes point METRICS_DIR at a shared directory; the endpoint needs
+# METRICS_TOKEN as a bearer token, or DEBUG when no token is set
+METRICS_DIR = env('METRICS_DIR', default=None)
+METRICS_FLUSH_INTERVAL_S = 5
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# On-demand sampling profiler (see smart_rider.profiling), staff mint tokens at
+# /api/profiling/token/ and captures are downloaded from the admin
+PROFILING_ENABLED = env.bool('PROFILING_ENABLED', default=True)
+PROFILING_INTERVAL_S = 0.005
+PROFILING_TOKEN_MAX_AGE_S = 600
+PROFILING_MAX_WINDOW_S = 60
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+        'null': {'class': 'logging.NullHandler'},
+    },
+    'loggers': {
+        # tests read these records with assertLogs instead
+        'smart_rider': {'handlers': ['null' if TESTING else 'console'], 'level': 'INFO', 'propagate': not TESTING},
+    },
+}
+
+# Deleted accounts are purged in chunks by accounts.purge, in a background
+# thread of the web process and/or by `manage.py purge_accounts --loop`
+ACCOUNT_PURGE_IN_PROCESS = env.bool('ACCOUNT_PURGE_IN_PROCESS', default=True)
+ACCOUNT_PURGE_CHUNK_SIZE = 500
+ACCOUNT_PURGE_PAUSE_S = 0.05
+ACCOUNT_PURGE_STALE_S = 300
+
+# Reverse geocoding for trip locations (see accounts.geocoding). The fixture
+# provider answers from a bundled file, set GEOCODING_PROVIDER to
+# accounts.geocoding.NominatimProvider for real lookups
+GEOCODING_PROVIDER = env('GEOCODING_PROVIDER', default='accounts.geocoding.FixtureProvider')
+GEOCODING_FIXTURES = BASE_DIR / 'accounts' / 'fixtures' / 'geocoding.json'
+GEOCODING_PRECISION = 4
+GEOCODING_TTL_S = 30 * 86400
+GEOCODING_MAX_ENTRIES = 100000
+GEOCODING_WORKERS = 4
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Configured from the environment: DATABASE_URL for the primary and an optional
+# DATABASE_REPLICA_URL used for read-heavy views (see smart_rider.db_router).
+def database_profile(url, replica=False):
+    db = env.db_url_config(url)
+    db['CONN_MAX_AGE'] = env.int('DB_CONN_MAX_AGE', default=60)
+    db['CONN_HEALTH_CHECKS'] = True
+    options = db.setdefault('OPTIONS', {})
+    if db['ENGINE'] == 'django.db.backends.sqlite3':
+        pragmas = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL']
+        if replica:
+            pragmas.append('PRAGMA query_only=ON')
+        options.setdefault('init_command', '; '.join(pragmas) + ';')
+        options.setdefault('transaction_mode', 'IMMEDIATE')
+        options.setdefault('timeout', 20)
+    elif db['ENGINE'] == 'django.db.backends.postgresql' and env.bool('DB_POOL', default=False):
+        options['pool'] = {
+            'min_size': env.int('DB_POOL_MIN_SIZE', default=2),
+            'max_size': env.int('DB_POOL_MAX_SIZE', default=10),
+        }
+        # the pool owns connection reuse, persistent connections must be off
+        db['CONN_MAX_AGE'] = 0
+    if replica:
+        db['TEST'] = {'MIRROR': 'default'}
+    return db
+
+
 DATABASES = {
+    'default': database_profile(env('DATABASE_URL', default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}")),
+}
+if env('DATABASE_REPLICA_URL', default=None):
+    DATABASES['replica'] = database_profile(env('DATABASE_REPLICA_URL'), replica=True)
+
+DATABASE_ROUTERS = ['smart_rider.db_router.ReplicaRouter']
+
+
+# Cache
+# A per-process LRU in front of a cache shared by every worker (see smart_rider.cache).
+# CACHE_URL selects the shared store, e.g. redis://..., a file cache stands in locally.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'smart_rider.cache.TwoTierCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 30,
+            'POLL_INTERVAL': 0.5,
+        },
+    },
+    'shared': env.cache_url('CACHE_URL', default=f"filecache://{BASE_DIR / '.cache'}?max_entries=10000"),
 }
+if TESTING:
+    # a fresh store per run, tests must not read or leave state in a developer's cache
+    CACHES['shared'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'}
+# the invalidation log and surge counters need atomic incr, Django's file cache has none
+if CACHES['shared']['BACKEND'] == 'django.core.cache.backends.filebased.FileBasedCache':
+    CACHES['shared']['BACKEND'] = 'smart_rider.cache.FileBasedCache'
 
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
+# Django's defaults with the PBKDF2 hasher timed for metrics
+PASSWORD_HASHERS = [
+    'smart_rider.hashers.TimedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -143,6 +301,13 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Uploaded photos are resized in the background (see accounts.media), px of the longest side
+MEDIA_VARIANTS = {'thumb': 160, 'display': 1080}
+MEDIA_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 